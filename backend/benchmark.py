@@ -0,0 +1,348 @@
+"""
+Benchmark reproducible sobre el corpus imagenes_prueba/.
+
+Mide, en proceso (importando servidor.py) y/o contra un servidor HTTP:
+  - arranque en frío (carga del modelo hasta el primer resultado)
+  - percentiles de latencia por etapa (tiempos_etapas_ms) de histología y radiografía
+  - imágenes/s de encode_image a varios tamaños de lote y nº de hilos (en proceso)
+    o de /analizar-lote a varios tamaños de lote (HTTP)
+  - RSS máximo
+  - precisión de la decodificación reducida (draft JPEG + prerreducción) frente a la
+    decodificación completa, con TOLERANCIA_DECODIFICACION (en proceso)
+
+y escribe una línea base JSON que puede compararse con la de otra versión.
+
+Uso:
+    python benchmark.py --modo proceso --salida linea_base.json
+    python benchmark.py --modo http --url http://localhost:8000 --salida linea_base_http.json
+    python benchmark.py --modo proceso --comparar linea_base.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus_prueba import cargar_corpus, leer, tipo_mime
+
+# Métricas que se comparan entre líneas base: (ruta en el JSON, mayor es mejor)
+METRICAS_COMPARADAS = [
+    (("proceso", "arranque_frio_s"), False),
+    (("proceso", "histologia", "total_ms", "p50"), False),
+    (("proceso", "histologia", "total_ms", "p99"), False),
+    (("proceso", "radiografia", "total_ms", "p50"), False),
+    (("proceso", "rss_max_mb",), False),
+    (("proceso", "decodificacion_reducida", "diferencia_media"), False),
+    (("http", "histologia", "cliente_ms", "p50"), False),
+    (("http", "histologia", "cliente_ms", "p99"), False),
+    (("http", "radiografia", "cliente_ms", "p50"), False),
+]
+
+
+def percentiles(muestras):
+    if not muestras:
+        return None
+    ordenadas = sorted(muestras)
+
+    def p(q):
+        return round(ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))], 2)
+
+    return {"n": len(ordenadas), "p50": p(0.50), "p90": p(0.90), "p99": p(0.99),
+            "media": round(sum(ordenadas) / len(ordenadas), 2), "max": round(ordenadas[-1], 2)}
+
+
+def resumen_etapas(respuestas, totales_ms):
+    """Percentiles por etapa a partir de los tiempos_etapas_ms de cada respuesta"""
+    etapas = {}
+    for r in respuestas:
+        for etapa, ms in r.get("tiempos_etapas_ms", {}).items():
+            etapas.setdefault(etapa, []).append(ms)
+    return {
+        "etapas_ms": {etapa: percentiles(ms) for etapa, ms in etapas.items()},
+        "total_ms": percentiles(totales_ms),
+    }
+
+
+def rss_max_mb():
+    import resource
+    # ru_maxrss está en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+def metadatos():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+# =============================================================================
+# EN PROCESO
+# =============================================================================
+
+def comparar_decodificacion_corpus(corpus, procesador):
+    """Tensor preprocesado con y sin decodificación reducida para cada imagen del corpus"""
+    import servidor
+
+    rutas = corpus["histologia"] + corpus["radiografia"]
+    print(f"🔍 Decodificación reducida frente a completa ({len(rutas)} imágenes)...")
+    filas = []
+    for ruta in rutas:
+        datos = leer(ruta)
+        tiempos = {}
+        for reducida in (False, True):
+            t = time.perf_counter()
+            servidor.decodificar_imagen(datos, reducida=reducida)
+            tiempos[reducida] = (time.perf_counter() - t) * 1000
+        fila = servidor.comparar_decodificacion(datos, procesador)
+        fila.update({"imagen": os.path.basename(ruta),
+                     "completa_ms": round(tiempos[False], 2), "reducida_ms": round(tiempos[True], 2)})
+        if not fila["dentro_tolerancia"]:
+            print(f"   ⚠️ {fila['imagen']}: diferencia media {fila['diferencia_media']} "
+                  f"> {servidor.TOLERANCIA_DECODIFICACION}")
+        filas.append(fila)
+    if not filas:
+        return None
+    return {
+        "tolerancia": servidor.TOLERANCIA_DECODIFICACION,
+        "diferencia_media": round(sum(f["diferencia_media"] for f in filas) / len(filas), 5),
+        "diferencia_media_max": max(f["diferencia_media"] for f in filas),
+        "fraccion_dentro_tolerancia": round(sum(f["dentro_tolerancia"] for f in filas) / len(filas), 3),
+        "completa_ms": percentiles([f["completa_ms"] for f in filas]),
+        "reducida_ms": percentiles([f["reducida_ms"] for f in filas]),
+        "imagenes": filas,
+    }
+
+
+def benchmark_proceso(corpus, repeticiones, tamanos_lote, hilos, iteraciones):
+    import torch
+    import servidor
+
+    resultado = {"torch": torch.__version__, "hilos_torch": torch.get_num_threads()}
+
+    # Sin caché: cada repetición decodifica e infiere de verdad
+    servidor.cache_imagenes.max_entradas = 0
+    servidor.cache_imagenes._entradas.clear()
+
+    print("⏱️ Arranque en frío...")
+    inicio = time.perf_counter()
+    if not servidor.cargar_modelo("biomedclip"):
+        raise SystemExit("❌ No se pudo cargar BiomedCLIP")
+    carga = time.perf_counter() - inicio
+    servidor.analizar_imagen(leer(corpus["histologia"][0]))
+    resultado["motor_vision"] = servidor.modelos_cargados["biomedclip"]["motor"].nombre
+    resultado["paridad_motor"] = servidor.modelos_cargados["biomedclip"].get("paridad_motor")
+    resultado["carga_modelo_s"] = round(carga, 2)
+    resultado["arranque_frio_s"] = round(time.perf_counter() - inicio, 2)
+
+    for modalidad, funcion in (("histologia", servidor.analizar_imagen),
+                               ("radiografia", servidor.analizar_imagen_radiografia)):
+        rutas = corpus[modalidad]
+        if not rutas:
+            continue
+        print(f"📊 Latencia por etapa: {modalidad} ({len(rutas)} imágenes x {repeticiones})")
+        respuestas, totales = [], []
+        for _ in range(repeticiones):
+            for ruta in rutas:
+                datos = leer(ruta)
+                t = time.perf_counter()
+                respuestas.append(funcion(datos))
+                totales.append((time.perf_counter() - t) * 1000)
+        resultado[modalidad] = resumen_etapas(respuestas, totales)
+
+    procesador = servidor.modelos_cargados["biomedclip"]["procesador"]
+    resultado["decodificacion_reducida"] = comparar_decodificacion_corpus(corpus, procesador)
+
+    print("🚀 Rendimiento de encode_image por tamaño de lote e hilos...")
+    tensores = [servidor.decodificar_imagen(leer(r))[0] for r in corpus["histologia"]]
+    tensores = [procesador(imagen) for imagen in tensores]
+    hilos_originales = torch.get_num_threads()
+    rendimiento = []
+    try:
+        for n_hilos in hilos:
+            torch.set_num_threads(n_hilos)
+            for tamano in tamanos_lote:
+                lote = [tensores[i % len(tensores)] for i in range(tamano)]
+                servidor._codificar_lote_imagenes(lote)  # calentamiento de esta forma
+                t = time.perf_counter()
+                for _ in range(iteraciones):
+                    servidor._codificar_lote_imagenes(lote)
+                duracion = time.perf_counter() - t
+                fila = {"hilos": n_hilos, "tamano_lote": tamano,
+                        "imagenes_por_s": round(tamano * iteraciones / duracion, 2),
+                        "ms_por_lote": round(duracion * 1000 / iteraciones, 2)}
+                print(f"   hilos={n_hilos:>2} lote={tamano:>3}: {fila['imagenes_por_s']} img/s")
+                rendimiento.append(fila)
+    finally:
+        torch.set_num_threads(hilos_originales)
+    resultado["rendimiento_encode"] = rendimiento
+    resultado["rss_max_mb"] = rss_max_mb()
+
+    servidor.planificador_imagenes.detener()
+    return resultado
+
+
+# =============================================================================
+# HTTP
+# =============================================================================
+
+def benchmark_http(corpus, url, repeticiones, tamanos_lote, arranque_frio):
+    import requests
+
+    url = url.rstrip("/")
+    sesion = requests.Session()
+    resultado = {"url": url}
+
+    def publicar(ruta_endpoint, ruta):
+        archivos = {"archivo": (os.path.basename(ruta), leer(ruta), tipo_mime(ruta))}
+        t = time.perf_counter()
+        r = sesion.post(url + ruta_endpoint, files=archivos, timeout=600)
+        r.raise_for_status()
+        return r.json(), (time.perf_counter() - t) * 1000
+
+    rss = []
+
+    def muestrear_rss():
+        valor = sesion.get(url + "/estado", timeout=30).json().get("memoria_rss_mb")
+        if valor is not None:
+            rss.append(valor)
+
+    if arranque_frio:
+        print("⏱️ Arranque en frío (libera y recarga el modelo del servidor)...")
+        sesion.post(url + "/liberar-modelo", params={"modelo": "todas"}, timeout=60).raise_for_status()
+    inicio = time.perf_counter()
+    sesion.post(url + "/cargar-modelo", params={"modelo": "biomedclip"}, timeout=600).raise_for_status()
+    publicar("/analizar", corpus["histologia"][0])
+    resultado["arranque_frio_s" if arranque_frio else "primera_respuesta_s"] = round(time.perf_counter() - inicio, 2)
+    muestrear_rss()
+
+    # El servidor cachea embeddings por contenido: solo la primera pasada mide decodificación e inferencia
+    for modalidad, endpoint in (("histologia", "/analizar"), ("radiografia", "/analizar-radiografia")):
+        rutas = corpus[modalidad]
+        if not rutas:
+            continue
+        print(f"📊 Latencia HTTP: {endpoint} ({len(rutas)} imágenes x {repeticiones})")
+        respuestas, cliente, sin_cache = [], [], []
+        for _ in range(repeticiones):
+            for ruta in rutas:
+                respuesta, ms = publicar(endpoint, ruta)
+                respuestas.append(respuesta)
+                cliente.append(ms)
+                if not respuesta.get("desde_cache"):
+                    sin_cache.append(ms)
+        resultado[modalidad] = resumen_etapas(respuestas, sin_cache)
+        resultado[modalidad]["cliente_ms"] = percentiles(cliente)
+        muestrear_rss()
+
+    print("🚀 Rendimiento de /analizar-lote por tamaño de lote...")
+    rendimiento = []
+    for tamano in tamanos_lote:
+        rutas = [corpus["histologia"][i % len(corpus["histologia"])] for i in range(tamano)]
+        archivos = [("archivos", (f"{i}_{os.path.basename(r)}", leer(r), tipo_mime(r))) for i, r in enumerate(rutas)]
+        t = time.perf_counter()
+        sesion.post(url + "/analizar-lote", files=archivos, timeout=600).raise_for_status()
+        duracion = time.perf_counter() - t
+        rendimiento.append({"tamano_lote": tamano, "imagenes_por_s": round(tamano / duracion, 2),
+                            "ms_por_lote": round(duracion * 1000, 2)})
+        print(f"   lote={tamano:>3}: {rendimiento[-1]['imagenes_por_s']} img/s")
+    resultado["rendimiento_lote"] = rendimiento
+    muestrear_rss()
+    resultado["rss_max_mb"] = max(rss) if rss else None
+    return resultado
+
+
+# =============================================================================
+# COMPARACIÓN DE LÍNEAS BASE
+# =============================================================================
+
+def _valor(datos, ruta):
+    for clave in ruta:
+        if not isinstance(datos, dict) or clave not in datos:
+            return None
+        datos = datos[clave]
+    return datos
+
+
+def comparar(actual, base, tolerancia):
+    """Imprime las diferencias y devuelve True si alguna métrica empeora más que la tolerancia"""
+    regresion = False
+    print(f"\n📐 Comparación con la línea base ({base.get('metadatos', {}).get('commit')}):")
+    for ruta, mayor_mejor in METRICAS_COMPARADAS:
+        antes, ahora = _valor(base, ruta), _valor(actual, ruta)
+        if not antes or ahora is None:
+            continue
+        cambio = (ahora - antes) / antes
+        empeora = -cambio if mayor_mejor else cambio
+        marca = "❌" if empeora > tolerancia else "✅"
+        regresion = regresion or empeora > tolerancia
+        print(f"   {marca} {'.'.join(ruta)}: {antes} → {ahora} ({cambio:+.1%})")
+    for fila in actual.get("proceso", {}).get("rendimiento_encode", []):
+        previa = next((f for f in base.get("proceso", {}).get("rendimiento_encode", [])
+                       if f["hilos"] == fila["hilos"] and f["tamano_lote"] == fila["tamano_lote"]), None)
+        if previa:
+            cambio = (fila["imagenes_por_s"] - previa["imagenes_por_s"]) / previa["imagenes_por_s"]
+            marca = "❌" if -cambio > tolerancia else "✅"
+            regresion = regresion or -cambio > tolerancia
+            print(f"   {marca} encode hilos={fila['hilos']} lote={fila['tamano_lote']}: "
+                  f"{previa['imagenes_por_s']} → {fila['imagenes_por_s']} img/s ({cambio:+.1%})")
+    return regresion
+
+
+def _lista_enteros(texto):
+    return [int(x) for x in texto.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de BiomedCLIP sobre imagenes_prueba/")
+    parser.add_argument("--modo", choices=["proceso", "http", "ambos"], default="proceso")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--corpus", default=None, help="Directorio del corpus (por defecto imagenes_prueba/)")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--lotes", type=_lista_enteros, default=[1, 4, 8, 16])
+    parser.add_argument("--hilos", type=_lista_enteros, default=sorted({1, max(1, (os.cpu_count() or 2) // 2), os.cpu_count() or 1}))
+    parser.add_argument("--iteraciones", type=int, default=5, help="Lotes medidos por combinación de tamaño e hilos")
+    parser.add_argument("--arranque-frio", action="store_true", help="HTTP: libera el modelo del servidor antes de medir")
+    parser.add_argument("--salida", default=None, help="Fichero JSON de la línea base")
+    parser.add_argument("--comparar", default=None, help="Línea base JSON anterior")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="Empeoramiento admitido (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    corpus = cargar_corpus(args.corpus)
+    print(f"🖼️ Corpus: {len(corpus['histologia'])} imágenes de histología/forense, "
+          f"{len(corpus['radiografia'])} radiografías")
+
+    linea_base = {"metadatos": metadatos(), "parametros": vars(args)}
+    if args.modo in ("proceso", "ambos"):
+        linea_base["proceso"] = benchmark_proceso(corpus, args.repeticiones, args.lotes, args.hilos, args.iteraciones)
+    if args.modo in ("http", "ambos"):
+        linea_base["http"] = benchmark_http(corpus, args.url, args.repeticiones, args.lotes, args.arranque_frio)
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(linea_base, f, ensure_ascii=False, indent=2)
+        print(f"💾 Línea base guardada en {args.salida}")
+    else:
+        print(json.dumps(linea_base, ensure_ascii=False, indent=2))
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            base = json.load(f)
+        if comparar(linea_base, base, args.tolerancia):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Cola persistente de trabajos de análisis sobre SQLite (modo WAL).
+
+Cada trabajo agrupa varias imágenes; cada imagen es una unidad de la cola que
+los trabajadores reclaman de forma atómica (BEGIN IMMEDIATE), de modo que varios
+trabajadores -o varios procesos- pueden drenar la misma base de datos. Las
+imágenes y los resultados se guardan en disco, así que los trabajos sin terminar
+se reanudan tras un reinicio del contenedor (cuando vence su lease).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    estado TEXT NOT NULL,
+    modalidad TEXT NOT NULL,
+    categoria TEXT,
+    prioridad TEXT,
+    total INTEGER NOT NULL,
+    completadas INTEGER NOT NULL DEFAULT 0,
+    errores INTEGER NOT NULL DEFAULT 0,
+    creado REAL NOT NULL,
+    actualizado REAL NOT NULL,
+    finalizado REAL
+);
+CREATE TABLE IF NOT EXISTS trabajo_imagenes (
+    trabajo_id TEXT NOT NULL,
+    indice INTEGER NOT NULL,
+    nombre TEXT,
+    datos BLOB,
+    estado TEXT NOT NULL,
+    resultado TEXT,
+    error TEXT,
+    reclamado_en REAL,
+    PRIMARY KEY (trabajo_id, indice)
+);
+CREATE INDEX IF NOT EXISTS idx_imagenes_estado ON trabajo_imagenes (estado, trabajo_id, indice);
+"""
+
+# Estados de trabajos e imágenes
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+COMPLETADO = "completado"
+ERROR = "error"
+
+
+class ColaTrabajos:
+    """Almacenamiento y reclamación de trabajos de análisis"""
+
+    def __init__(self, ruta_db, lease_s=600.0):
+        self.ruta_db = ruta_db
+        # Una imagen "procesando" durante más de lease_s se considera abandonada
+        self.lease_s = lease_s
+        self._local = threading.local()
+        directorio = os.path.dirname(os.path.abspath(ruta_db))
+        os.makedirs(directorio, exist_ok=True)
+        with self._conexion() as con:
+            con.executescript(ESQUEMA)
+            # Bases de datos anteriores a las clases de prioridad
+            columnas = {fila["name"] for fila in con.execute("PRAGMA table_info(trabajos)")}
+            if "prioridad" not in columnas:
+                con.execute("ALTER TABLE trabajos ADD COLUMN prioridad TEXT")
+
+    def _conexion(self):
+        """Conexión SQLite por hilo (sqlite3 no comparte conexiones entre hilos)"""
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+    def crear(self, modalidad, categoria, imagenes, prioridad=None):
+        """Registra un trabajo con sus imágenes [(nombre, bytes)] y devuelve su id"""
+        id_trabajo = uuid.uuid4().hex
+        ahora = time.time()
+        con = self._conexion()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute(
+                "INSERT INTO trabajos (id, estado, modalidad, categoria, prioridad, total, creado, actualizado) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (id_trabajo, PENDIENTE, modalidad, categoria, prioridad, len(imagenes), ahora, ahora)
+            )
+            con.executemany(
+                "INSERT INTO trabajo_imagenes (trabajo_id, indice, nombre, datos, estado) VALUES (?, ?, ?, ?, ?)",
+                [(id_trabajo, i, nombre, sqlite3.Binary(datos), PENDIENTE) for i, (nombre, datos) in enumerate(imagenes)]
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return id_trabajo
+
+    def reanudar(self):
+        """
+        Devuelve a la cola las imágenes 'procesando' con el lease vencido (p. ej. tras un
+        reinicio). Las reclamadas hace menos de lease_s pueden estar en manos de otro
+        proceso vivo (varios workers de gunicorn sobre la misma base de datos): no se tocan.
+        """
+        con = self._conexion()
+        cursor = con.execute(
+            "UPDATE trabajo_imagenes SET estado = ?, reclamado_en = NULL "
+            "WHERE estado = ? AND (reclamado_en IS NULL OR reclamado_en < ?)",
+            (PENDIENTE, PROCESANDO, time.time() - self.lease_s)
+        )
+        return cursor.rowcount
+
+    def reclamar(self):
+        """
+        Reclama atómicamente la siguiente imagen pendiente (FIFO por trabajo).
+        Devuelve un dict con el trabajo y la imagen, o None si la cola está vacía.
+        """
+        ahora = time.time()
+        con = self._conexion()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            fila = con.execute(
+                "SELECT i.trabajo_id, i.indice, i.nombre, i.datos, t.modalidad, t.categoria, t.prioridad "
+                "FROM trabajo_imagenes i JOIN trabajos t ON t.id = i.trabajo_id "
+                "WHERE i.estado = ? OR (i.estado = ? AND i.reclamado_en < ?) "
+                "ORDER BY t.creado, i.indice LIMIT 1",
+                (PENDIENTE, PROCESANDO, ahora - self.lease_s)
+            ).fetchone()
+            if fila is None:
+                con.execute("COMMIT")
+                return None
+            con.execute(
+                "UPDATE trabajo_imagenes SET estado = ?, reclamado_en = ? WHERE trabajo_id = ? AND indice = ?",
+                (PROCESANDO, ahora, fila["trabajo_id"], fila["indice"])
+            )
+            con.execute(
+                "UPDATE trabajos SET estado = ?, actualizado = ? WHERE id = ? AND estado = ?",
+                (PROCESANDO, ahora, fila["trabajo_id"], PENDIENTE)
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return dict(fila)
+
+    def completar(self, trabajo_id, indice, resultado=None, error=None):
+        """Guarda el resultado (o el error) de una imagen y cierra el trabajo si era la última"""
+        ahora = time.time()
+        con = self._conexion()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = con.execute(
+                "UPDATE trabajo_imagenes SET estado = ?, resultado = ?, error = ?, datos = NULL "
+                "WHERE trabajo_id = ? AND indice = ? AND estado = ?",
+                (ERROR if error else COMPLETADO,
+                 json.dumps(resultado, ensure_ascii=False) if resultado is not None else None,
+                 error, trabajo_id, indice, PROCESANDO)
+            )
+            if cursor.rowcount:
+                columna = "errores" if error else "completadas"
+                con.execute(
+                    f"UPDATE trabajos SET {columna} = {columna} + 1, actualizado = ? WHERE id = ?",
+                    (ahora, trabajo_id)
+                )
+                con.execute(
+                    "UPDATE trabajos SET estado = ?, finalizado = ? "
+                    "WHERE id = ? AND completadas + errores >= total",
+                    (COMPLETADO, ahora, trabajo_id)
+                )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+    def obtener(self, trabajo_id, incluir_resultados=True):
+        """Estado, progreso y (opcionalmente) resultados de un trabajo"""
+        con = self._conexion()
+        trabajo = con.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        if trabajo is None:
+            return None
+        trabajo = dict(trabajo)
+        procesadas = trabajo["completadas"] + trabajo["errores"]
+        trabajo["progreso"] = round(procesadas / trabajo["total"], 3) if trabajo["total"] else 1.0
+        if incluir_resultados:
+            filas = con.execute(
+                "SELECT indice, nombre, estado, resultado, error FROM trabajo_imagenes "
+                "WHERE trabajo_id = ? ORDER BY indice",
+                (trabajo_id,)
+            ).fetchall()
+            trabajo["resultados"] = [
+                {
+                    "indice": f["indice"],
+                    "nombre_archivo": f["nombre"],
+                    "estado": f["estado"],
+                    **({"exito": True, **json.loads(f["resultado"])} if f["resultado"] else {}),
+                    **({"exito": False, "error": f["error"]} if f["error"] else {}),
+                }
+                for f in filas
+            ]
+        return trabajo
+
+    def pendientes(self):
+        """Número de imágenes pendientes o en proceso"""
+        fila = self._conexion().execute(
+            "SELECT COUNT(*) FROM trabajo_imagenes WHERE estado IN (?, ?)", (PENDIENTE, PROCESANDO)
+        ).fetchone()
+        return fila[0]
@@ -0,0 +1,24 @@
+"""
+Construye los embeddings de texto de los catálogos diagnósticos y los guarda
+junto a servidor.py (embeddings/catalogo_<nombre>_<huella>.npy + .json).
+
+Uso:
+    python construir_embeddings.py
+    python construir_embeddings.py --onnx    # además exporta la torre de visión a ONNX (fp32 e INT8)
+
+El servidor mapea estos ficheros en memoria al arrancar en lugar de
+ejecutar el codificador de texto de BiomedCLIP.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from servidor import construir_embeddings_catalogos, DIRECTORIO_EMBEDDINGS, exportar_motores_onnx
+
+if __name__ == "__main__":
+    print(f"📦 Construyendo embeddings de catálogos en {DIRECTORIO_EMBEDDINGS}")
+    construir_embeddings_catalogos()
+    if "--onnx" in sys.argv[1:]:
+        exportar_motores_onnx()
@@ -0,0 +1,71 @@
+"""
+Corpus de imágenes de prueba del repositorio (imagenes_prueba/).
+
+- Carpetas de datación de contusiones: inmediata, reciente, 1_3_dias, 3_7_dias,
+  1_2_semanas, antigua, postmortem (la carpeta es la etiqueta).
+- Imágenes sueltas en la raíz: radiografías de tórax (nombre con "rx", "torax" o
+  "radiografia") y otras imágenes forenses de ejemplo.
+
+Sin dependencias: lo usan tanto el benchmark en proceso como los clientes HTTP.
+"""
+
+import os
+
+DIRECTORIO_PRUEBA = os.environ.get(
+    "IMAGENES_PRUEBA",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "imagenes_prueba")
+)
+
+CARPETAS_CONTUSION = ("inmediata", "reciente", "1_3_dias", "3_7_dias", "1_2_semanas", "antigua", "postmortem")
+
+# Mismos formatos que aceptan los endpoints de análisis
+TIPOS_MIME = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+}
+
+
+def es_radiografia(nombre):
+    nombre = nombre.lower()
+    return "rx" in nombre or "torax" in nombre or "radiografia" in nombre
+
+
+def tipo_mime(ruta):
+    return TIPOS_MIME.get(os.path.splitext(ruta)[1].lower())
+
+
+def cargar_corpus(directorio=None):
+    """
+    Recorre el corpus y devuelve:
+      contusiones: [(carpeta, ruta)] etiquetadas por carpeta
+      histologia:  [ruta] (contusiones + imágenes forenses sueltas)
+      radiografia: [ruta]
+    """
+    directorio = directorio or DIRECTORIO_PRUEBA
+    if not os.path.isdir(directorio):
+        raise FileNotFoundError(f"No existe el corpus de prueba: {directorio}")
+
+    contusiones = []
+    for carpeta in CARPETAS_CONTUSION:
+        ruta_carpeta = os.path.join(directorio, carpeta)
+        if not os.path.isdir(ruta_carpeta):
+            continue
+        for nombre in sorted(os.listdir(ruta_carpeta)):
+            if tipo_mime(nombre):
+                contusiones.append((carpeta, os.path.join(ruta_carpeta, nombre)))
+
+    sueltas = [
+        os.path.join(directorio, nombre) for nombre in sorted(os.listdir(directorio))
+        if tipo_mime(nombre) and os.path.isfile(os.path.join(directorio, nombre))
+    ]
+    radiografia = [r for r in sueltas if es_radiografia(os.path.basename(r))]
+    histologia = [r for _, r in contusiones] + [r for r in sueltas if r not in radiografia]
+    return {"contusiones": contusiones, "histologia": histologia, "radiografia": radiografia}
+
+
+def leer(ruta):
+    with open(ruta, "rb") as f:
+        return f.read()
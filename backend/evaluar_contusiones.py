@@ -0,0 +1,273 @@
+"""
+Evaluación de precisión y rendimiento del catálogo de datación de contusiones.
+
+Las carpetas de imagenes_prueba/ son la verdad de referencia de la categoría
+'contusiones' de CATEGORIAS_FORENSES. El corpus se codifica UNA vez (pool de
+procesos, con caché en disco) y cada variante de plantilla/catálogo se puntúa
+contra esos embeddings con un producto matricial, así que comparar decenas de
+variantes de prompts cuesta segundos.
+
+Informa top-1/top-3, matriz de confusión y tiempos de cada fase.
+
+Uso:
+    python evaluar_contusiones.py
+    python evaluar_contusiones.py --plantillas "a photograph of |a clinical photograph of skin with "
+    python evaluar_contusiones.py --variantes variantes.json --ambito ambos --salida evaluacion.json
+
+variantes.json: [{"nombre": "...", "plantilla": "...", "textos": {"contusion_reciente": "...", ...}}]
+(los diagnósticos no indicados conservan el texto del catálogo).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus_prueba import cargar_corpus, leer
+
+# Carpeta del corpus → diagnóstico del catálogo
+ETIQUETAS_CARPETA = {
+    "inmediata": "contusion_inmediata",
+    "reciente": "contusion_reciente",
+    "1_3_dias": "contusion_1_3_dias",
+    "3_7_dias": "contusion_3_7_dias",
+    "1_2_semanas": "contusion_1_2_semanas",
+    "antigua": "contusion_antigua",
+    "postmortem": "lesion_postmortem",
+}
+
+# Plantillas que se prueban siempre, además de la del servidor
+PLANTILLAS_BASE = [
+    "a photograph of ",
+    "forensic photograph of skin showing ",
+    "",
+]
+
+# Predicción fuera de la categoría 'contusiones' (ámbito completo)
+OTRO = "otro"
+
+
+# =============================================================================
+# CODIFICACIÓN DEL CORPUS (POOL DE PROCESOS)
+# =============================================================================
+
+def _iniciar_trabajador(hilos):
+    import torch
+    import servidor
+
+    torch.set_num_threads(hilos)
+    if not servidor.cargar_modelo("biomedclip"):
+        raise RuntimeError("No se pudo cargar BiomedCLIP en el trabajador")
+
+
+def _codificar_rutas(rutas):
+    """En el trabajador: decodifica como el servidor y codifica las rutas en un solo lote"""
+    import servidor
+
+    procesador = servidor.modelos_cargados["biomedclip"]["procesador"]
+    tensores = [procesador(servidor.decodificar_imagen(leer(r))[0]) for r in rutas]
+    return servidor._codificar_lote_imagenes(tensores)
+
+
+def huella_corpus(rutas, motor):
+    """Clave de la caché: modelo, decodificación, motor de visión efectivo y bytes del corpus"""
+    import servidor
+
+    h = hashlib.sha256(servidor.MODELO_BIOMEDCLIP_HUB.encode("utf-8"))
+    h.update(str(servidor.DECODIFICACION_REDUCIDA).encode("utf-8"))
+    h.update(motor.encode("utf-8"))
+    for ruta in rutas:
+        h.update(b"\0" + hashlib.sha256(leer(ruta)).digest())
+    return h.hexdigest()[:16]
+
+
+def codificar_corpus(rutas, procesos, tamano_lote):
+    """Embeddings normalizados del corpus (N x D), cacheados en DIRECTORIO_EMBEDDINGS"""
+    import numpy as np
+    import servidor
+
+    # El motor efectivo (tras la paridad, un motor rechazado vuelve a torch) forma parte de la
+    # clave: los embeddings de onnx-int8 no son los de torch
+    if not servidor.cargar_modelo("biomedclip"):
+        raise SystemExit("❌ No se pudo cargar BiomedCLIP")
+    motor = servidor.modelos_cargados["biomedclip"]["motor"].nombre
+    ruta_cache = os.path.join(servidor.DIRECTORIO_EMBEDDINGS,
+                              f"evaluacion_contusiones_{huella_corpus(rutas, motor)}.npy")
+    if os.path.exists(ruta_cache):
+        print(f"📂 Embeddings del corpus en caché: {ruta_cache}")
+        return np.load(ruta_cache)
+
+    bloques = [rutas[i:i + tamano_lote] for i in range(0, len(rutas), tamano_lote)]
+    procesos = max(1, min(procesos, len(bloques)))
+    hilos = max(1, (os.cpu_count() or 1) // procesos)
+    print(f"🧮 Codificando {len(rutas)} imágenes (motor {motor}) con {procesos} procesos x {hilos} hilos...")
+    # spawn: cada trabajador carga su propio modelo sin heredar el estado de hilos de torch
+    contexto = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(procesos, mp_context=contexto, initializer=_iniciar_trabajador,
+                             initargs=(hilos,)) as pool:
+        matriz = np.concatenate(list(pool.map(_codificar_rutas, bloques))).astype(np.float32)
+
+    os.makedirs(servidor.DIRECTORIO_EMBEDDINGS, exist_ok=True)
+    np.save(ruta_cache, matriz)
+    return matriz
+
+
+# =============================================================================
+# VARIANTES Y PUNTUACIÓN
+# =============================================================================
+
+def construir_variantes(plantillas_extra, fichero_variantes):
+    """Lista de variantes {nombre, plantilla, textos: {id: texto}} sobre el catálogo de contusiones"""
+    import servidor
+
+    base = {d["id"]: d["texto"] for d in servidor.CATEGORIAS_FORENSES["contusiones"]["diagnosticos"]}
+    plantillas = [servidor.PLANTILLA_HISTOLOGIA] + [p for p in PLANTILLAS_BASE + plantillas_extra
+                                                    if p != servidor.PLANTILLA_HISTOLOGIA]
+    variantes = [
+        {"nombre": "servidor" if p == servidor.PLANTILLA_HISTOLOGIA else f"plantilla: {p!r}",
+         "plantilla": p, "textos": dict(base)}
+        for p in dict.fromkeys(plantillas)
+    ]
+    if fichero_variantes:
+        with open(fichero_variantes, encoding="utf-8") as f:
+            for v in json.load(f):
+                variantes.append({
+                    "nombre": v["nombre"],
+                    "plantilla": v.get("plantilla", servidor.PLANTILLA_HISTOLOGIA),
+                    "textos": {**base, **v.get("textos", {})},
+                })
+    return variantes
+
+
+def codificar_variantes(variantes, ambitos):
+    """
+    Embeddings de texto de todas las variantes en una sola llamada al codificador.
+    En ámbito 'completo' se añaden (con la misma plantilla) el resto de diagnósticos forenses.
+    """
+    import servidor
+
+    if not servidor.cargar_modelo("biomedclip"):
+        raise SystemExit("❌ No se pudo cargar BiomedCLIP")
+    m = servidor.modelos_cargados["biomedclip"]
+    otros = [d for organo, datos in servidor.CATEGORIAS_FORENSES.items() if organo != "contusiones"
+             for d in datos["diagnosticos"]]
+
+    textos, tablas = [], []
+    for v in variantes:
+        for ambito in ambitos:
+            ids = list(ETIQUETAS_CARPETA.values())
+            prompts = [v["plantilla"] + v["textos"][i] for i in ids]
+            if ambito == "completo":
+                ids += [d["id"] for d in otros]
+                prompts += [v["plantilla"] + d["texto"] for d in otros]
+            tablas.append((v, ambito, ids, len(textos), len(textos) + len(prompts)))
+            textos.extend(prompts)
+
+    unicos = list(dict.fromkeys(textos))
+    matriz = servidor._calcular_embeddings_texto(unicos, m)
+    fila = {t: i for i, t in enumerate(unicos)}
+    return [
+        (v, ambito, ids, matriz[[fila[t] for t in textos[desde:hasta]]])
+        for v, ambito, ids, desde, hasta in tablas
+    ], m["escala_logit"]
+
+
+def evaluar(embeddings, etiquetas, ids, matriz_texto, escala_logit):
+    """top-1, top-3 y matriz de confusión (filas: verdad; columnas: predicción)"""
+    import numpy as np
+
+    logits = escala_logit * embeddings @ matriz_texto.T
+    orden = np.argsort(-logits, axis=1)
+    clases = list(ETIQUETAS_CARPETA.values())
+    columnas = clases + ([OTRO] if len(ids) > len(clases) else [])
+    confusion = [[0] * len(columnas) for _ in clases]
+    top1 = top3 = 0
+    for fila, verdad in zip(orden, etiquetas):
+        predichos = [ids[i] for i in fila[:3]]
+        top1 += predichos[0] == verdad
+        top3 += verdad in predichos
+        prediccion = predichos[0] if predichos[0] in clases else OTRO
+        confusion[clases.index(verdad)][columnas.index(prediccion)] += 1
+    n = len(etiquetas)
+    return {
+        "top1": round(top1 / n, 4),
+        "top3": round(top3 / n, 4),
+        "columnas": columnas,
+        "matriz_confusion": confusion,
+    }
+
+
+def imprimir_confusion(resultado):
+    cortas = [c.replace("contusion_", "").replace("lesion_", "") for c in resultado["columnas"]]
+    print("      verdad \\ pred  " + " ".join(f"{c[:11]:>11}" for c in cortas))
+    for nombre, fila in zip(cortas, resultado["matriz_confusion"]):
+        print(f"   {nombre[:15]:>15}  " + " ".join(f"{v:>11}" for v in fila))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evalúa el catálogo de datación de contusiones sobre imagenes_prueba/")
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--procesos", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument("--lote", type=int, default=8, help="Imágenes por tarea del pool")
+    parser.add_argument("--plantillas", type=lambda t: t.split("|"), default=[],
+                        help="Plantillas adicionales separadas por '|'")
+    parser.add_argument("--variantes", default=None, help="JSON con variantes de textos del catálogo")
+    parser.add_argument("--ambito", choices=["contusiones", "completo", "ambos"], default="contusiones",
+                        help="Puntuar solo contra la categoría o contra todo el catálogo forense")
+    parser.add_argument("--salida", default=None)
+    args = parser.parse_args()
+
+    corpus = cargar_corpus(args.corpus)
+    if not corpus["contusiones"]:
+        raise SystemExit("❌ El corpus no tiene carpetas de contusiones")
+    etiquetas = [ETIQUETAS_CARPETA[carpeta] for carpeta, _ in corpus["contusiones"]]
+    rutas = [ruta for _, ruta in corpus["contusiones"]]
+    ambitos = ["contusiones", "completo"] if args.ambito == "ambos" else [args.ambito]
+
+    inicio = time.perf_counter()
+    embeddings = codificar_corpus(rutas, args.procesos, args.lote)
+    t_imagenes = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    variantes = construir_variantes(args.plantillas, args.variantes)
+    tablas, escala_logit = codificar_variantes(variantes, ambitos)
+    t_textos = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    resultados = []
+    for v, ambito, ids, matriz_texto in tablas:
+        r = evaluar(embeddings, etiquetas, ids, matriz_texto, escala_logit)
+        resultados.append({"variante": v["nombre"], "plantilla": v["plantilla"], "ambito": ambito, **r})
+    t_puntuacion = time.perf_counter() - inicio
+
+    resultados.sort(key=lambda r: (r["top1"], r["top3"]), reverse=True)
+    print(f"\n📊 {len(rutas)} imágenes, {len(resultados)} combinaciones variante/ámbito")
+    for r in resultados:
+        print(f"   top1={r['top1']:.2%} top3={r['top3']:.2%}  [{r['ambito']}] {r['variante']}")
+    print(f"\n🏆 Mejor: {resultados[0]['variante']} [{resultados[0]['ambito']}]")
+    imprimir_confusion(resultados[0])
+    tiempos = {
+        "codificacion_imagenes_s": round(t_imagenes, 2),
+        "codificacion_textos_s": round(t_textos, 2),
+        "puntuacion_s": round(t_puntuacion, 4),
+    }
+    print(f"\n⏱️ Imágenes {tiempos['codificacion_imagenes_s']}s · textos {tiempos['codificacion_textos_s']}s · "
+          f"puntuación de todas las variantes {tiempos['puntuacion_s']}s")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            import servidor
+            motor = servidor.modelos_cargados["biomedclip"]["motor"].nombre
+            json.dump({"imagenes": len(rutas), "motor_vision": motor, "tiempos": tiempos, "resultados": resultados},
+                      f, ensure_ascii=False, indent=2)
+        print(f"💾 Evaluación guardada en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Arranque con varios workers que comparten los pesos de BiomedCLIP.
+
+    gunicorn -c gunicorn.conf.py servidor:app
+
+Con preload_app el proceso maestro importa servidor.py y, en when_ready (antes
+del primer fork), carga los pesos y los embeddings de los catálogos una sola vez.
+Los workers heredan esas páginas copy-on-write: el RSS de cada worker adicional
+es una fracción del primero. Cada worker crea después sus propios pools de
+hilos y su motor de visión (servidor.preparar_worker).
+
+Nota: 'uvicorn --workers N' lanza procesos nuevos (spawn) que cargan cada uno
+su copia del modelo; para compartir pesos hay que usar este fichero.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from topologia_cpu import cpus_disponibles
+
+# Antes de importar servidor: el reparto de hilos por worker se calcula al importarlo
+os.environ.setdefault("WEB_CONCURRENCY", str(max(1, min(4, cpus_disponibles() // 2))))
+# Un worker que desalojara el modelo heredado y lo recargara tendría una copia privada
+os.environ.setdefault("MODELO_INACTIVIDAD_S", "0")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '7860')}"
+workers = int(os.environ["WEB_CONCURRENCY"])
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Carga de motor/calentamiento por worker (y ONNX/compilación si se configuran)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+
+
+def when_ready(server):
+    """En el maestro, tras importar la app y antes de lanzar los workers"""
+    import servidor
+
+    servidor.precargar_en_maestro()
@@ -0,0 +1,181 @@
+"""
+Métricas Prometheus del servidor (expuestas en /metrics).
+
+- Histogramas que se observan en el camino de cada petición: etapas del análisis,
+  espera en la cola de admisión, duración y tamaño de los lotes de encode_image,
+  y duración de las cargas de modelo. Observar un histograma es una suma y un
+  incremento bajo lock, por lo que pueden quedarse activos en producción.
+- Valores de estado (profundidad de colas, caché, RSS, modelos cargados) que no se
+  actualizan en cada petición: se leen solo cuando Prometheus hace scrape, a través
+  de las funciones registradas con registrar_colector().
+
+Si prometheus_client no está instalado, las métricas son no-ops y /metrics responde 503.
+"""
+
+import time
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+    DISPONIBLE = True
+except ImportError:
+    DISPONIBLE = False
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _MetricaNula:
+    """Sustituto sin coste cuando prometheus_client no está disponible"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, valor):
+        pass
+
+    def inc(self, cantidad=1):
+        pass
+
+
+def _histograma(nombre, ayuda, etiquetas=(), buckets=None):
+    if not DISPONIBLE:
+        return _MetricaNula()
+    if buckets is None:
+        return Histogram(nombre, ayuda, etiquetas)
+    return Histogram(nombre, ayuda, etiquetas, buckets=buckets)
+
+
+def _contador(nombre, ayuda, etiquetas=()):
+    if not DISPONIBLE:
+        return _MetricaNula()
+    return Counter(nombre, ayuda, etiquetas)
+
+
+# Etapas de un análisis: de 1 ms (puntuación, caché) a decenas de segundos (lectura de subidas grandes)
+_BUCKETS_ETAPA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_BUCKETS_CARGA = (1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+_BUCKETS_LOTE = (1, 2, 4, 8, 16, 32, 64, 128)
+
+ETAPAS = _histograma(
+    "patologia_etapa_segundos",
+    "Duración de cada etapa del análisis de una imagen (lectura, decodificación, preprocesado, inferencia, puntuación, formato)",
+    ("modalidad", "etapa"), _BUCKETS_ETAPA
+)
+ESPERA_COLA = _histograma(
+    "patologia_espera_cola_segundos",
+    "Tiempo en la cola de admisión antes de obtener un hilo de inferencia",
+    ("prioridad",), _BUCKETS_ETAPA
+)
+EJECUCION = _histograma(
+    "patologia_ejecucion_segundos",
+    "Duración de un análisis en el pool de inferencia (tras la admisión)",
+    ("prioridad",), _BUCKETS_ETAPA
+)
+TAMANO_LOTE = _histograma(
+    "patologia_tamano_lote",
+    "Imágenes por llamada a encode_image del planificador de micro-lotes",
+    buckets=_BUCKETS_LOTE
+)
+DURACION_LOTE = _histograma(
+    "patologia_lote_segundos",
+    "Duración de una llamada a encode_image sobre un lote",
+    buckets=_BUCKETS_ETAPA
+)
+CARGA_MODELO = _histograma(
+    "patologia_carga_modelo_segundos",
+    "Duración de la carga de un modelo (pesos, embeddings de catálogos y calentamiento)",
+    ("modelo", "resultado"), _BUCKETS_CARGA
+)
+CARGAS = _contador(
+    "patologia_cargas_modelo",
+    "Cargas de modelo completadas, por resultado",
+    ("modelo", "resultado")
+)
+LIBERACIONES = _contador(
+    "patologia_liberaciones_modelo",
+    "Modelos liberados de memoria, por motivo (manual, inactividad, memoria, sugerido)",
+    ("modelo", "motivo")
+)
+
+
+def registrar_tiempos(modalidad, tiempos):
+    """Observa los milisegundos por etapa que devuelve un análisis (tiempos_etapas_ms)"""
+    for etapa, ms in tiempos.items():
+        ETAPAS.labels(modalidad, etapa).observe(ms / 1000.0)
+
+
+def registrar_carga(modelo, duracion, exito):
+    resultado = "ok" if exito else "error"
+    CARGA_MODELO.labels(modelo, resultado).observe(duracion)
+    CARGAS.labels(modelo, resultado).inc()
+
+
+class Cronometro:
+    """Observa en un histograma la duración del bloque: with Cronometro(EJECUCION.labels(p)): ..."""
+
+    __slots__ = ("_metrica", "_inicio")
+
+    def __init__(self, metrica):
+        self._metrica = metrica
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrica.observe(time.perf_counter() - self._inicio)
+        return False
+
+
+# =============================================================================
+# VALORES LEÍDOS EN EL SCRAPE
+# =============================================================================
+
+def medidor(nombre, ayuda, valores, etiquetas=()):
+    """
+    Familia gauge para un colector. 'valores' es un número (sin etiquetas) o un
+    dict {tupla de valores de etiqueta: número}.
+    """
+    familia = GaugeMetricFamily(nombre, ayuda, labels=list(etiquetas) or None)
+    _rellenar(familia, valores, etiquetas)
+    return familia
+
+
+def contador(nombre, ayuda, valores, etiquetas=()):
+    """Familia counter para un colector (valores acumulados que mantiene el propio componente)"""
+    familia = CounterMetricFamily(nombre, ayuda, labels=list(etiquetas) or None)
+    _rellenar(familia, valores, etiquetas)
+    return familia
+
+
+def _rellenar(familia, valores, etiquetas):
+    if not etiquetas:
+        if valores is not None:
+            familia.add_metric([], valores)
+        return
+    for clave, valor in valores.items():
+        if valor is not None:
+            familia.add_metric(list(clave if isinstance(clave, tuple) else (clave,)), valor)
+
+
+class _Colector:
+    def __init__(self, funcion):
+        self.funcion = funcion
+
+    def collect(self):
+        try:
+            yield from self.funcion()
+        except Exception as e:
+            print(f"⚠️ Error leyendo métricas de estado: {e}")
+
+
+def registrar_colector(funcion):
+    """Registra una función que genera familias (medidor/contador) en cada scrape"""
+    if DISPONIBLE:
+        REGISTRY.register(_Colector(funcion))
+
+
+def exportar():
+    """Devuelve (cuerpo, content-type) en formato de exposición de Prometheus"""
+    if not DISPONIBLE:
+        return None, CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
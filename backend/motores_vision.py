@@ -0,0 +1,243 @@
+"""
+Motores de inferencia de la torre de visión (ViT-B/16) de BiomedCLIP.
+
+- MotorTorch: encode_image de PyTorch en fp32 (referencia).
+- MotorTorchCompilado: ruta rápida de PyTorch sin dependencias extra (inference_mode,
+  channels-last, bf16 autocast opcional y la torre compilada por tamaño de lote).
+- MotorOnnx: la torre exportada a ONNX y ejecutada con ONNX Runtime, en fp32 o
+  cuantizada dinámicamente a INT8 (pesos de las capas MatMul/Gemm).
+
+Todos exponen codificar(tensores) → matriz numpy (N x D) de embeddings normalizados,
+que es lo que consume el planificador de micro-lotes.
+"""
+
+import contextlib
+import os
+import time
+
+
+def _rss_mb():
+    """RSS del proceso en MB (None fuera de Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+class MotorTorch:
+    """encode_image de PyTorch (fp32, modo eager)"""
+
+    nombre = "torch"
+
+    def __init__(self, modelo):
+        self.modelo = modelo
+
+    def codificar(self, tensores):
+        import torch
+
+        with torch.no_grad():
+            image_features = self.modelo.encode_image(torch.stack(list(tensores)))
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        return image_features.cpu().numpy()
+
+
+def _torre_vision(visual):
+    """Módulo visual + normalización L2 (lo que se compila o exporta)"""
+    import torch
+
+    class TorreVision(torch.nn.Module):
+        def __init__(self, visual):
+            super().__init__()
+            self.visual = visual
+
+        def forward(self, imagenes):
+            caracteristicas = self.visual(imagenes)
+            return caracteristicas / caracteristicas.norm(dim=-1, keepdim=True)
+
+    return TorreVision(visual).eval()
+
+
+def cpu_soporta_bf16():
+    """True si la CPU tiene instrucciones bf16 nativas (AVX512-BF16 o AMX)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            banderas = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in banderas or "amx_bf16" in banderas
+
+
+class MotorTorchCompilado:
+    """
+    Torre de visión compilada una vez por tamaño de lote (TorchScript trace o
+    torch.compile), en channels-last y con bf16 autocast opcional. Un lote se
+    rellena hasta el tamaño compilado inmediatamente superior, así que ninguna
+    petición dispara una compilación. Los módulos trazados comparten los pesos
+    del modelo original (sin freeze), de modo que no se duplica la memoria.
+    """
+
+    def __init__(self, modelo, tamanos, modo="trace", bf16=False, tamano_entrada=224):
+        if modo not in ("trace", "compile"):
+            raise ValueError(f"Modo de compilación desconocido: {modo}")
+        self.nombre = f"torch-{modo}" + ("-bf16" if bf16 else "")
+        self.tamanos = sorted({int(n) for n in tamanos if int(n) > 0})
+        self.modo = modo
+        self.bf16 = bf16
+        self.tamano_entrada = tamano_entrada
+        self._torre = _torre_vision(modelo.visual)
+        self._compilados = {}
+
+    def _autocast(self):
+        import torch
+
+        if self.bf16:
+            # Sin caché de casts: con jit.trace, los pesos convertidos a bf16 quedarían
+            # congelados en la traza como constantes (una copia por tamaño de lote)
+            return torch.autocast("cpu", dtype=torch.bfloat16, cache_enabled=False)
+        return contextlib.nullcontext()
+
+    def _ejemplo(self, n):
+        import torch
+
+        return torch.randn(n, 3, self.tamano_entrada, self.tamano_entrada).contiguous(memory_format=torch.channels_last)
+
+    def compilar(self):
+        """Compila y ejecuta cada tamaño de lote (durante la carga, antes de declarar listo)"""
+        import torch
+
+        self._torre = self._torre.to(memory_format=torch.channels_last)
+        compilado = torch.compile(self._torre, dynamic=False) if self.modo == "compile" else None
+        for n in self.tamanos:
+            inicio = time.time()
+            rss_previo = _rss_mb()
+            if self.modo == "trace":
+                with torch.no_grad(), self._autocast():
+                    modulo = torch.jit.trace(self._torre, self._ejemplo(n), check_trace=False)
+            else:
+                modulo = compilado
+            self._compilados[n] = modulo
+            # La primera ejecución fija la especialización (y en torch.compile, compila)
+            self._ejecutar(n, self._ejemplo(n))
+            rss = _rss_mb()
+            crecimiento = f", RSS {rss - rss_previo:+.0f} MB" if rss is not None and rss_previo is not None else ""
+            print(f"🧩 Torre de visión compilada ({self.nombre}) para lote {n}: {time.time() - inicio:.1f}s{crecimiento}")
+        return self
+
+    def _ejecutar(self, tamano, lote):
+        import torch
+
+        with torch.inference_mode():
+            if self.modo == "trace":
+                # Los casts a bf16 quedaron registrados en la traza
+                return self._compilados[tamano](lote)
+            with self._autocast():
+                return self._compilados[tamano](lote)
+
+    def codificar(self, tensores):
+        import numpy as np
+        import torch
+
+        tensores = list(tensores)
+        maximo = self.tamanos[-1]
+        if len(tensores) > maximo:
+            return np.concatenate([self.codificar(tensores[i:i + maximo]) for i in range(0, len(tensores), maximo)])
+
+        n = len(tensores)
+        tamano = next(t for t in self.tamanos if t >= n)
+        lote = torch.stack(tensores)
+        if tamano > n:
+            lote = torch.cat([lote, lote.new_zeros((tamano - n,) + tuple(lote.shape[1:]))])
+        salida = self._ejecutar(tamano, lote.contiguous(memory_format=torch.channels_last))
+        return salida[:n].float().cpu().numpy()
+
+
+class MotorOnnx:
+    """Torre de visión exportada a ONNX, ejecutada con ONNX Runtime en CPU"""
+
+    def __init__(self, ruta, nombre="onnx", hilos=None):
+        import onnxruntime as ort
+
+        opciones = ort.SessionOptions()
+        opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if hilos:
+            opciones.intra_op_num_threads = hilos
+        self.nombre = nombre
+        self.ruta = ruta
+        self.sesion = ort.InferenceSession(ruta, opciones, providers=["CPUExecutionProvider"])
+        self._entrada = self.sesion.get_inputs()[0].name
+
+    def codificar(self, tensores):
+        import numpy as np
+
+        lote = np.stack([np.asarray(t, dtype=np.float32) for t in tensores])
+        # La normalización L2 va dentro del grafo exportado
+        return self.sesion.run(None, {self._entrada: lote})[0]
+
+
+def exportar_onnx(modelo, ruta, tamano_entrada=224, opset=17):
+    """Exporta modelo.visual (+ normalización L2) a ONNX con el eje de lote dinámico"""
+    import torch
+
+    inicio = time.time()
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            _torre_vision(modelo.visual),
+            torch.randn(1, 3, tamano_entrada, tamano_entrada),
+            temporal,
+            input_names=["imagenes"],
+            output_names=["embeddings"],
+            dynamic_axes={"imagenes": {0: "lote"}, "embeddings": {0: "lote"}},
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    os.replace(temporal, ruta)
+    print(f"📦 Torre de visión exportada a ONNX en {time.time() - inicio:.1f}s: {ruta}")
+
+
+def cuantizar_int8(ruta_fp32, ruta_int8):
+    """Cuantización dinámica INT8 de los pesos (las activaciones se cuantizan en ejecución)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    inicio = time.time()
+    temporal = f"{ruta_int8}.{os.getpid()}.tmp"
+    quantize_dynamic(ruta_fp32, temporal, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+    os.replace(temporal, ruta_int8)
+    print(f"📦 Modelo ONNX cuantizado a INT8 en {time.time() - inicio:.1f}s: {ruta_int8}")
+
+
+def comprobar_paridad(referencia, candidato, tensores, matrices_texto, escala_logit, tamano_lote=8):
+    """
+    Compara dos motores sobre los mismos tensores. Para cada catálogo (matriz de
+    embeddings de texto) mide la diferencia máxima de logits y el acuerdo top-1.
+    """
+    import numpy as np
+
+    emb_ref, emb_cand = [], []
+    tiempos = {referencia.nombre: 0.0, candidato.nombre: 0.0}
+    for i in range(0, len(tensores), tamano_lote):
+        lote = tensores[i:i + tamano_lote]
+        for motor, salida in ((referencia, emb_ref), (candidato, emb_cand)):
+            inicio = time.perf_counter()
+            salida.append(motor.codificar(lote))
+            tiempos[motor.nombre] += time.perf_counter() - inicio
+    emb_ref = np.concatenate(emb_ref)
+    emb_cand = np.concatenate(emb_cand)
+
+    delta_max, acuerdos = 0.0, 0
+    for matriz in matrices_texto:
+        logits_ref = escala_logit * emb_ref @ matriz.T
+        logits_cand = escala_logit * emb_cand @ matriz.T
+        delta_max = max(delta_max, float(np.abs(logits_ref - logits_cand).max()))
+        acuerdos += int((logits_ref.argmax(axis=1) == logits_cand.argmax(axis=1)).sum())
+    return {
+        "imagenes": len(tensores),
+        "delta_logit_max": round(delta_max, 4),
+        "acuerdo_top1": round(acuerdos / (len(tensores) * len(matrices_texto)), 4),
+        "ms_por_imagen": {n: round(t * 1000 / len(tensores), 2) for n, t in tiempos.items()},
+    }
@@ -0,0 +1,330 @@
+"""
+Planificación de la inferencia de imágenes.
+
+- PlanificadorLotes: las peticiones concurrentes entregan su tensor preprocesado y
+  esperan su resultado; un hilo en segundo plano agrupa los tensores que llegan dentro
+  de una ventana de tiempo (o hasta el tamaño máximo de lote) y ejecuta una única
+  llamada a la función de lote (p. ej. ``encode_image``) para todos ellos.
+- ControlAdmision: cola acotada delante del modelo; cuando está llena, las peticiones
+  se rechazan de inmediato con un Retry-After estimado a partir de la tasa de servicio.
+"""
+
+import asyncio
+import itertools
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class PlanificadorLotes:
+    """Agrupa peticiones concurrentes en lotes y reparte los resultados"""
+
+    def __init__(self, funcion_lote, ventana_ms=15.0, tamano_max=16, nombre="planificador"):
+        # funcion_lote recibe una lista de tensores y devuelve una secuencia
+        # de resultados en el mismo orden
+        self.funcion_lote = funcion_lote
+        self.ventana = ventana_ms / 1000.0
+        self.tamano_max = max(1, int(tamano_max))
+        self.nombre = nombre
+        # Cola ordenada por (prioridad, llegada): las clases urgentes entran antes en el lote
+        self._cola = queue.PriorityQueue()
+        self._secuencia = itertools.count()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self.estadisticas = {
+            "lotes": 0,
+            "imagenes": 0,
+            "errores": 0,
+            "tamanos_lote": {},
+        }
+
+    def iniciar(self):
+        """Arranca el hilo del planificador (idempotente)"""
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name=self.nombre, daemon=True)
+                self._hilo.start()
+
+    def detener(self):
+        """Detiene el hilo tras procesar lo que ya está en cola"""
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive():
+                self._cola.put(self._parada())
+                self._hilo.join(timeout=5)
+            self._hilo = None
+
+    def _parada(self):
+        return (math.inf, next(self._secuencia), None, None)
+
+    def enviar(self, tensor, prioridad=0):
+        """Encola un tensor (menor prioridad = más urgente) y devuelve un Future con su resultado"""
+        self.iniciar()
+        futuro = Future()
+        self._cola.put((prioridad, next(self._secuencia), tensor, futuro))
+        return futuro
+
+    def ejecutar(self, tensor, prioridad=0, timeout=None):
+        """Encola un tensor y espera su resultado"""
+        return self.enviar(tensor, prioridad).result(timeout=timeout)
+
+    def _recoger_lote(self, primero):
+        lote = [primero]
+        limite = time.monotonic() + self.ventana
+        while len(lote) < self.tamano_max:
+            restante = limite - time.monotonic()
+            try:
+                if restante > 0:
+                    elemento = self._cola.get(timeout=restante)
+                else:
+                    elemento = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            if elemento[2] is None:
+                # Señal de parada: se reencola para salir tras este lote
+                self._cola.put(elemento)
+                break
+            lote.append(elemento)
+        return lote
+
+    def _bucle(self):
+        while True:
+            primero = self._cola.get()
+            if primero[2] is None:
+                return
+            lote = self._recoger_lote(primero)
+            futuros = [elemento[3] for elemento in lote]
+            try:
+                resultados = self.funcion_lote([elemento[2] for elemento in lote])
+                if len(resultados) != len(futuros):
+                    # zip dejaría futuros sin resolver y sus llamadores bloqueados para siempre
+                    raise ValueError(f"{self.nombre}: la función de lote devolvió {len(resultados)} "
+                                     f"resultados para {len(futuros)} entradas")
+                for futuro, resultado in zip(futuros, resultados):
+                    futuro.set_result(resultado)
+            except Exception as e:
+                self.estadisticas["errores"] += 1
+                for futuro in futuros:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+
+            tamanos = self.estadisticas["tamanos_lote"]
+            tamanos[len(lote)] = tamanos.get(len(lote), 0) + 1
+            self.estadisticas["lotes"] += 1
+            self.estadisticas["imagenes"] += len(lote)
+
+    def resumen(self):
+        """Estadísticas para /estado"""
+        lotes = self.estadisticas["lotes"]
+        return {
+            "ventana_ms": round(self.ventana * 1000, 1),
+            "tamano_max": self.tamano_max,
+            "en_cola": self._cola.qsize(),
+            "lotes": lotes,
+            "imagenes": self.estadisticas["imagenes"],
+            "errores": self.estadisticas["errores"],
+            "tamano_medio_lote": round(self.estadisticas["imagenes"] / lotes, 2) if lotes else 0,
+            "tamanos_lote": dict(sorted(self.estadisticas["tamanos_lote"].items())),
+        }
+
+
+class ColaLlena(Exception):
+    """La cola de inferencia está llena (o la espera superó el máximo)"""
+
+    def __init__(self, mensaje, retry_after):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+# Clases de prioridad, de mayor a menor urgencia
+PRIORIDADES = ("interactiva", "estandar", "masiva")
+
+
+class ControlAdmision:
+    """
+    Limita los análisis en ejecución a 'concurrencia' y los que esperan a 'capacidad_cola'.
+    Cada petición pertenece a una clase de prioridad con su propia cola; los huecos libres
+    se reparten por round-robin ponderado (suave) entre las clases con peticiones en espera
+    y por debajo de su límite de concurrencia.
+    Se usa desde el bucle de eventos (no es thread-safe).
+    """
+
+    def __init__(self, concurrencia, capacidad_cola, espera_max_s, pesos=None, limites=None,
+                 ventana_muestras=1000):
+        self.concurrencia = concurrencia
+        self.capacidad_cola = capacidad_cola
+        self.espera_max_s = espera_max_s
+        self.pesos = {c: 1 for c in PRIORIDADES}
+        self.pesos.update(pesos or {})
+        self.limites = {c: concurrencia for c in PRIORIDADES}
+        self.limites.update({c: max(1, min(concurrencia, int(n))) for c, n in (limites or {}).items()})
+        self._libres = concurrencia
+        self._colas = {c: deque() for c in PRIORIDADES}
+        self._ejecutando = {c: 0 for c in PRIORIDADES}
+        self._peso_actual = {c: 0 for c in PRIORIDADES}
+        self._servicio_medio = None          # EWMA de la duración de un análisis (s)
+        self._esperas = deque(maxlen=ventana_muestras)
+        self._latencias = {c: deque(maxlen=ventana_muestras) for c in PRIORIDADES}
+        self.admitidas = 0
+        self.rechazadas = 0
+        self.rechazadas_por_espera = 0
+
+    @property
+    def en_cola(self):
+        return sum(len(cola) for cola in self._colas.values())
+
+    @property
+    def en_ejecucion(self):
+        return self.concurrencia - self._libres
+
+    def tasa_servicio(self):
+        """Análisis por segundo observados (None hasta tener muestras)"""
+        if not self._servicio_medio:
+            return None
+        return self.concurrencia / self._servicio_medio
+
+    def retry_after(self):
+        """Segundos estimados hasta que haya hueco para una petición nueva"""
+        tasa = self.tasa_servicio()
+        if not tasa:
+            return 1
+        return max(1, min(120, math.ceil((self.en_cola + 1) / tasa)))
+
+    def _admisible_ya(self, prioridad):
+        """True si una petición de la clase entraría sin esperar (hueco libre y clase bajo su límite)"""
+        return self._libres > 0 and self._ejecutando[prioridad] < self.limites[prioridad]
+
+    def comprobar(self, prioridad="interactiva"):
+        """
+        Lanza ColaLlena si una petición nueva de la clase sería rechazada: tendría que
+        esperar (sin hueco libre o con su clase en el límite) y la cola ya está llena
+        """
+        if prioridad not in self._colas:
+            prioridad = "estandar"
+        if not self._admisible_ya(prioridad) and self.en_cola >= self.capacidad_cola:
+            self.rechazadas += 1
+            raise ColaLlena("Servidor saturado: cola de inferencia llena", self.retry_after())
+
+    async def entrar(self, prioridad="interactiva", esperar=False):
+        """
+        Espera un hueco de ejecución para la clase indicada y devuelve los segundos esperados.
+        Con esperar=True (tareas internas) nunca se rechaza ni caduca.
+        """
+        if prioridad not in self._colas:
+            prioridad = "estandar"
+        inicio = time.perf_counter()
+        if not esperar:
+            self.comprobar(prioridad)
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._colas[prioridad].append(futuro)
+        self._despachar()
+        try:
+            if futuro.done() or esperar or not self.espera_max_s:
+                await futuro
+            else:
+                await asyncio.wait_for(futuro, self.espera_max_s)
+        except asyncio.TimeoutError:
+            self._quitar(prioridad, futuro)
+            self.rechazadas_por_espera += 1
+            raise ColaLlena("Tiempo máximo de espera en cola superado", self.retry_after())
+        except asyncio.CancelledError:
+            if futuro.done() and not futuro.cancelled():
+                # Se le asignó el hueco pero quien esperaba ya no está: se cede
+                self._liberar(prioridad)
+            else:
+                self._quitar(prioridad, futuro)
+            raise
+        espera = time.perf_counter() - inicio
+        self.admitidas += 1
+        self._esperas.append(espera)
+        return espera
+
+    def salir(self, prioridad, duracion, espera=0.0, unidades=1):
+        """
+        Libera el hueco y registra la duración (tasa de servicio) y la latencia de la clase.
+        'unidades' son las imágenes analizadas en el hueco: la tasa de servicio se estima por
+        imagen, para que un lote de cientos de imágenes no dispare el Retry-After de las demás.
+        """
+        if prioridad not in self._colas:
+            prioridad = "estandar"
+        por_unidad = duracion / max(1, unidades)
+        if self._servicio_medio is None:
+            self._servicio_medio = por_unidad
+        else:
+            self._servicio_medio = 0.9 * self._servicio_medio + 0.1 * por_unidad
+        self._latencias[prioridad].append(espera + duracion)
+        self._liberar(prioridad)
+
+    def _liberar(self, prioridad):
+        self._libres += 1
+        self._ejecutando[prioridad] -= 1
+        self._despachar()
+
+    def _despachar(self):
+        """Asigna huecos libres por round-robin ponderado suave entre clases elegibles"""
+        while self._libres > 0:
+            for cola in self._colas.values():
+                while cola and cola[0].done():
+                    cola.popleft()
+            elegibles = [
+                c for c in PRIORIDADES
+                if self._colas[c] and self._ejecutando[c] < self.limites[c]
+            ]
+            if not elegibles:
+                return
+            total = 0
+            for c in elegibles:
+                self._peso_actual[c] += self.pesos[c]
+                total += self.pesos[c]
+            clase = max(elegibles, key=lambda c: self._peso_actual[c])
+            self._peso_actual[clase] -= total
+            futuro = self._colas[clase].popleft()
+            self._libres -= 1
+            self._ejecutando[clase] += 1
+            futuro.set_result(None)
+
+    def _quitar(self, prioridad, futuro):
+        try:
+            self._colas[prioridad].remove(futuro)
+        except ValueError:
+            pass
+
+    def ocupacion(self):
+        """(en cola, en ejecución) por clase, sin calcular percentiles (para /metrics)"""
+        return {c: (len(self._colas[c]), self._ejecutando[c]) for c in PRIORIDADES}
+
+    def resumen(self):
+        """Profundidad de cola, esperas, rechazos y latencia por clase (para /estado)"""
+        def percentil(muestras, p):
+            if not muestras:
+                return 0.0
+            ordenadas = sorted(muestras)
+            return round(ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))], 4)
+
+        tasa = self.tasa_servicio()
+        return {
+            "concurrencia": self.concurrencia,
+            "capacidad_cola": self.capacidad_cola,
+            "en_ejecucion": self.en_ejecucion,
+            "en_cola": self.en_cola,
+            "admitidas": self.admitidas,
+            "rechazadas": self.rechazadas,
+            "rechazadas_por_espera": self.rechazadas_por_espera,
+            "espera_p50_s": percentil(self._esperas, 0.50),
+            "espera_p99_s": percentil(self._esperas, 0.99),
+            "tasa_servicio_por_s": round(tasa, 2) if tasa else None,
+            "clases": {
+                c: {
+                    "peso": self.pesos[c],
+                    "limite_concurrencia": self.limites[c],
+                    "en_ejecucion": self._ejecutando[c],
+                    "en_cola": len(self._colas[c]),
+                    "latencia_p50_s": percentil(self._latencias[c], 0.50),
+                    "latencia_p99_s": percentil(self._latencias[c], 0.99),
+                }
+                for c in PRIORIDADES
+            },
+        }
@@ -8,21 +8,189 @@ import os
 import io
 import time
 import gc
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
 from typing import Optional, List
-from contextlib import asynccontextmanager
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Header
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 
+from planificador import PlanificadorLotes, ControlAdmision, ColaLlena, PRIORIDADES
+from cola_trabajos import ColaTrabajos
+from topologia_cpu import planificar_hilos, candidatos_intra_op, calibrar
+from motores_vision import (MotorTorch, MotorTorchCompilado, MotorOnnx, exportar_onnx, cuantizar_int8,
+                            comprobar_paridad, cpu_soporta_bf16)
+import metricas
+
 # Estado de los modelos (carga bajo demanda)
 modelos_cargados = {
     "biomedclip": {"modelo": None, "procesador": None, "tokenizer": None},
     "biovil": {"modelo": None, "procesador": None, "tokenizer": None}
 }
 
+# Identificador del modelo en el hub y plantillas de los prompts zero-shot
+MODELO_BIOMEDCLIP_HUB = 'hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224'
+PLANTILLA_HISTOLOGIA = "this is a histopathology image showing "
+PLANTILLA_RADIOGRAFIA = "chest x-ray with "
+
+# Embeddings de texto de los catálogos (se calculan una vez por modelo y versión del catálogo)
+# y se persisten en disco (.npy + manifiesto JSON) para compartirlos entre arranques y workers
+DIRECTORIO_EMBEDDINGS = os.environ.get(
+    "DIRECTORIO_EMBEDDINGS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "embeddings")
+)
+embeddings_catalogos = {}
+_lock_embeddings = threading.Lock()
+
+# Modo "solo visión": con los embeddings de los catálogos ya calculados, la torre de texto
+# (PubMedBERT) se descarta tras la carga y solo se recarga si cambian los prompts
+MODO_SOLO_VISION = os.environ.get("MODO_SOLO_VISION", "0").lower() in ("1", "true", "si", "sí")
+
+# Micro-lotes: ventana de agrupación de peticiones concurrentes y tamaño máximo de lote
+LOTE_VENTANA_MS = float(os.environ.get("LOTE_VENTANA_MS", "15"))
+LOTE_TAMANO_MAX = int(os.environ.get("LOTE_TAMANO_MAX", "16"))
+
+# Política de precarga al arrancar: none | biomedclip | all
+PRECARGA_MODELOS = os.environ.get("PRECARGA_MODELOS", "none").lower()
+# Tamaños de lote sintéticos con los que se calienta encode_image antes de declarar el modelo listo
+TAMANOS_CALENTAMIENTO = sorted({
+    int(n) for n in os.environ.get("CALENTAMIENTO_LOTES", f"1,4,{LOTE_TAMANO_MAX}").split(",") if n.strip()
+})
+# Resolución de entrada de la ViT-B/16 de BiomedCLIP
+TAMANO_ENTRADA = 224
+
+# Motor de la torre de visión: torch | torch-trace | torch-compile | onnx | onnx-int8.
+# Los motores alternativos se validan contra torch al cargar (imágenes reales de
+# DIRECTORIO_PARIDAD) y, si no superan la paridad, se sigue con torch
+MOTORES_VISION = ("torch", "torch-trace", "torch-compile", "onnx", "onnx-int8")
+MOTOR_VISION = os.environ.get("MOTOR_VISION", "torch").lower()
+# bf16 autocast en la ruta compilada de torch: auto (solo si la CPU tiene AVX512-BF16/AMX) | 1 | 0
+TORCH_BF16 = os.environ.get("TORCH_BF16", "auto").lower()
+DIRECTORIO_ONNX = os.environ.get(
+    "DIRECTORIO_ONNX",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx")
+)
+# Conjunto fijo de paridad: copia pequeña de imagenes_prueba/ dentro de backend/, que sí
+# llega a la imagen Docker (el contexto de build es backend/)
+DIRECTORIO_PARIDAD = os.environ.get(
+    "DIRECTORIO_PARIDAD",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "imagenes_paridad")
+)
+PARIDAD_IMAGENES = int(os.environ.get("PARIDAD_IMAGENES", "16"))
+PARIDAD_DELTA_MAX = float(os.environ.get("PARIDAD_DELTA_MAX", "2.0"))      # logits (escala ~100)
+PARIDAD_ACUERDO_MIN = float(os.environ.get("PARIDAD_ACUERDO_MIN", "0.9"))  # fracción de top-1 iguales
+# Con un motor ONNX aceptado, la torre de visión de torch se descarta de memoria
+ONNX_DESCARTAR_TORCH = os.environ.get("ONNX_DESCARTAR_TORCH", "1").lower() in ("1", "true", "si", "sí")
+
+# Residencia de modelos: desalojo por inactividad o por presupuesto de memoria (0 = desactivado)
+MODELO_INACTIVIDAD_S = float(os.environ.get("MODELO_INACTIVIDAD_S", "1800"))
+MEMORIA_MAX_MB = float(os.environ.get("MEMORIA_MAX_MB", "0"))
+# Inactividad tras la que se libera un modelo cuando el cliente pide liberarlo ("modo ahorro")
+LIBERACION_DIFERIDA_S = float(os.environ.get("LIBERACION_DIFERIDA_S", "120"))
+
+# Decodificación reducida: draft JPEG (escalado DCT 1/2-1/8) y reducción entera por cajas hasta
+# que el lado corto quede en FACTOR_PREREDUCCION × TAMANO_ENTRADA, antes del Resize bicúbico de open_clip
+DECODIFICACION_REDUCIDA = os.environ.get("DECODIFICACION_REDUCIDA", "1").lower() in ("1", "true", "si", "sí")
+FACTOR_PREREDUCCION = 2
+# Tolerancia frente a la decodificación a resolución completa: diferencia absoluta media
+# del tensor preprocesado (unidades normalizadas de CLIP)
+TOLERANCIA_DECODIFICACION = 0.03
+
+# Hilos por worker: los núcleos disponibles (afinidad y cuota de cgroup) se reparten entre
+# los WEB_CONCURRENCY workers del host para que sus pools de torch no compitan entre sí
+TOPOLOGIA_CPU = planificar_hilos()
+HILOS_INTRA_OP = int(os.environ.get("HILOS_INTRA_OP", str(TOPOLOGIA_CPU["hilos_intra_op"])))
+HILOS_INTER_OP = int(os.environ.get("HILOS_INTER_OP", str(TOPOLOGIA_CPU["hilos_inter_op"])))
+# Compara varios nº de hilos intra-op sobre un lote sintético al cargar el modelo
+CALIBRAR_HILOS = os.environ.get("CALIBRAR_HILOS", "0").lower() in ("1", "true", "si", "sí")
+# OpenMP/MKL leen estas variables al importar torch, que se importa bajo demanda
+os.environ.setdefault("OMP_NUM_THREADS", str(HILOS_INTRA_OP))
+os.environ.setdefault("MKL_NUM_THREADS", str(HILOS_INTRA_OP))
+
+# Caché LRU de embeddings de imagen por SHA-256 del fichero subido (nº de entradas)
+CACHE_IMAGENES_MAX = int(os.environ.get("CACHE_IMAGENES_MAX", "2048"))
+
+# Análisis por lotes: límites del lote (nº de imágenes y MB descomprimidos de un ZIP)
+# e hilos para decodificar y preprocesar imágenes en paralelo
+LOTE_MAX_IMAGENES = int(os.environ.get("LOTE_MAX_IMAGENES", "500"))
+LOTE_MAX_MB = float(os.environ.get("LOTE_MAX_MB", "1024"))
+DECODIFICACION_HILOS = int(os.environ.get("DECODIFICACION_HILOS", str(TOPOLOGIA_CPU["hilos_decodificacion"])))
+EXTENSIONES_IMAGEN = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+TIPOS_IMAGEN_PERMITIDOS = ["image/jpeg", "image/png", "image/tiff", "image/jpg"]
+TIPOS_ZIP = ["application/zip", "application/x-zip-compressed", "application/x-zip"]
+
+# Trabajos asíncronos: base de datos SQLite de la cola, nº de trabajadores y lease de
+# una imagen reclamada (pasado ese tiempo otro trabajador/proceso puede reclamarla)
+TRABAJOS_DB = os.environ.get(
+    "TRABAJOS_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "trabajos.db")
+)
+TRABAJOS_WORKERS = int(os.environ.get("TRABAJOS_WORKERS", "2"))
+TRABAJOS_LEASE_S = float(os.environ.get("TRABAJOS_LEASE_S", "600"))
+
+# Control de admisión: peticiones que pueden esperar turno de inferencia (más allá → 429)
+# y espera máxima en cola antes de rechazar (acota la latencia de las admitidas)
+ADMISION_COLA_MAX = int(os.environ.get("ADMISION_COLA_MAX", "64"))
+ADMISION_ESPERA_MAX_S = float(os.environ.get("ADMISION_ESPERA_MAX_S", "30"))
+
+# Perfilado bajo demanda (?perfilar=true + cabecera X-Token-Admin). Sin token, desactivado
+PERFILADO_TOKEN = os.environ.get("PERFILADO_TOKEN", "")
+DIRECTORIO_TRAZAS = os.environ.get(
+    "DIRECTORIO_TRAZAS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "trazas")
+)
+# Trazas conservadas en disco: al guardar una nueva se borran las más antiguas (0 = sin límite)
+TRAZAS_MAX = int(os.environ.get("TRAZAS_MAX", "20"))
+
+# Clases de prioridad (interactiva, estandar, masiva): peso en el reparto de huecos y límite
+# de análisis simultáneos de cada clase (formato "clase=valor,...")
+def _leer_por_clase(variable, defecto):
+    valores = dict(defecto)
+    for par in os.environ.get(variable, "").split(","):
+        if "=" in par:
+            clase, valor = par.split("=", 1)
+            valores[clase.strip()] = float(valor)
+    return valores
+
+
+PRIORIDAD_PESOS = _leer_por_clase("PRIORIDAD_PESOS", {"interactiva": 8, "estandar": 3, "masiva": 1})
+PRIORIDAD_LIMITES = _leer_por_clase("PRIORIDAD_LIMITES", {})
+
+# Hilos dedicados a inferencia (límite de análisis simultáneos); por defecto igual al
+# tamaño de lote para que el planificador pueda llenar lotes completos
+INFERENCIA_CONCURRENCIA = int(os.environ.get("INFERENCIA_CONCURRENCIA", str(LOTE_TAMANO_MAX)))
+
+# Máquina de estados de carga por modelo: sin_cargar → cargando → listo | error
+ESTADO_SIN_CARGAR = "sin_cargar"
+ESTADO_CARGANDO = "cargando"
+ESTADO_LISTO = "listo"
+ESTADO_ERROR = "error"
+
+# Varios workers (gunicorn --preload): el maestro carga los pesos una vez antes del fork.
+# En los workers ambos valores se heredan; _carga_en_maestro solo es True durante esa carga
+PESOS_MEMORIA_COMPARTIDA = os.environ.get("PESOS_MEMORIA_COMPARTIDA", "0").lower() in ("1", "true", "si", "sí")
+_carga_en_maestro = False
+pesos_heredados = False
+
+estado_modelos = {
+    tipo: {"estado": ESTADO_SIN_CARGAR, "progreso": 0.0, "etapa": None,
+           "inicio": None, "duracion": None, "error": None, "desalojado": False}
+    for tipo in modelos_cargados
+}
+
+# Cargas en curso (una por modelo): las peticiones concurrentes esperan el mismo Future
+_cargas_en_curso = {}
+_lock_cargas = threading.Lock()
+
 def obtener_modelo_cargado():
     """Retorna si el modelo biomedclip está cargado (para compatibilidad)"""
     return modelos_cargados["biomedclip"]["modelo"] is not None
@@ -808,35 +976,123 @@ def obtener_todos_diagnosticos():
     return todos
 
 
-def cargar_modelo(tipo="biomedclip"):
-    """Carga el modelo especificado bajo demanda"""
-    global modelos_cargados
-    
-    if modelos_cargados.get(tipo) and modelos_cargados[tipo]["modelo"] is not None:
+def _actualizar_estado(tipo, **campos):
+    """Actualiza la máquina de estados de carga de un modelo"""
+    estado_modelos[tipo].update(campos)
+
+
+def resumen_estado_modelo(tipo):
+    """Estado de carga de un modelo con el tiempo transcurrido (para /estado y /api/health)"""
+    e = dict(estado_modelos[tipo])
+    if e["estado"] == ESTADO_CARGANDO and e["inicio"] is not None:
+        e["transcurrido"] = round(time.time() - e["inicio"], 1)
+    e.pop("inicio", None)
+    return e
+
+
+def cargar_modelo(tipo="biomedclip", calentar=False):
+    """
+    Carga el modelo especificado bajo demanda.
+    Solo hay una carga en curso por modelo: las llamadas concurrentes esperan
+    a esa misma carga y reciben su resultado.
+    Con calentar=True se ejecutan lotes sintéticos antes de declararlo listo.
+    """
+    if tipo not in modelos_cargados:
+        print(f"⚠️ Tipo de modelo '{tipo}' no reconocido para cargar.")
+        return False
+    if modelos_cargados[tipo]["modelo"] is not None:
         return True
-        
+
+    with _lock_cargas:
+        if modelos_cargados[tipo]["modelo"] is not None:
+            return True
+        vuelo = _cargas_en_curso.get(tipo)
+        propietario = vuelo is None
+        if propietario:
+            vuelo = Future()
+            _cargas_en_curso[tipo] = vuelo
+
+    if not propietario:
+        return vuelo.result()
+
+    exito = False
+    try:
+        exito = _ejecutar_carga_modelo(tipo, calentar)
+    finally:
+        with _lock_cargas:
+            del _cargas_en_curso[tipo]
+        vuelo.set_result(exito)
+    return exito
+
+
+async def cargar_modelo_async(tipo="biomedclip"):
+    """Espera la carga en curso (sin ocupar un hilo) o lanza una nueva en el pool de carga"""
+    with _lock_cargas:
+        vuelo = _cargas_en_curso.get(tipo)
+    if vuelo is not None:
+        return await asyncio.wrap_future(vuelo)
+    return await ejecutar_carga(cargar_modelo, tipo)
+
+
+def _calentar_modelo(motor):
+    """Pasa lotes sintéticos por el motor de visión (JIT, allocator, caches de oneDNN/ORT)"""
+    import torch
+
+    for n in TAMANOS_CALENTAMIENTO:
+        inicio = time.time()
+        motor.codificar(torch.randn(n, 3, TAMANO_ENTRADA, TAMANO_ENTRADA))
+        print(f"🔥 Calentamiento lote {n} ({motor.nombre}): {time.time() - inicio:.2f}s")
+
+
+def _ejecutar_carga_modelo(tipo, calentar=False):
+    """Realiza la carga efectiva y recorre los estados cargando → listo / error"""
+    _actualizar_estado(tipo, estado=ESTADO_CARGANDO, progreso=0.0, etapa="iniciando",
+                       inicio=time.time(), duracion=None, error=None)
     try:
         if tipo == "biomedclip":
             print(f"🔄 Cargando modelo BiomedCLIP (esto puede tardar 30-60 segundos la primera vez)...")
             inicio = time.time()
             import torch
+            if _carga_en_maestro:
+                # Un solo hilo y sin pool inter-op: OpenMP no debe arrancar antes del fork
+                aplicar_hilos_torch(1)
+            else:
+                aplicar_hilos_torch(HILOS_INTRA_OP, HILOS_INTER_OP)
             from open_clip import create_model_from_pretrained, get_tokenizer
             
-            modelo, procesador = create_model_from_pretrained(
-                'hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224'
-            )
-            tokenizer = get_tokenizer('hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224')
+            _actualizar_estado(tipo, progreso=0.1, etapa="descargando/cargando pesos")
+            modelo, procesador = create_model_from_pretrained(MODELO_BIOMEDCLIP_HUB)
+            _actualizar_estado(tipo, progreso=0.6, etapa="cargando tokenizer")
+            tokenizer = get_tokenizer(MODELO_BIOMEDCLIP_HUB)
             
             modelo.eval()
             for param in modelo.parameters():
                 param.requires_grad = False
 
-            modelos_cargados["biomedclip"] = {
+            m = {
                 "modelo": modelo,
                 "procesador": procesador,
-                "tokenizer": tokenizer
+                "tokenizer": tokenizer,
+                # exp(logit_scale) precalculado: es constante en inferencia
+                "escala_logit": float(modelo.logit_scale.exp().item())
             }
+            if MODO_SOLO_VISION or calentar or _carga_en_maestro:
+                _actualizar_estado(tipo, progreso=0.7, etapa="embeddings de catálogos")
+                for nombre in ("forense", "radiografia"):
+                    obtener_embeddings_catalogo(nombre, m)
+            if _carga_en_maestro:
+                # Motor, calibración y calentamiento los hace cada worker tras el fork
+                m["motor"], m["paridad_motor"] = MotorTorch(modelo), None
+            else:
+                preparar_motor_proceso(m, calentar, tipo)
+            if MODO_SOLO_VISION:
+                descartar_torre_texto(modelo)
+
+            modelos_cargados["biomedclip"] = m
             tiempo = time.time() - inicio
+            _actualizar_estado(tipo, estado=ESTADO_LISTO, progreso=1.0, etapa=None, duracion=round(tiempo, 1))
+            residencia.registrar_carga(tipo)
+            metricas.registrar_carga(tipo, tiempo, True)
             print(f"✅ Modelo BiomedCLIP cargado en {tiempo:.1f} segundos.")
             return True
         
@@ -845,23 +1101,147 @@ def cargar_modelo(tipo="biomedclip"):
             # pero con los prompts específicos de BioViL.
             # En un entorno con más RAM podríamos cargar 'microsoft/Biovil-T'
             print(f"🔄 Cargando BioViL-T (usando motor BiomedCLIP optimizado para Rx)...")
+            inicio = time.time()
             # BioViL-T en este contexto es un "modo" de BiomedCLIP con prompts específicos.
             # Por lo tanto, cargamos BiomedCLIP si no está cargado.
-            if not cargar_modelo("biomedclip"):
-                return False
+            _actualizar_estado(tipo, progreso=0.1, etapa="esperando motor BiomedCLIP")
+            if not cargar_modelo("biomedclip", calentar):
+                raise Exception("No se pudo cargar el motor BiomedCLIP")
             # Marcamos BioViL como "cargado" para indicar que su motor está listo
             modelos_cargados["biovil"]["modelo"] = True # Usamos un booleano para indicar que está "listo"
+            tiempo = time.time() - inicio
+            _actualizar_estado(tipo, estado=ESTADO_LISTO, progreso=1.0, etapa=None, duracion=round(tiempo, 1))
+            residencia.registrar_carga(tipo)
+            metricas.registrar_carga(tipo, tiempo, True)
             print("✅ Motor BioViL-T (BiomedCLIP) listo para radiografías.")
             return True
             
     except Exception as e:
+        tiempo = time.time() - estado_modelos[tipo]["inicio"]
+        _actualizar_estado(tipo, estado=ESTADO_ERROR, etapa=None, error=str(e), duracion=round(tiempo, 1))
+        metricas.registrar_carga(tipo, tiempo, False)
         print(f"❌ Error cargando modelo {tipo}: {e}")
         import traceback
         traceback.print_exc()
         return False
 
-def liberar_modelo(tipo="todas"):
-    """Libera el modelo especificado de la memoria"""
+def preparar_motor_proceso(m, calentar=False, tipo=None):
+    """
+    Lo que pertenece a cada proceso y no puede heredarse de un fork: motor de visión
+    (sesiones de ONNX Runtime, módulos compilados), calibración de hilos y calentamiento.
+    Con 'tipo' se informa del progreso en la máquina de estados de carga.
+    """
+    if tipo and MOTOR_VISION != "torch":
+        _actualizar_estado(tipo, progreso=0.75, etapa=f"motor de visión {MOTOR_VISION}")
+    m["motor"], m["paridad_motor"] = crear_motor_vision(m)
+    if CALIBRAR_HILOS and not isinstance(m["motor"], MotorOnnx):
+        if tipo:
+            _actualizar_estado(tipo, progreso=0.78, etapa="calibración de hilos")
+        calibrar_hilos(m["motor"])
+    if calentar:
+        if tipo:
+            _actualizar_estado(tipo, progreso=0.8, etapa="calentamiento")
+        _calentar_modelo(m["motor"])
+
+
+def aplicar_hilos_torch(intra_op, inter_op=None):
+    """Fija los pools de torch de este proceso y lo refleja en TOPOLOGIA_CPU (para /estado)"""
+    import torch
+
+    torch.set_num_threads(intra_op)
+    if inter_op is not None:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            # Solo puede fijarse antes del primer trabajo inter-op del proceso
+            pass
+    TOPOLOGIA_CPU["aplicado"] = {
+        "intra_op": torch.get_num_threads(),
+        "inter_op": torch.get_num_interop_threads(),
+    }
+
+
+def calibrar_hilos(motor):
+    """Elige el nº de hilos intra-op con más imágenes/s sobre un lote sintético"""
+    import torch
+
+    lote = list(torch.randn(min(8, LOTE_TAMANO_MAX), 3, TAMANO_ENTRADA, TAMANO_ENTRADA))
+    candidatos = candidatos_intra_op(TOPOLOGIA_CPU["cpus_por_worker"], HILOS_INTRA_OP)
+    mejor, resultados = calibrar(motor.codificar, aplicar_hilos_torch, candidatos, lote)
+    TOPOLOGIA_CPU["calibracion"] = {"imagenes_por_s": resultados, "hilos_intra_op": mejor}
+    print(f"🧵 Calibración de hilos intra-op {resultados} → {mejor}")
+
+
+def _devolver_memoria_so():
+    """Devuelve al sistema operativo la memoria liberada por el allocator (glibc)"""
+    gc.collect()
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except Exception:
+        pass
+
+
+def descartar_torre_texto(modelo):
+    """
+    Elimina la torre de texto (PubMedBERT) del modelo. Quedan en memoria
+    la ViT-B/16, su proyección y logit_scale, suficientes para la inferencia.
+    """
+    if modelo is None or getattr(modelo, "text", None) is None:
+        return
+    modelo.text = None
+    _devolver_memoria_so()
+    print("🪶 Modo solo visión: torre de texto descartada de memoria.")
+
+
+def _cargar_modelo_texto():
+    """Recarga temporalmente un modelo completo para recalcular embeddings de texto"""
+    from open_clip import create_model_from_pretrained
+
+    print("🔄 Recargando la torre de texto (los prompts del catálogo han cambiado)...")
+    modelo_texto, _ = create_model_from_pretrained(MODELO_BIOMEDCLIP_HUB)
+    modelo_texto.eval()
+    modelo_texto.visual = None
+    return modelo_texto
+
+
+def memoria_rss_mb():
+    """RSS actual del proceso en MB (None si no se puede leer)"""
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024.0 * 1024.0)
+    except Exception:
+        return None
+
+
+def memoria_compartida_mb():
+    """
+    Desglose del RSS (Linux): páginas compartidas con otros procesos (p. ej. pesos
+    heredados del maestro) y privadas, y el PSS (RSS con lo compartido prorrateado)
+    """
+    campos = {"Pss:": "pss_mb", "Shared_Clean:": "compartida_mb", "Shared_Dirty:": "compartida_mb",
+              "Private_Clean:": "privada_mb", "Private_Dirty:": "privada_mb"}
+    desglose = {"pss_mb": 0.0, "compartida_mb": 0.0, "privada_mb": 0.0}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for linea in f:
+                partes = linea.split()
+                if partes and partes[0] in campos:
+                    desglose[campos[partes[0]]] += int(partes[1]) / 1024.0
+    except (OSError, ValueError):
+        return None
+    return {k: round(v, 1) for k, v in desglose.items()}
+
+
+def liberar_modelo(tipo="todas", motivo="manual"):
+    """Libera el modelo especificado de la memoria ('motivo' etiqueta la métrica de liberaciones)"""
     global modelos_cargados
     
     import gc
@@ -875,16 +1255,23 @@ def liberar_modelo(tipo="todas"):
     else:
         print(f"⚠️ Tipo de modelo '{tipo}' no reconocido para liberar.")
         return
+    # BioViL-T usa el motor BiomedCLIP: si se libera el motor, deja de estar listo
+    if "biomedclip" in tipos_a_liberar and "biovil" not in tipos_a_liberar:
+        tipos_a_liberar.append("biovil")
 
     for t in tipos_a_liberar:
         if modelos_cargados.get(t):
             if modelos_cargados[t]["modelo"] is not None:
+                metricas.LIBERACIONES.labels(t, motivo).inc()
                 del modelos_cargados[t]["modelo"]
             if modelos_cargados[t]["procesador"] is not None:
                 del modelos_cargados[t]["procesador"]
             if modelos_cargados[t]["tokenizer"] is not None:
                 del modelos_cargados[t]["tokenizer"]
             modelos_cargados[t] = {"modelo": None, "procesador": None, "tokenizer": None}
+            # Desalojado por la residencia: se recarga en la siguiente petición (sigue "listo")
+            _actualizar_estado(t, estado=ESTADO_SIN_CARGAR, progreso=0.0, etapa=None,
+                               inicio=None, duracion=None, error=None, desalojado=motivo != "manual")
             print(f"🧹 Modelo '{t}' liberado de memoria.")
     
     gc.collect()
@@ -893,88 +1280,833 @@ def liberar_modelo(tipo="todas"):
     
     print(f"🧹 Limpieza de memoria completada.")
 
+# =============================================================================
+# RESIDENCIA DE MODELOS
+# =============================================================================
 
-def analizar_imagen(imagen_bytes: bytes, organo_filtro: str = None) -> dict:
+class GestorResidencia:
     """
-    Analiza una imagen histológica con BiomedCLIP usando clasificación zero-shot.
+    Decide cuándo sale un modelo de memoria: tras MODELO_INACTIVIDAD_S sin uso,
+    o en orden LRU cuando el RSS del proceso supera MEMORIA_MAX_MB.
+    Nunca desaloja un modelo con análisis en curso.
     """
-    import torch
-    from PIL import Image
-    import numpy as np
-    import io
-    import time
-    
+
+    def __init__(self, inactividad_s, memoria_max_mb, diferida_s, intervalo_s=15.0):
+        self.inactividad_s = inactividad_s
+        self.memoria_max_mb = memoria_max_mb
+        self.diferida_s = diferida_s
+        self.intervalo_s = intervalo_s
+        self._ultimo_uso = OrderedDict()   # tipo -> último uso (orden LRU)
+        self._en_uso = {}
+        self._sugeridos = {}               # tipo -> instante de la petición de liberación
+        self._desalojando = set()          # modelos que se están liberando ahora mismo
+        self._lock = threading.Lock()
+        self._liberado = threading.Condition(self._lock)
+        self._parar = threading.Event()
+        self._hilo = None
+        self.desalojos = {"inactividad": 0, "memoria": 0, "sugerido": 0}
+
+    def iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._bucle, name="residencia-modelos", daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+
+    @contextmanager
+    def usar(self, *tipos):
+        """
+        Marca los modelos como en uso durante un análisis (y como recientes en el LRU).
+        Si uno se está desalojando, espera a que termine (después se recarga bajo demanda).
+        """
+        with self._liberado:
+            while self._desalojando.intersection(tipos):
+                self._liberado.wait()
+            for tipo in tipos:
+                self._en_uso[tipo] = self._en_uso.get(tipo, 0) + 1
+                self._sugeridos.pop(tipo, None)
+                self._ultimo_uso[tipo] = time.time()
+                self._ultimo_uso.move_to_end(tipo)
+        try:
+            yield
+        finally:
+            with self._lock:
+                for tipo in tipos:
+                    self._en_uso[tipo] -= 1
+                    self._ultimo_uso[tipo] = time.time()
+
+    def registrar_carga(self, tipo):
+        """Un modelo recién cargado entra en el LRU aunque aún no se haya usado"""
+        with self._lock:
+            self._ultimo_uso[tipo] = time.time()
+            self._ultimo_uso.move_to_end(tipo)
+
+    def sugerir_liberacion(self, tipo):
+        """Pista del cliente: liberar el modelo si queda inactivo LIBERACION_DIFERIDA_S"""
+        tipos = list(modelos_cargados.keys()) if tipo in ("todas", "todos") else [tipo]
+        with self._lock:
+            for t in tipos:
+                self._sugeridos[t] = time.time()
+
+    def _candidatos(self, solo_con_memoria=False):
+        """
+        Modelos cargados y sin uso, del menos al más recientemente usado. Con
+        solo_con_memoria se excluyen los que solo son una marca (BioViL reutiliza
+        los pesos de BiomedCLIP): desalojarlos no libera RSS.
+        """
+        return [
+            tipo for tipo in self._ultimo_uso
+            if modelos_cargados[tipo]["modelo"] is not None and self._en_uso.get(tipo, 0) == 0
+            and tipo not in self._desalojando
+            and not (solo_con_memoria and modelos_cargados[tipo]["modelo"] is True)
+        ]
+
+    def revisar(self):
+        """
+        Aplica las políticas de desalojo una vez. Las víctimas se eligen (y se reservan)
+        bajo el lock, pero se liberan fuera de él: usar() de otros modelos no espera a
+        liberar_modelo ni a la recogida de basura.
+        """
+        ahora = time.time()
+        with self._lock:
+            a_liberar = []
+            for tipo in self._candidatos():
+                inactivo = ahora - self._ultimo_uso[tipo]
+                if tipo in self._sugeridos and inactivo >= self.diferida_s:
+                    a_liberar.append((tipo, "sugerido"))
+                elif self.inactividad_s > 0 and inactivo >= self.inactividad_s:
+                    a_liberar.append((tipo, "inactividad"))
+            self._desalojando.update(tipo for tipo, _ in a_liberar)
+        for tipo, motivo in a_liberar:
+            self._desalojar(tipo, motivo)
+
+        while self.memoria_max_mb > 0:
+            rss = memoria_rss_mb()
+            if rss is None or rss <= self.memoria_max_mb:
+                break
+            with self._lock:
+                candidatos = self._candidatos(solo_con_memoria=True)
+                if not candidatos:
+                    break
+                tipo = candidatos[0]
+                self._desalojando.add(tipo)
+            print(f"📈 RSS {rss:.0f} MB > presupuesto {self.memoria_max_mb:.0f} MB")
+            self._desalojar(tipo, "memoria")
+
+    def _desalojar(self, tipo, motivo):
+        """Libera un modelo reservado en _desalojando (fuera del lock) y lo vuelve a dejar usable"""
+        try:
+            if modelos_cargados[tipo]["modelo"] is not None:
+                print(f"♻️ Desalojando modelo '{tipo}' ({motivo})")
+                liberar_modelo(tipo, motivo)
+                _devolver_memoria_so()
+                self.desalojos[motivo] += 1
+        finally:
+            with self._liberado:
+                self._desalojando.discard(tipo)
+                self._sugeridos.pop(tipo, None)
+                self._liberado.notify_all()
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo_s):
+            try:
+                self.revisar()
+            except Exception as e:
+                print(f"⚠️ Error en el gestor de residencia: {e}")
+
+    def resumen(self):
+        ahora = time.time()
+        with self._lock:
+            return {
+                "inactividad_s": self.inactividad_s,
+                "memoria_max_mb": self.memoria_max_mb,
+                "orden_lru": list(self._ultimo_uso.keys()),
+                "inactivo_s": {t: round(ahora - u, 1) for t, u in self._ultimo_uso.items()},
+                "en_uso": {t: n for t, n in self._en_uso.items() if n},
+                "liberacion_sugerida": list(self._sugeridos.keys()),
+                "desalojos": dict(self.desalojos),
+            }
+
+
+residencia = GestorResidencia(MODELO_INACTIVIDAD_S, MEMORIA_MAX_MB, LIBERACION_DIFERIDA_S)
+
+
+# =============================================================================
+# INFERENCIA DE IMÁGENES EN MICRO-LOTES
+# =============================================================================
+
+def _codificar_lote_imagenes(tensores):
+    """Ejecuta el motor de visión sobre un lote y devuelve los embeddings normalizados"""
+    m = modelos_cargados["biomedclip"]
+    if m["modelo"] is None:
+        raise Exception("El modelo BiomedCLIP no está cargado")
+    metricas.TAMANO_LOTE.observe(len(tensores))
+    with metricas.Cronometro(metricas.DURACION_LOTE):
+        return m["motor"].codificar(tensores)
+
+
+# =============================================================================
+# MOTOR DE LA TORRE DE VISIÓN
+# =============================================================================
+
+def rutas_onnx():
+    """(fp32, int8) de la torre de visión exportada, por modelo"""
+    huella = hashlib.sha256(MODELO_BIOMEDCLIP_HUB.encode("utf-8")).hexdigest()[:12]
+    base = os.path.join(DIRECTORIO_ONNX, f"biomedclip_visual_{huella}")
+    return base + ".onnx", base + "_int8.onnx"
+
+
+def preparar_motor_onnx(modelo, int8=False):
+    """Exporta (y cuantiza) la torre de visión si no está en DIRECTORIO_ONNX y abre la sesión"""
+    ruta_fp32, ruta_int8 = rutas_onnx()
+    if not os.path.exists(ruta_fp32):
+        exportar_onnx(modelo, ruta_fp32, TAMANO_ENTRADA)
+    if int8 and not os.path.exists(ruta_int8):
+        cuantizar_int8(ruta_fp32, ruta_int8)
+    if int8:
+        return MotorOnnx(ruta_int8, "onnx-int8", hilos=HILOS_INTRA_OP)
+    return MotorOnnx(ruta_fp32, "onnx", hilos=HILOS_INTRA_OP)
+
+
+def exportar_motores_onnx():
+    """Paso de build: deja exportadas en DIRECTORIO_ONNX las variantes fp32 e INT8"""
     if not cargar_modelo("biomedclip"):
         raise Exception("No se pudo cargar el modelo BiomedCLIP")
-    
+    modelo = modelos_cargados["biomedclip"]["modelo"]
+    if getattr(modelo, "visual", None) is None:
+        raise Exception("La torre de visión de torch ya se descartó (MOTOR_VISION=torch para exportar)")
+    preparar_motor_onnx(modelo, int8=True)
+
+
+def tamanos_lote_compilados():
+    """Tamaños de lote que compila la ruta rápida de torch: potencias de 2 hasta LOTE_TAMANO_MAX"""
+    tamanos = {LOTE_TAMANO_MAX}
+    n = 1
+    while n < LOTE_TAMANO_MAX:
+        tamanos.add(n)
+        n *= 2
+    return sorted(tamanos)
+
+
+def preparar_motor_torch_compilado(modelo, modo):
+    """Compila la torre de visión para cada tamaño de lote (parte de la carga, no de una petición)"""
+    bf16 = TORCH_BF16 in ("1", "true", "si", "sí") or (TORCH_BF16 == "auto" and cpu_soporta_bf16())
+    return MotorTorchCompilado(modelo, tamanos_lote_compilados(), modo=modo, bf16=bf16,
+                               tamano_entrada=TAMANO_ENTRADA).compilar()
+
+
+def _tensores_paridad(procesador):
+    """
+    Imágenes reales preprocesadas para la paridad: DIRECTORIO_PARIDAD y, si no está,
+    imagenes_prueba/. Devuelve (tensores, origen); sin imágenes, ([], None).
+    """
+    from corpus_prueba import cargar_corpus, leer
+
+    for directorio in (DIRECTORIO_PARIDAD, None):
+        try:
+            corpus = cargar_corpus(directorio)
+        except FileNotFoundError:
+            continue
+        rutas = corpus["radiografia"][:PARIDAD_IMAGENES // 4] + corpus["histologia"]
+        rutas = rutas[:PARIDAD_IMAGENES]
+        if rutas:
+            return [procesador(decodificar_imagen(leer(r))[0]) for r in rutas], directorio or "imagenes_prueba"
+    return [], None
+
+
+def crear_motor_vision(m):
+    """
+    Devuelve (motor, informe de paridad) según MOTOR_VISION. Un motor ONNX solo se
+    usa si sus logits contra los catálogos coinciden con los de torch dentro de
+    PARIDAD_DELTA_MAX y PARIDAD_ACUERDO_MIN; si no (o si falla), se queda torch.
+    """
+    referencia = MotorTorch(m["modelo"])
+    if MOTOR_VISION == "torch":
+        return referencia, None
+    if MOTOR_VISION not in MOTORES_VISION:
+        print(f"⚠️ MOTOR_VISION '{MOTOR_VISION}' desconocido; se usa torch")
+        return referencia, None
+
+    try:
+        if MOTOR_VISION.startswith("onnx"):
+            motor = preparar_motor_onnx(m["modelo"], int8=MOTOR_VISION == "onnx-int8")
+        else:
+            motor = preparar_motor_torch_compilado(m["modelo"], MOTOR_VISION.split("-", 1)[1])
+        tensores, origen = _tensores_paridad(m["procesador"])
+        if not tensores:
+            # Sobre ruido sintético la paridad no dice nada de imágenes reales: no se acepta
+            raise Exception(f"sin imágenes para la paridad ({DIRECTORIO_PARIDAD} ni imagenes_prueba/)")
+        matrices = [obtener_embeddings_catalogo(nombre, m)["matriz"] for nombre in ("forense", "radiografia")]
+        paridad = comprobar_paridad(referencia, motor, tensores, matrices, m["escala_logit"])
+        paridad["origen_imagenes"] = origen
+    except Exception as e:
+        print(f"⚠️ No se pudo preparar el motor {MOTOR_VISION}, se usa torch: {e}")
+        return referencia, {"motor_solicitado": MOTOR_VISION, "aceptado": False, "error": str(e)}
+
+    paridad["motor_solicitado"] = MOTOR_VISION
+    paridad["aceptado"] = (paridad["delta_logit_max"] <= PARIDAD_DELTA_MAX
+                           and paridad["acuerdo_top1"] >= PARIDAD_ACUERDO_MIN)
+    print(f"⚖️ Paridad {motor.nombre} vs torch: Δlogit máx {paridad['delta_logit_max']}, "
+          f"acuerdo top-1 {paridad['acuerdo_top1']:.1%}, ms/imagen {paridad['ms_por_imagen']}")
+    if not paridad["aceptado"]:
+        print(f"⚠️ El motor {motor.nombre} no supera la paridad; se usa torch")
+        return referencia, paridad
+
+    if ONNX_DESCARTAR_TORCH and isinstance(motor, MotorOnnx):
+        m["modelo"].visual = None
+        _devolver_memoria_so()
+        print("🪶 Torre de visión de torch descartada: la inferencia usa ONNX Runtime.")
+    return motor, paridad
+
+
+# Compartido por histología y radiografía: ambos usan los mismos pesos de BiomedCLIP
+planificador_imagenes = PlanificadorLotes(
+    _codificar_lote_imagenes,
+    ventana_ms=LOTE_VENTANA_MS,
+    tamano_max=LOTE_TAMANO_MAX,
+    nombre="planificador-biomedclip"
+)
+
+
+# =============================================================================
+# CACHÉ DE EMBEDDINGS DE IMAGEN
+# =============================================================================
+
+class CacheEmbeddingsImagen:
+    """
+    LRU acotada: SHA-256 de los bytes subidos → embedding normalizado de la imagen.
+    Un acierto permite re-puntuar contra cualquier catálogo o filtro con un solo
+    producto matricial, sin decodificar ni ejecutar encode_image.
+    """
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    @staticmethod
+    def clave(imagen_bytes):
+        return MODELO_BIOMEDCLIP_HUB + ":" + hashlib.sha256(imagen_bytes).hexdigest()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada
+
+    def guardar(self, clave, entrada):
+        if self.max_entradas <= 0:
+            return
+        with self._lock:
+            self._entradas[clave] = entrada
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def resumen(self):
+        total = self.aciertos + self.fallos
+        return {
+            "entradas": len(self._entradas),
+            "max_entradas": self.max_entradas,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / total, 3) if total else 0.0,
+        }
+
+
+cache_imagenes = CacheEmbeddingsImagen(CACHE_IMAGENES_MAX)
+
+
+@contextmanager
+def medir(tiempos, etapa):
+    """Acumula en tiempos[etapa] los milisegundos del bloque"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tiempos[etapa] = round(tiempos.get(etapa, 0.0) + (time.perf_counter() - inicio) * 1000, 2)
+
+
+def decodificar_imagen(imagen_bytes, reducida=None):
+    """
+    Decodifica una imagen a RGB. En modo reducido evita trabajar a resolución completa
+    (fotos y placas de 4000+ px): el procesador solo necesita TAMANO_ENTRADA px.
+    Devuelve (imagen, tamaño original).
+    """
+    from PIL import Image
+
+    if reducida is None:
+        reducida = DECODIFICACION_REDUCIDA
+    imagen = Image.open(io.BytesIO(imagen_bytes))
+    tamano_original = imagen.size
+    if not reducida:
+        return imagen.convert("RGB"), tamano_original
+
+    objetivo = TAMANO_ENTRADA * FACTOR_PREREDUCCION
+    if imagen.format == "JPEG":
+        # Elige la mayor escala DCT que mantiene ambos lados >= objetivo
+        imagen.draft("RGB", (objetivo, objetivo))
+    imagen = imagen.convert("RGB")
+    factor = min(imagen.size) // objetivo
+    if factor >= 2:
+        imagen = imagen.reduce(factor)
+    return imagen, tamano_original
+
+
+def comparar_decodificacion(imagen_bytes, procesador):
+    """Compara el tensor preprocesado con y sin decodificación reducida"""
+    completa, _ = decodificar_imagen(imagen_bytes, reducida=False)
+    reducida, _ = decodificar_imagen(imagen_bytes, reducida=True)
+    diferencia = (procesador(completa) - procesador(reducida)).abs()
+    media = float(diferencia.mean())
+    return {
+        "tamano_decodificado": f"{reducida.size[0]}x{reducida.size[1]}",
+        "diferencia_media": round(media, 5),
+        "diferencia_maxima": round(float(diferencia.max()), 5),
+        "dentro_tolerancia": media <= TOLERANCIA_DECODIFICACION,
+    }
+
+
+def obtener_embedding_imagen(imagen_bytes, m, tiempos=None):
+    """
+    Devuelve (embedding normalizado, tamaño original, desde_cache) de una imagen.
+    Solo decodifica y pasa por el planificador de lotes si no está en la caché.
+    Si se pasa 'tiempos', se rellenan los milisegundos de cada etapa.
+    """
+    if tiempos is None:
+        tiempos = {}
+
+    clave = cache_imagenes.clave(imagen_bytes)
+    entrada = cache_imagenes.obtener(clave)
+    if entrada is not None:
+        return entrada["embedding"], entrada["tamano"], True
+
+    with medir(tiempos, "decodificacion"):
+        imagen, tamano = decodificar_imagen(imagen_bytes)
+    with medir(tiempos, "preprocesado"):
+        imagen_procesada = m["procesador"](imagen)
+    with medir(tiempos, "inferencia"):
+        embedding = planificador_imagenes.ejecutar(imagen_procesada, prioridad_hilo())
+    cache_imagenes.guardar(clave, {"embedding": embedding, "tamano": tamano})
+    return embedding, tamano, False
+
+
+# =============================================================================
+# EJECUCIÓN FUERA DEL BUCLE DE EVENTOS
+# =============================================================================
+
+# La carga del modelo y la inferencia son CPU-bound y bloqueantes: se ejecutan en
+# pools dedicados para que /api/health y /estado sigan respondiendo al instante
+_ejecutor_inferencia = ThreadPoolExecutor(max_workers=INFERENCIA_CONCURRENCIA, thread_name_prefix="inferencia")
+_ejecutor_carga = ThreadPoolExecutor(max_workers=2, thread_name_prefix="carga-modelo")
+# Con DECODIFICACION_HILOS=0 (menos de 4 CPUs por worker) el lote se decodifica en el hilo de
+# inferencia; el pool queda con un hilo para extraer ZIPs
+_ejecutor_decodificacion = ThreadPoolExecutor(max_workers=max(1, DECODIFICACION_HILOS), thread_name_prefix="decodificacion")
+
+
+admision = ControlAdmision(
+    INFERENCIA_CONCURRENCIA, ADMISION_COLA_MAX, ADMISION_ESPERA_MAX_S,
+    pesos=PRIORIDAD_PESOS,
+    # Por defecto los trabajos masivos no ocupan más de la mitad de los hilos
+    limites={"masiva": max(1, INFERENCIA_CONCURRENCIA // 2), **PRIORIDAD_LIMITES}
+)
+
+# Clase de prioridad del análisis que ejecuta cada hilo del pool (la lee el planificador de lotes)
+_contexto_hilo = threading.local()
+
+
+def prioridad_hilo():
+    """Orden de prioridad (0 = más urgente) del análisis en curso en este hilo"""
+    return PRIORIDADES.index(getattr(_contexto_hilo, "prioridad", "interactiva"))
+
+
+class ServicioSaturado(HTTPException):
+    """429 con Retry-After calculado a partir de la tasa de servicio observada"""
+
+    def __init__(self, detalle, retry_after):
+        super().__init__(status_code=429, detail=detalle, headers={"Retry-After": str(retry_after)})
+
+
+async def ejecutar_inferencia(funcion, *args, prioridad="interactiva", esperar=False, unidades=1,
+                              registrar_metricas=True, **kwargs):
+    """
+    Ejecuta una función bloqueante en el pool de inferencia, tras pasar el control
+    de admisión en la clase de prioridad indicada. Devuelve (resultado, segundos de espera en cola).
+    Con esperar=True (trabajos internos) se espera turno sin riesgo de 429. 'unidades' es el
+    nº de imágenes que analiza la función (para la tasa de servicio por imagen); con
+    registrar_metricas=False (análisis perfilados) la espera y la ejecución no van a /metrics.
+    """
+    try:
+        espera = await admision.entrar(prioridad=prioridad, esperar=esperar)
+    except ColaLlena as e:
+        raise ServicioSaturado(str(e), e.retry_after)
+
+    def tarea():
+        _contexto_hilo.prioridad = prioridad
+        return funcion(*args, **kwargs)
+
+    if registrar_metricas:
+        metricas.ESPERA_COLA.labels(prioridad).observe(espera)
+    inicio = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    futuro = loop.run_in_executor(_ejecutor_inferencia, tarea)
+
+    def terminar(f):
+        # El hueco se libera cuando termina el hilo, no cuando se va el cliente: si la
+        # petición se cancela, el análisis sigue ocupando el pool hasta acabar
+        duracion = time.perf_counter() - inicio
+        admision.salir(prioridad, duracion, espera, unidades)
+        if registrar_metricas:
+            metricas.EJECUCION.labels(prioridad).observe(duracion)
+        if not f.cancelled():
+            f.exception()  # marca la excepción como recogida si ya nadie la espera
+
+    futuro.add_done_callback(terminar)
+    resultado = await asyncio.shield(futuro)
+    return resultado, espera
+
+
+def comprobar_admision(prioridad="interactiva"):
+    """Rechaza de inmediato (429) si la cola de inferencia está llena para la clase"""
+    try:
+        admision.comprobar(prioridad)
+    except ColaLlena as e:
+        raise ServicioSaturado(str(e), e.retry_after)
+
+
+async def precargar_modelos():
+    """Carga en segundo plano los modelos indicados por PRECARGA_MODELOS"""
+    if PRECARGA_MODELOS in ("", "none", "ninguno"):
+        return
+    tipos = ["biomedclip", "biovil"] if PRECARGA_MODELOS in ("all", "todos") else [PRECARGA_MODELOS]
+    for tipo in tipos:
+        if tipo not in modelos_cargados:
+            print(f"⚠️ PRECARGA_MODELOS: modelo '{tipo}' desconocido")
+            continue
+        print(f"⏳ Precarga en segundo plano: {tipo}")
+        await ejecutar_carga(cargar_modelo, tipo, True)
+
+
+async def ejecutar_carga(funcion, *args):
+    """Ejecuta una operación de carga/liberación de modelo fuera del bucle de eventos"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ejecutor_carga, funcion, *args)
+
+
+# =============================================================================
+# VARIOS WORKERS: PESOS COMPARTIDOS COPY-ON-WRITE
+# =============================================================================
+
+def precargar_en_maestro():
+    """
+    Con gunicorn --preload (gunicorn.conf.py), carga los pesos de BiomedCLIP y los
+    embeddings de los catálogos en el proceso maestro antes del fork. Los workers
+    heredan esas páginas y las comparten mientras nadie las escriba (los pesos están
+    en modo eval y sin gradientes). En el maestro no se ejecuta inferencia ni se crean
+    pools de hilos: OpenMP y ONNX Runtime no sobreviven al fork.
+    """
+    global _carga_en_maestro, pesos_heredados
+
+    inicio = time.time()
+    mapear_embeddings_persistidos()
+    _carga_en_maestro = True
+    try:
+        if not cargar_modelo("biomedclip"):
+            print("⚠️ Precarga en el maestro fallida: cada worker cargará su propia copia")
+            return False
+    finally:
+        _carga_en_maestro = False
+
+    if PESOS_MEMORIA_COMPARTIDA:
+        # Mueve los pesos a memoria compartida (/dev/shm): ni una escritura accidental
+        # los duplica. Requiere un /dev/shm mayor que el modelo (en Docker, --shm-size)
+        modelos_cargados["biomedclip"]["modelo"].share_memory()
+    _devolver_memoria_so()
+    # Saca del GC los objetos ya creados: sus recorridos no tocarán (ni copiarán) esas páginas
+    gc.freeze()
+    pesos_heredados = True
+    rss = memoria_rss_mb()
+    print(f"🧬 Pesos precargados en el maestro en {time.time() - inicio:.1f}s"
+          + (f" (RSS {rss:.0f} MB)" if rss is not None else "") + "; los workers los compartirán tras el fork")
+    return True
+
+
+def preparar_worker():
+    """En cada worker, tras el fork: hilos propios, motor de visión y calentamiento"""
     m = modelos_cargados["biomedclip"]
-    modelo = m["modelo"]
-    procesador = m["procesador"]
-    tokenizer = m["tokenizer"]
+    if m["modelo"] is None:
+        return
+    aplicar_hilos_torch(HILOS_INTRA_OP, HILOS_INTER_OP)
+    preparar_motor_proceso(m, calentar=PRECARGA_MODELOS not in ("", "none", "ninguno"))
+    residencia.registrar_carga("biomedclip")
+    print(f"🧬 Worker {os.getpid()} listo sobre los pesos heredados (motor {m['motor'].nombre})")
 
-    imagen = Image.open(io.BytesIO(imagen_bytes)).convert("RGB")
-    imagen_procesada = procesador(imagen).unsqueeze(0)
-    
-    if organo_filtro and organo_filtro in CATEGORIAS_FORENSES:
-        diagnosticos = []
-        data = CATEGORIAS_FORENSES[organo_filtro]
-        for diag in data["diagnosticos"]:
-            diagnosticos.append({
-                "organo": organo_filtro,
-                "organo_nombre": data["nombre"],
-                **diag
-            })
-    else:
-        diagnosticos = obtener_todos_diagnosticos()
-    
-    template = "this is a histopathology image showing "
-    textos = [template + d["texto"] for d in diagnosticos]
-    
+
+# =============================================================================
+# EMBEDDINGS DE TEXTO DE LOS CATÁLOGOS
+# =============================================================================
+
+def _definicion_catalogo(nombre):
+    """Devuelve (diagnósticos, plantilla) del catálogo 'forense' o 'radiografia'"""
+    if nombre == "forense":
+        return obtener_todos_diagnosticos(), PLANTILLA_HISTOLOGIA
+    if nombre == "radiografia":
+        return obtener_todos_diagnosticos_radiografia(), PLANTILLA_RADIOGRAFIA
+    raise ValueError(f"Catálogo desconocido: {nombre}")
+
+
+def huella_catalogo(plantilla, textos):
+    """Hash del modelo, la plantilla y los textos de los prompts (versión del catálogo)"""
+    h = hashlib.sha256()
+    h.update(MODELO_BIOMEDCLIP_HUB.encode("utf-8"))
+    h.update(b"\0" + plantilla.encode("utf-8"))
+    for texto in textos:
+        h.update(b"\0" + texto.encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def tokenizar_textos(tokenizer, textos):
+    """Tokeniza los prompts con el wrapper de open_clip (con alternativa manual)"""
     try:
-        tokens = tokenizer(textos)
+        return tokenizer(textos)
     except Exception as e:
         print(f"⚠️ Error en tokenización estándar: {e}")
         # Intento manual si el wrapper de open_clip falla
         if hasattr(tokenizer, 'tokenizer'):
-            tokens = tokenizer.tokenizer(textos, padding=True, truncation=True, return_tensors="pt")["input_ids"]
-        else:
-            raise e
+            return tokenizer.tokenizer(textos, padding=True, truncation=True, return_tensors="pt")["input_ids"]
+        raise
+
+
+def obtener_embeddings_catalogo(nombre, m=None):
+    """
+    Devuelve los embeddings de texto normalizados de un catálogo completo.
+    Se calculan una sola vez y se reutilizan mientras no cambien el modelo,
+    la plantilla o los textos de los prompts.
+    'm' permite pasar un modelo aún no publicado (durante su propia carga).
+    """
+    diagnosticos, plantilla = _definicion_catalogo(nombre)
+    textos = [plantilla + d["texto"] for d in diagnosticos]
+    huella = huella_catalogo(plantilla, textos)
+
+    entrada = embeddings_catalogos.get(nombre)
+    if entrada is not None and entrada["huella"] == huella:
+        return entrada
+
+    with _lock_embeddings:
+        entrada = embeddings_catalogos.get(nombre)
+        if entrada is not None and entrada["huella"] == huella:
+            return entrada
+        matriz = _cargar_embeddings_disco(nombre, huella, diagnosticos)
+        if matriz is not None:
+            print(f"📚 Embeddings del catálogo '{nombre}' mapeados desde disco (huella {huella}).")
+            return _registrar_embeddings(nombre, huella, diagnosticos, matriz)
+
+    # La carga del modelo se espera fuera del lock para no bloquear a quien lo está cargando
+    if m is None:
+        if not cargar_modelo("biomedclip"):
+            raise Exception("No se pudo cargar el modelo BiomedCLIP")
+        m = modelos_cargados["biomedclip"]
+        if m["modelo"] is None:
+            raise Exception("El modelo BiomedCLIP se liberó durante el cálculo de embeddings")
+
+    with _lock_embeddings:
+        entrada = embeddings_catalogos.get(nombre)
+        if entrada is not None and entrada["huella"] == huella:
+            return entrada
+        matriz = _calcular_embeddings_texto(textos, m)
+        _guardar_embeddings_disco(nombre, huella, plantilla, diagnosticos, matriz)
+        print(f"📚 Embeddings del catálogo '{nombre}' calculados ({len(textos)} prompts, huella {huella}).")
+        return _registrar_embeddings(nombre, huella, diagnosticos, matriz)
+
+
+def _registrar_embeddings(nombre, huella, diagnosticos, matriz):
+    indices_por_organo = {}
+    for i, d in enumerate(diagnosticos):
+        indices_por_organo.setdefault(d["organo"], []).append(i)
+
+    entrada = {
+        "huella": huella,
+        "matriz": matriz,
+        "diagnosticos": diagnosticos,
+        "indices_por_organo": indices_por_organo,
+    }
+    embeddings_catalogos[nombre] = entrada
+    return entrada
+
+
+def mapear_embeddings_persistidos():
+    """Mapea al arrancar los catálogos ya persistidos (sin cargar el modelo)"""
+    for nombre in ("forense", "radiografia"):
+        diagnosticos, plantilla = _definicion_catalogo(nombre)
+        huella = huella_catalogo(plantilla, [plantilla + d["texto"] for d in diagnosticos])
+        ruta_npy, _ = _rutas_embeddings(nombre, huella)
+        if os.path.exists(ruta_npy):
+            obtener_embeddings_catalogo(nombre)
+
+
+def _calcular_embeddings_texto(textos, m):
+    """Ejecuta el codificador de texto sobre los prompts y normaliza los embeddings"""
+    import torch
+    import numpy as np
+
+    modelo_texto = m["modelo"]
+    temporal = getattr(modelo_texto, "text", None) is None
+    if temporal:
+        modelo_texto = _cargar_modelo_texto()
+
+    try:
+        with metricas.Cronometro(metricas.ETAPAS.labels("catalogo", "tokenizacion")):
+            tokens = tokenizar_textos(m["tokenizer"], textos)
+        with metricas.Cronometro(metricas.ETAPAS.labels("catalogo", "codificacion_texto")), torch.no_grad():
+            text_features = modelo_texto.encode_text(tokens)
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        return text_features.cpu().numpy().astype(np.float32)
+    finally:
+        if temporal:
+            del modelo_texto
+            _devolver_memoria_so()
+
+
+def _rutas_embeddings(nombre, huella):
+    base = os.path.join(DIRECTORIO_EMBEDDINGS, f"catalogo_{nombre}_{huella}")
+    return base + ".npy", base + ".json"
+
+
+def _cargar_embeddings_disco(nombre, huella, diagnosticos):
+    """
+    Mapea en memoria (mmap, solo lectura) la matriz persistida del catálogo.
+    Los workers que abren el mismo fichero comparten las páginas del page cache.
+    Devuelve None si no existe o no coincide con el catálogo actual.
+    """
+    import numpy as np
+
+    ruta_npy, ruta_manifiesto = _rutas_embeddings(nombre, huella)
+    if not (os.path.exists(ruta_npy) and os.path.exists(ruta_manifiesto)):
+        return None
+    try:
+        with open(ruta_manifiesto, encoding="utf-8") as f:
+            manifiesto = json.load(f)
+        if manifiesto.get("huella") != huella or manifiesto.get("ids") != [d["id"] for d in diagnosticos]:
+            print(f"⚠️ Manifiesto de embeddings '{nombre}' desactualizado, se recalculará.")
+            return None
+        matriz = np.load(ruta_npy, mmap_mode="r")
+        if matriz.shape != (len(diagnosticos), manifiesto.get("dimension")):
+            print(f"⚠️ Dimensiones inesperadas en {ruta_npy}, se recalculará.")
+            return None
+        return matriz
+    except Exception as e:
+        print(f"⚠️ Error leyendo embeddings persistidos de '{nombre}': {e}")
+        return None
+
+
+def _guardar_embeddings_disco(nombre, huella, plantilla, diagnosticos, matriz):
+    """Escribe la matriz (.npy) y el manifiesto JSON de forma atómica"""
+    import numpy as np
+
+    ruta_npy, ruta_manifiesto = _rutas_embeddings(nombre, huella)
+    manifiesto = {
+        "catalogo": nombre,
+        "huella": huella,
+        "modelo": MODELO_BIOMEDCLIP_HUB,
+        "plantilla": plantilla,
+        "dimension": int(matriz.shape[1]),
+        "ids": [d["id"] for d in diagnosticos],
+        "creado": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        os.makedirs(DIRECTORIO_EMBEDDINGS, exist_ok=True)
+        sufijo = f".{os.getpid()}.tmp"
+        with open(ruta_npy + sufijo, "wb") as f:
+            np.save(f, np.ascontiguousarray(matriz, dtype=np.float32))
+        with open(ruta_manifiesto + sufijo, "w", encoding="utf-8") as f:
+            json.dump(manifiesto, f, ensure_ascii=False, indent=2)
+        os.replace(ruta_npy + sufijo, ruta_npy)
+        os.replace(ruta_manifiesto + sufijo, ruta_manifiesto)
+    except OSError as e:
+        print(f"⚠️ No se pudieron persistir los embeddings de '{nombre}': {e}")
+
+
+def construir_embeddings_catalogos():
+    """Paso de construcción: calcula y persiste los embeddings de todos los catálogos"""
+    if not cargar_modelo("biomedclip"):
+        raise Exception("No se pudo cargar el modelo BiomedCLIP")
+    m = modelos_cargados["biomedclip"]
+    for nombre in ("forense", "radiografia"):
+        diagnosticos, plantilla = _definicion_catalogo(nombre)
+        textos = [plantilla + d["texto"] for d in diagnosticos]
+        huella = huella_catalogo(plantilla, textos)
+        matriz = _calcular_embeddings_texto(textos, m)
+        _guardar_embeddings_disco(nombre, huella, plantilla, diagnosticos, matriz)
+        ruta_npy, _ = _rutas_embeddings(nombre, huella)
+        print(f"✅ {nombre}: {matriz.shape[0]} prompts → {ruta_npy}")
+
+
+def puntuar_embedding(image_features, matriz, logit_scale):
+    """Softmax de la similitud coseno escalada entre una imagen y un conjunto de prompts"""
+    return softmax(logit_scale * (matriz @ image_features))
+
+
+def softmax(logits):
+    """Softmax numéricamente estable de un vector de logits"""
+    import numpy as np
+
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+
+def analizar_imagen(imagen_bytes: bytes, organo_filtro: str = None, tiempos: dict = None) -> dict:
+    """
+    Analiza una imagen histológica con BiomedCLIP usando clasificación zero-shot.
+    """
+    with residencia.usar("biomedclip"):
+        if not cargar_modelo("biomedclip"):
+            raise Exception("No se pudo cargar el modelo BiomedCLIP")
     
-    inicio = time.time()
-    with torch.no_grad():
-        image_features = modelo.encode_image(imagen_procesada)
-        text_features = modelo.encode_text(tokens)
-        
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        
-        logit_scale = modelo.logit_scale.exp()
-        logits = (logit_scale * image_features @ text_features.T).softmax(dim=-1)
-        
+        m = modelos_cargados["biomedclip"]
+        tiempos = {} if tiempos is None else tiempos
+        inicio = time.time()
+        image_features, tamano, desde_cache = obtener_embedding_imagen(imagen_bytes, m, tiempos)
+        return resultado_histologia(image_features, tamano, desde_cache, organo_filtro, m, tiempos, inicio)
+
+
+def resultado_histologia(image_features, tamano, desde_cache, organo_filtro, m, tiempos, inicio,
+                         registrar_metricas=True):
+    """
+    Puntúa un embedding de imagen contra el catálogo forense y formatea la respuesta.
+    registrar_metricas=False deja fuera de /metrics los tiempos (p. ej. de un análisis perfilado).
+    """
+    import numpy as np
+
+    catalogo = obtener_embeddings_catalogo("forense")
+    if organo_filtro and organo_filtro in CATEGORIAS_FORENSES:
+        indices = catalogo["indices_por_organo"][organo_filtro]
+        diagnosticos = [catalogo["diagnosticos"][i] for i in indices]
+        text_features = catalogo["matriz"][indices]
+    else:
+        diagnosticos = catalogo["diagnosticos"]
+        text_features = catalogo["matriz"]
+
+    with medir(tiempos, "puntuacion"):
+        probabilidades = puntuar_embedding(image_features, text_features, m["escala_logit"])
     tiempo_inferencia = time.time() - inicio
-    
-    probabilidades = logits[0].numpy()
+    inicio_formato = time.perf_counter()
     indices_ordenados = np.argsort(probabilidades)[::-1]
     
-    resultados = []
-    for idx in indices_ordenados:
-        prob = float(probabilidades[idx])
-        diag = diagnosticos[idx]
-        resultados.append({
-            "diagnostico_id": diag["id"],
-            "diagnostico": diag["nombre_es"],
-            "descripcion": diag["descripcion"],
-            "organo": diag["organo_nombre"],
-            "probabilidad": round(prob * 100, 1),
-            "hallazgos": diag.get("hallazgos", []),
-            "info_adicional": {
-                k: v for k, v in diag.items() 
-                if k not in ["id", "texto", "nombre_es", "descripcion", "hallazgos", "organo", "organo_nombre"]
-            }
-        })
+    resultados = [formatear_diagnostico(diagnosticos[idx], probabilidades[idx]) for idx in indices_ordenados]
     
     principal = resultados[0]
-    confianza = "alta" if principal["probabilidad"] > 50 else "media" if principal["probabilidad"] > 30 else "baja"
+    confianza = nivel_confianza(principal["probabilidad"])
+    tiempos["formato"] = round((time.perf_counter() - inicio_formato) * 1000, 2)
+    if registrar_metricas:
+        metricas.registrar_tiempos("histologia", tiempos)
     
     return {
         "diagnostico_principal": principal,
@@ -982,10 +2114,231 @@ def analizar_imagen(imagen_bytes: bytes, organo_filtro: str = None) -> dict:
         "todos_los_diagnosticos": resultados,
         "confianza": confianza,
         "tiempo_analisis": f"{tiempo_inferencia:.2f}s",
-        "tamano_imagen": f"{imagen.size[0]}x{imagen.size[1]}",
+        "tiempos_etapas_ms": tiempos,
+        "tamano_imagen": f"{tamano[0]}x{tamano[1]}",
         "modelo": "BiomedCLIP (Microsoft)",
         "tipo_clasificacion": "Zero-shot",
-        "num_categorias_evaluadas": len(diagnosticos)
+        "num_categorias_evaluadas": len(diagnosticos),
+        "desde_cache": desde_cache
+    }
+
+
+def formatear_diagnostico(diag, prob):
+    """Entrada de la respuesta para un diagnóstico forense con su probabilidad (0-1)"""
+    return {
+        "diagnostico_id": diag["id"],
+        "diagnostico": diag["nombre_es"],
+        "descripcion": diag["descripcion"],
+        "organo": diag["organo_nombre"],
+        "probabilidad": round(float(prob) * 100, 1),
+        "hallazgos": diag.get("hallazgos", []),
+        "info_adicional": {
+            k: v for k, v in diag.items() 
+            if k not in ["id", "texto", "nombre_es", "descripcion", "hallazgos", "organo", "organo_nombre"]
+        }
+    }
+
+
+def nivel_confianza(probabilidad):
+    """Confianza cualitativa a partir de la probabilidad (en %) del diagnóstico principal"""
+    return "alta" if probabilidad > 50 else "media" if probabilidad > 30 else "baja"
+
+
+# =============================================================================
+# PANEL COMPLETO EN UNA PASADA
+# =============================================================================
+
+def analizar_imagen_panel(imagen_bytes: bytes, tiempos: dict = None) -> dict:
+    """
+    Analiza una imagen contra todas las categorías forenses a la vez: un solo
+    encode_image y un solo producto contra la matriz completa del catálogo.
+    """
+    with residencia.usar("biomedclip"):
+        if not cargar_modelo("biomedclip"):
+            raise Exception("No se pudo cargar el modelo BiomedCLIP")
+
+        m = modelos_cargados["biomedclip"]
+        tiempos = {} if tiempos is None else tiempos
+        inicio = time.time()
+        image_features, tamano, desde_cache = obtener_embedding_imagen(imagen_bytes, m, tiempos)
+        return resultado_panel(image_features, tamano, desde_cache, m, tiempos, inicio)
+
+
+def resultado_panel(image_features, tamano, desde_cache, m, tiempos, inicio, top_categoria=3):
+    """
+    Softmax global sobre todo el catálogo y, reutilizando los mismos logits, una
+    softmax por categoría (equivalente a /analizar/{categoria} para cada una). Cada
+    entrada por categoría lleva también su probabilidad en la softmax global.
+    """
+    import numpy as np
+
+    catalogo = obtener_embeddings_catalogo("forense")
+    diagnosticos = catalogo["diagnosticos"]
+    with medir(tiempos, "puntuacion"):
+        logits = m["escala_logit"] * (catalogo["matriz"] @ image_features)
+        probabilidades = softmax(logits)
+        por_categoria = {}
+        for organo, indices in catalogo["indices_por_organo"].items():
+            por_categoria[organo] = (indices, softmax(logits[indices]))
+    tiempo_inferencia = time.time() - inicio
+
+    inicio_formato = time.perf_counter()
+    orden_global = np.argsort(probabilidades)[::-1]
+    todos_global = [formatear_diagnostico(diagnosticos[i], probabilidades[i]) for i in orden_global]
+    principales = todos_global[:5]
+
+    categorias = {}
+    for organo, (indices, probs) in por_categoria.items():
+        orden = np.argsort(probs)[::-1]
+        resultados = [
+            {**formatear_diagnostico(diagnosticos[indices[i]], probs[i]),
+             "probabilidad_global": round(float(probabilidades[indices[i]]) * 100, 1)}
+            for i in orden
+        ]
+        categorias[organo] = {
+            "nombre": CATEGORIAS_FORENSES[organo]["nombre"],
+            "diagnostico_principal": resultados[0],
+            "diagnosticos_alternativos": resultados[1:top_categoria],
+            "todos_los_diagnosticos": resultados,
+            "confianza": nivel_confianza(resultados[0]["probabilidad"]),
+            # Probabilidad global acumulada por los diagnósticos de la categoría
+            "probabilidad_global": round(float(probabilidades[indices].sum()) * 100, 1),
+        }
+    tiempos["formato"] = round((time.perf_counter() - inicio_formato) * 1000, 2)
+    metricas.registrar_tiempos("panel", tiempos)
+
+    return {
+        "diagnostico_principal": principales[0],
+        "diagnosticos_alternativos": principales[1:5],
+        "todos_los_diagnosticos": todos_global,
+        "confianza": nivel_confianza(principales[0]["probabilidad"]),
+        "categorias": categorias,
+        "tiempo_analisis": f"{tiempo_inferencia:.2f}s",
+        "tiempos_etapas_ms": tiempos,
+        "tamano_imagen": f"{tamano[0]}x{tamano[1]}",
+        "modelo": "BiomedCLIP (Microsoft)",
+        "tipo_clasificacion": "Zero-shot",
+        "num_categorias_evaluadas": len(diagnosticos),
+        "desde_cache": desde_cache
+    }
+
+
+# =============================================================================
+# PERFILADO BAJO DEMANDA
+# =============================================================================
+
+ARCHIVOS_TRAZA = ("torch_trace.json", "operadores.txt", "cprofile.prof", "cprofile.txt")
+
+
+def comprobar_token_admin(token):
+    """403 si el perfilado está desactivado o el token no coincide"""
+    if not PERFILADO_TOKEN:
+        raise HTTPException(status_code=403, detail="Perfilado desactivado (defina PERFILADO_TOKEN)")
+    if not token or not hmac.compare_digest(token, PERFILADO_TOKEN):
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+
+
+# El perfilador de torch es global al proceso: un solo análisis perfilado a la vez
+_perfilado_lock = threading.Lock()
+
+
+def analizar_con_perfilado(imagen_bytes, modalidad="histologia", organo_filtro=None, tiempos=None):
+    """
+    Análisis de una imagen bajo torch.profiler y cProfile. Sin caché ni planificador de
+    lotes: decodificación, preprocesado y encode_image se ejecutan en este hilo para que
+    el perfil recoja sus operadores. La traza se guarda en DIRECTORIO_TRAZAS. Sus tiempos,
+    inflados por cProfile, no entran en las métricas de /metrics. 409 si ya hay otro en curso.
+    """
+    if not _perfilado_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ya hay un análisis perfilado en curso; reintente más tarde")
+    try:
+        return _analizar_con_perfilado(imagen_bytes, modalidad, organo_filtro, tiempos)
+    finally:
+        _perfilado_lock.release()
+
+
+def _analizar_con_perfilado(imagen_bytes, modalidad, organo_filtro, tiempos):
+    import cProfile
+    from torch.profiler import profile, record_function, ProfilerActivity
+
+    tipos = ("biovil", "biomedclip") if modalidad == "radiografia" else ("biomedclip",)
+    with residencia.usar(*tipos):
+        if not cargar_modelo(tipos[0]):
+            raise Exception("No se pudo cargar el modelo BiomedCLIP")
+        m = modelos_cargados["biomedclip"]
+        tiempos = {} if tiempos is None else tiempos
+        inicio = time.time()
+
+        perfil_python = cProfile.Profile()
+        with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as perfil_torch:
+            perfil_python.enable()
+            try:
+                with record_function("decodificacion_pil"), medir(tiempos, "decodificacion"):
+                    imagen, tamano = decodificar_imagen(imagen_bytes)
+                with record_function("preprocesado"), medir(tiempos, "preprocesado"):
+                    tensor = m["procesador"](imagen)
+                with record_function("encode_image"), medir(tiempos, "inferencia"):
+                    # Directo al motor: el lote perfilado no cuenta en los histogramas de lotes
+                    embedding = m["motor"].codificar([tensor])[0]
+            finally:
+                perfil_python.disable()
+
+        if modalidad == "radiografia":
+            resultado = resultado_radiografia(embedding, tamano, False, m, tiempos, inicio, registrar_metricas=False)
+        else:
+            resultado = resultado_histologia(embedding, tamano, False, organo_filtro, m, tiempos, inicio,
+                                             registrar_metricas=False)
+    resultado["perfilado"] = guardar_traza(perfil_torch, perfil_python)
+    return resultado
+
+
+def podar_trazas():
+    """Conserva solo las TRAZAS_MAX trazas más recientes (el id empieza por la fecha)"""
+    import shutil
+
+    if TRAZAS_MAX <= 0:
+        return
+    trazas = sorted(
+        nombre for nombre in os.listdir(DIRECTORIO_TRAZAS)
+        if os.path.isdir(os.path.join(DIRECTORIO_TRAZAS, nombre))
+    )
+    for nombre in trazas[:-TRAZAS_MAX]:
+        shutil.rmtree(os.path.join(DIRECTORIO_TRAZAS, nombre), ignore_errors=True)
+        print(f"🗑️ Traza de perfilado antigua eliminada: {nombre}")
+
+
+def guardar_traza(perfil_torch, perfil_python):
+    """Escribe la traza Chrome, las tablas de operadores/funciones y el volcado de cProfile"""
+    import pstats
+    import uuid
+
+    traza_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    directorio = os.path.join(DIRECTORIO_TRAZAS, traza_id)
+    os.makedirs(directorio, exist_ok=True)
+
+    perfil_torch.export_chrome_trace(os.path.join(directorio, "torch_trace.json"))
+    operadores = sorted(perfil_torch.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)
+    with open(os.path.join(directorio, "operadores.txt"), "w") as f:
+        f.write(perfil_torch.key_averages().table(sort_by="self_cpu_time_total", row_limit=50))
+
+    perfil_python.dump_stats(os.path.join(directorio, "cprofile.prof"))
+    with open(os.path.join(directorio, "cprofile.txt"), "w") as f:
+        pstats.Stats(perfil_python, stream=f).sort_stats("cumulative").print_stats(60)
+
+    print(f"🩺 Traza de perfilado guardada en {directorio}")
+    podar_trazas()
+    return {
+        "id": traza_id,
+        "archivos": {nombre: f"/trazas/{traza_id}/{nombre}" for nombre in ARCHIVOS_TRAZA},
+        "operadores_principales": [
+            {
+                "operador": e.key,
+                "llamadas": e.count,
+                "cpu_propio_ms": round(e.self_cpu_time_total / 1000, 3),
+                "cpu_total_ms": round(e.cpu_time_total / 1000, 3),
+            }
+            for e in operadores[:15]
+        ],
     }
 
 
@@ -1008,8 +2361,22 @@ async def lifespan(app: FastAPI):
     print("📋 Documentación API: http://localhost:8000/docs")
     print(f"📊 Categorías forenses: {list(CATEGORIAS_FORENSES.keys())}")
     print(f"🩻 Categorías radiografía: {list(CATEGORIAS_RADIOGRAFIA.keys())}")
+    mapear_embeddings_persistidos()
+    residencia.iniciar()
+    if pesos_heredados:
+        await ejecutar_carga(preparar_worker)
+    tarea_precarga = asyncio.create_task(precargar_modelos())
+    trabajadores = iniciar_trabajadores()
     yield
+    for tarea in trabajadores:
+        tarea.cancel()
+    tarea_precarga.cancel()
+    residencia.detener()
+    _ejecutor_inferencia.shutdown(wait=False, cancel_futures=True)
+    planificador_imagenes.detener()
     liberar_modelo("todas")
+    _ejecutor_carga.shutdown(wait=False)
+    _ejecutor_decodificacion.shutdown(wait=False, cancel_futures=True)
     print("👋 Servidor cerrado")
 
 
@@ -1086,11 +2453,17 @@ async def obtener_estado():
     
     # BiomedCLIP status
     cargado_biomed = modelos_cargados["biomedclip"]["modelo"] is not None
+    solo_vision = cargado_biomed and getattr(modelos_cargados["biomedclip"]["modelo"], "text", None) is None
+    consumo = ("~0.9 GB" if solo_vision else "~1.5 GB") if cargado_biomed else "0 GB"
     status["biomedclip"] = {
         "cargado": cargado_biomed,
+        "carga": resumen_estado_modelo("biomedclip"),
         "nombre": "BiomedCLIP (Microsoft)",
         "tipo": "Zero-Shot Classification - Forense",
-        "consumo_ram": "~1.5 GB" if cargado_biomed else "0 GB",
+        "consumo_ram": consumo,
+        "modo_solo_vision": solo_vision,
+        "motor_vision": modelos_cargados["biomedclip"]["motor"].nombre if cargado_biomed else None,
+        "paridad_motor": modelos_cargados["biomedclip"].get("paridad_motor") if cargado_biomed else None,
         "num_categorias": len(CATEGORIAS_FORENSES),
         "num_diagnosticos": sum(len(data["diagnosticos"]) for data in CATEGORIAS_FORENSES.values())
     }
@@ -1099,13 +2472,24 @@ async def obtener_estado():
     cargado_biovil = cargado_biomed or modelos_cargados["biovil"]["modelo"] is not None
     status["biovil"] = {
         "cargado": cargado_biovil,
+        "carga": resumen_estado_modelo("biovil"),
         "nombre": "BioViL-T (Microsoft)",
         "tipo": "Zero-Shot Classification - Radiografía de Tórax",
-        "consumo_ram": "~1.5 GB" if cargado_biovil else "0 GB",
+        "consumo_ram": consumo if cargado_biovil else "0 GB",
         "num_categorias": len(CATEGORIAS_RADIOGRAFIA),
         "num_diagnosticos": sum(len(data["diagnosticos"]) for data in CATEGORIAS_RADIOGRAFIA.values())
     }
     
+    status["planificador"] = planificador_imagenes.resumen()
+    status["residencia"] = residencia.resumen()
+    status["cache_imagenes"] = cache_imagenes.resumen()
+    status["admision"] = admision.resumen()
+    status["topologia_cpu"] = TOPOLOGIA_CPU
+    rss = memoria_rss_mb()
+    status["memoria_rss_mb"] = round(rss, 1) if rss is not None else None
+    status["memoria_desglose"] = memoria_compartida_mb()
+    status["worker"] = {"pid": os.getpid(), "pesos_heredados": pesos_heredados}
+    
     # Compatibilidad con formato antiguo (si el frontend no ha actualizado)
     # Esto devuelve el estado de biomedclip directamente en la raíz del JSON
     # para clientes que esperan el formato anterior de /estado
@@ -1161,7 +2545,7 @@ async def obtener_categoria(categoria: str):
 @app.post("/cargar-modelo")
 async def endpoint_cargar_modelo(modelo: str = "biomedclip"):
     """Carga un modelo específico en memoria"""
-    exito = cargar_modelo(modelo)
+    exito = await cargar_modelo_async(modelo)
     if exito:
         return {"exito": True, "mensaje": f"Modelo {modelo} cargado correctamente"}
     else:
@@ -1169,16 +2553,27 @@ async def endpoint_cargar_modelo(modelo: str = "biomedclip"):
 
 
 @app.post("/liberar-modelo")
-async def endpoint_liberar_modelo(modelo: str = "todas"):
-    """Libera un modelo específico o todos de la memoria"""
-    liberar_modelo(modelo)
+async def endpoint_liberar_modelo(modelo: str = "todas", diferido: bool = False):
+    """
+    Libera un modelo específico o todos de la memoria.
+    Con diferido=true solo se programa la liberación tras LIBERACION_DIFERIDA_S de inactividad.
+    """
+    if diferido:
+        residencia.sugerir_liberacion(modelo)
+        return {
+            "exito": True,
+            "mensaje": f"Liberación de {modelo} programada tras {LIBERACION_DIFERIDA_S:.0f}s de inactividad"
+        }
+    await ejecutar_carga(liberar_modelo, modelo)
     return {"exito": True, "mensaje": f"Modelo(s) {modelo} liberado(s) de memoria"}
 
 
 @app.post("/analizar")
-async def analizar(archivo: UploadFile = File(...)):
+async def analizar(archivo: UploadFile = File(...), perfilar: bool = False,
+                   x_token_admin: Optional[str] = Header(None)):
     """
     Analiza una imagen histológica buscando en TODAS las categorías forenses.
+    Con ?perfilar=true (y X-Token-Admin) devuelve además una traza de perfilado.
     """
     tipos_permitidos = ["image/jpeg", "image/png", "image/tiff", "image/jpg"]
     if archivo.content_type not in tipos_permitidos:
@@ -1186,23 +2581,35 @@ async def analizar(archivo: UploadFile = File(...)):
             status_code=400, 
             detail=f"Tipo de archivo no soportado: {archivo.content_type}. Use JPEG, PNG o TIFF."
         )
+    if perfilar:
+        comprobar_token_admin(x_token_admin)
     
     try:
-        contenido = await archivo.read()
-        resultado = analizar_imagen(contenido)
+        tiempos = {}
+        with medir(tiempos, "lectura"):
+            contenido = await archivo.read()
+        if perfilar:
+            resultado, espera = await ejecutar_inferencia(
+                analizar_con_perfilado, contenido, tiempos=tiempos, registrar_metricas=False)
+        else:
+            resultado, espera = await ejecutar_inferencia(analizar_imagen, contenido, tiempos=tiempos)
         
         return {
             "exito": True,
             "nombre_archivo": archivo.filename,
-            **resultado
+            **resultado,
+            "tiempo_espera_cola": f"{espera:.3f}s"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
 
 
 @app.post("/analizar/{categoria}")
-async def analizar_por_categoria(categoria: str, archivo: UploadFile = File(...)):
+async def analizar_por_categoria(categoria: str, archivo: UploadFile = File(...), perfilar: bool = False,
+                                 x_token_admin: Optional[str] = Header(None)):
     """
     Analiza una imagen buscando solo en diagnósticos de la categoría especificada.
     """
@@ -1218,18 +2625,61 @@ async def analizar_por_categoria(categoria: str, archivo: UploadFile = File(...)
             status_code=400, 
             detail=f"Tipo de archivo no soportado: {archivo.content_type}. Use JPEG, PNG o TIFF."
         )
+    if perfilar:
+        comprobar_token_admin(x_token_admin)
     
     try:
-        contenido = await archivo.read()
-        resultado = analizar_imagen(contenido, organo_filtro=categoria)
+        tiempos = {}
+        with medir(tiempos, "lectura"):
+            contenido = await archivo.read()
+        if perfilar:
+            resultado, espera = await ejecutar_inferencia(
+                analizar_con_perfilado, contenido, organo_filtro=categoria, tiempos=tiempos,
+                registrar_metricas=False)
+        else:
+            resultado, espera = await ejecutar_inferencia(analizar_imagen, contenido, organo_filtro=categoria, tiempos=tiempos)
         
         return {
             "exito": True,
             "nombre_archivo": archivo.filename,
             "filtro_categoria": categoria,
-            **resultado
+            **resultado,
+            "tiempo_espera_cola": f"{espera:.3f}s"
         }
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
+
+
+@app.post("/analizar-panel")
+async def analizar_panel(archivo: UploadFile = File(...)):
+    """
+    Analiza una imagen contra TODAS las categorías forenses en una sola pasada:
+    softmax global y softmax por categoría (como /analizar/{categoria} para cada una).
+    """
+    if archivo.content_type not in TIPOS_IMAGEN_PERMITIDOS:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Tipo de archivo no soportado: {archivo.content_type}. Use JPEG, PNG o TIFF."
+        )
+    
+    try:
+        tiempos = {}
+        with medir(tiempos, "lectura"):
+            contenido = await archivo.read()
+        resultado, espera = await ejecutar_inferencia(analizar_imagen_panel, contenido, tiempos=tiempos)
+        
+        return {
+            "exito": True,
+            "nombre_archivo": archivo.filename,
+            **resultado,
+            "tiempo_espera_cola": f"{espera:.3f}s"
+        }
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
 
@@ -1237,18 +2687,31 @@ async def analizar_por_categoria(categoria: str, archivo: UploadFile = File(...)
 @app.post("/analizar-y-liberar")
 async def analizar_y_liberar(archivo: UploadFile = File(...)):
     """
-    Analiza una imagen y luego libera el modelo de memoria.
+    Analiza una imagen y pide liberar el modelo. La liberación es una pista para el
+    gestor de residencia: se hace efectiva si no hay más análisis en LIBERACION_DIFERIDA_S.
     """
     try:
         resultado = await analizar(archivo)
-        liberar_modelo("biomedclip") # Solo liberar biomedclip si fue el usado
-        resultado["modelo_liberado"] = True
+        residencia.sugerir_liberacion("biomedclip") # Solo liberar biomedclip si fue el usado
+        resultado["modelo_liberado"] = False
+        resultado["liberacion_programada_s"] = LIBERACION_DIFERIDA_S
         return resultado
     except HTTPException:
-        liberar_modelo("biomedclip")
+        residencia.sugerir_liberacion("biomedclip")
         raise
 
 
+@app.get("/trazas/{traza_id}/{archivo}")
+async def descargar_traza(traza_id: str, archivo: str, x_token_admin: Optional[str] = Header(None)):
+    """Descarga un artefacto de una traza de perfilado (abrir torch_trace.json en Perfetto)"""
+    comprobar_token_admin(x_token_admin)
+    ruta = os.path.join(DIRECTORIO_TRAZAS, traza_id, archivo)
+    if (archivo not in ARCHIVOS_TRAZA or not traza_id.replace("-", "").isalnum()
+            or not os.path.isfile(ruta)):
+        raise HTTPException(status_code=404, detail="Traza no encontrada")
+    return FileResponse(ruta, filename=f"{traza_id}_{archivo}")
+
+
 # =============================================================================
 # CATEGORÍAS DIAGNÓSTICAS - RADIOGRAFÍAS DE TÓRAX
 # =============================================================================
@@ -1388,57 +2851,36 @@ def obtener_todos_diagnosticos_radiografia():
     return todos
 
 
-def analizar_imagen_radiografia(imagen_bytes: bytes) -> dict:
+def analizar_imagen_radiografia(imagen_bytes: bytes, tiempos: dict = None) -> dict:
     """
     Analiza una radiografía de tórax usando el motor BiomedCLIP optimizado con prompts de BioViL-T.
     """
-    import torch
-    import time
-    from PIL import Image
-    import numpy as np
-    import io
-
-    # BioViL-T usa el motor de BiomedCLIP para este despliegue
-    if not cargar_modelo("biovil"):
-        raise Exception("No se pudo cargar el motor para análisis de radiografías")
+    with residencia.usar("biovil", "biomedclip"):
+        # BioViL-T usa el motor de BiomedCLIP para este despliegue
+        if not cargar_modelo("biovil"):
+            raise Exception("No se pudo cargar el motor para análisis de radiografías")
     
-    m = modelos_cargados["biomedclip"]
-    modelo = m["modelo"]
-    procesador = m["procesador"]
-    tokenizer = m["tokenizer"]
+        m = modelos_cargados["biomedclip"]
+        tiempos = {} if tiempos is None else tiempos
+        inicio = time.time()
+        # Embedding normalizado (CRÍTICO para zero-shot), calculado en micro-lote
+        image_features, tamano, desde_cache = obtener_embedding_imagen(imagen_bytes, m, tiempos)
+        return resultado_radiografia(image_features, tamano, desde_cache, m, tiempos, inicio)
+
+
+def resultado_radiografia(image_features, tamano, desde_cache, m, tiempos, inicio, registrar_metricas=True):
+    """Puntúa un embedding de imagen contra el catálogo de radiografía y formatea la respuesta"""
+    import numpy as np
 
-    imagen = Image.open(io.BytesIO(imagen_bytes)).convert("RGB")
-    imagen_procesada = procesador(imagen).unsqueeze(0)
-    
     # Diagnósticos especializados para radiografía de tórax (BioViL-T style)
-    diagnosticos = obtener_todos_diagnosticos_radiografia()
-    template = "chest x-ray with "
-    textos = [template + d["texto"] for d in diagnosticos]
-    
-    try:
-        tokens = tokenizer(textos)
-    except Exception as e:
-        print(f"⚠️ Error en tokenización Rx: {e}")
-        if hasattr(tokenizer, 'tokenizer'):
-            tokens = tokenizer.tokenizer(textos, padding=True, truncation=True, return_tensors="pt")["input_ids"]
-        else:
-            raise e
-    
-    inicio = time.time()
-    with torch.no_grad():
-        image_features = modelo.encode_image(imagen_procesada)
-        text_features = modelo.encode_text(tokens)
-        
-        # Normalización (CRÍTICO para zero-shot)
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        
-        # Usar la escala aprendida del modelo
-        logit_scale = modelo.logit_scale.exp()
-        logits = (logit_scale * image_features @ text_features.T).softmax(dim=-1)
-        probabilidades = logits.cpu().numpy()[0]
-    
+    catalogo = obtener_embeddings_catalogo("radiografia")
+    diagnosticos = catalogo["diagnosticos"]
+
+    # Usar la escala aprendida del modelo
+    with medir(tiempos, "puntuacion"):
+        probabilidades = puntuar_embedding(image_features, catalogo["matriz"], m["escala_logit"])
     tiempo_inferencia = time.time() - inicio
+    inicio_formato = time.perf_counter()
     
     # Formatear resultados
     resultados = []
@@ -1461,6 +2903,9 @@ def analizar_imagen_radiografia(imagen_bytes: bytes) -> dict:
     
     principal = resultados[0]
     confianza = "alta" if principal["probabilidad"] > 50 else "media" if principal["probabilidad"] > 30 else "baja"
+    tiempos["formato"] = round((time.perf_counter() - inicio_formato) * 1000, 2)
+    if registrar_metricas:
+        metricas.registrar_tiempos("radiografia", tiempos)
     
     return {
         "diagnostico_principal": principal,
@@ -1468,17 +2913,21 @@ def analizar_imagen_radiografia(imagen_bytes: bytes) -> dict:
         "todos_los_diagnosticos": resultados,
         "confianza": confianza,
         "tiempo_analisis": f"{tiempo_inferencia:.2f}s",
-        "tamano_imagen": f"{imagen.size[0]}x{imagen.size[1]}",
+        "tiempos_etapas_ms": tiempos,
+        "tamano_imagen": f"{tamano[0]}x{tamano[1]}",
         "modelo": "BioViL-T (Microsoft)",
         "tipo_imagen": "Radiografía de tórax",
-        "num_categorias_evaluadas": len(diagnosticos)
+        "num_categorias_evaluadas": len(diagnosticos),
+        "desde_cache": desde_cache
     }
 
 
 @app.post("/analizar-radiografia")
-async def analizar_radiografia(archivo: UploadFile = File(...)):
+async def analizar_radiografia(archivo: UploadFile = File(...), perfilar: bool = False,
+                               x_token_admin: Optional[str] = Header(None)):
     """
     Analiza una radiografía de tórax.
+    Con ?perfilar=true (y X-Token-Admin) devuelve además una traza de perfilado.
     """
     tipos_permitidos = ["image/jpeg", "image/png", "image/tiff", "image/jpg"]
     if archivo.content_type not in tipos_permitidos:
@@ -1486,17 +2935,28 @@ async def analizar_radiografia(archivo: UploadFile = File(...)):
             status_code=400, 
             detail=f"Tipo de archivo no soportado: {archivo.content_type}. Use JPEG, PNG o TIFF."
         )
+    if perfilar:
+        comprobar_token_admin(x_token_admin)
     
     try:
-        contenido = await archivo.read()
-        resultado = analizar_imagen_radiografia(contenido)
+        tiempos = {}
+        with medir(tiempos, "lectura"):
+            contenido = await archivo.read()
+        if perfilar:
+            resultado, espera = await ejecutar_inferencia(
+                analizar_con_perfilado, contenido, "radiografia", tiempos=tiempos, registrar_metricas=False)
+        else:
+            resultado, espera = await ejecutar_inferencia(analizar_imagen_radiografia, contenido, tiempos=tiempos)
         
         return {
             "exito": True,
             "nombre_archivo": archivo.filename,
-            **resultado
+            **resultado,
+            "tiempo_espera_cola": f"{espera:.3f}s"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1520,6 +2980,427 @@ async def obtener_categorias_radiografia():
     }
 
 
+# =============================================================================
+# ANÁLISIS POR LOTES (CASOS DE AUTOPSIA)
+# =============================================================================
+
+def extraer_imagenes_zip(contenido):
+    """Devuelve [(nombre, bytes)] de las imágenes de un ZIP, con límites de tamaño"""
+    import zipfile
+
+    imagenes = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+        for info in zf.infolist():
+            nombre = info.filename
+            if info.is_dir() or not nombre.lower().endswith(EXTENSIONES_IMAGEN):
+                continue
+            if nombre.startswith("__MACOSX/") or os.path.basename(nombre).startswith("."):
+                continue
+            total += info.file_size
+            if len(imagenes) >= LOTE_MAX_IMAGENES or total > LOTE_MAX_MB * 1024 * 1024:
+                raise ValueError(f"El ZIP supera el límite del lote ({LOTE_MAX_IMAGENES} imágenes / {LOTE_MAX_MB:.0f} MB)")
+            imagenes.append((nombre, zf.read(info)))
+    return imagenes
+
+
+def _preparar_imagen_lote(imagen_bytes, procesador):
+    """Decodifica y preprocesa una imagen del lote (en el pool de decodificación)"""
+    tiempos = {}
+    with medir(tiempos, "decodificacion"):
+        imagen, tamano = decodificar_imagen(imagen_bytes)
+    with medir(tiempos, "preprocesado"):
+        tensor = procesador(imagen)
+    return tensor, tamano, tiempos
+
+
+def _resultado_en_linea(funcion, *args):
+    """Future ya resuelto con funcion(*args), ejecutada en este hilo"""
+    futuro = Future()
+    try:
+        futuro.set_result(funcion(*args))
+    except Exception as e:
+        futuro.set_exception(e)
+    return futuro
+
+
+def iterar_lote(imagenes, modalidad="histologia", organo_filtro=None):
+    """
+    Procesa un lote [(nombre, bytes)] por bloques de LOTE_TAMANO_MAX y genera, para
+    cada bloque, la lista de resultados por imagen. Con DECODIFICACION_HILOS > 0 la
+    decodificación es paralela y el bloque siguiente se decodifica mientras el actual
+    pasa por encode_image; con 0, cada bloque se decodifica en este hilo al llegarle el turno.
+    """
+    anticipar = DECODIFICACION_HILOS > 0
+    tipos = ("biovil", "biomedclip") if modalidad == "radiografia" else ("biomedclip",)
+    with residencia.usar(*tipos):
+        if not cargar_modelo(tipos[0]):
+            raise Exception("No se pudo cargar el modelo BiomedCLIP")
+        m = modelos_cargados["biomedclip"]
+
+        def lanzar(desde):
+            preparados = []
+            for indice in range(desde, min(desde + LOTE_TAMANO_MAX, len(imagenes))):
+                datos = imagenes[indice][1]
+                clave = cache_imagenes.clave(datos)
+                entrada = cache_imagenes.obtener(clave)
+                futuro = None
+                if entrada is None and anticipar:
+                    futuro = _ejecutor_decodificacion.submit(_preparar_imagen_lote, datos, m["procesador"])
+                elif entrada is None:
+                    futuro = _resultado_en_linea(_preparar_imagen_lote, datos, m["procesador"])
+                preparados.append((indice, clave, entrada, futuro))
+            return preparados
+
+        siguiente = lanzar(0) if anticipar else None
+        try:
+            for desde in range(0, len(imagenes), LOTE_TAMANO_MAX):
+                if anticipar:
+                    actual = siguiente
+                    siguiente = lanzar(desde + LOTE_TAMANO_MAX)
+                else:
+                    actual = lanzar(desde)
+                inicio = time.time()
+
+                # Todos los tensores del bloque entran a la vez en el planificador → un lote real
+                orden = prioridad_hilo()
+                pendientes = []
+                for indice, clave, entrada, futuro in actual:
+                    if entrada is not None:
+                        pendientes.append((indice, clave, entrada, None, {}, None))
+                        continue
+                    try:
+                        tensor, tamano, tiempos = futuro.result()
+                        pendientes.append((indice, clave, {"tamano": tamano}, planificador_imagenes.enviar(tensor, orden), tiempos, None))
+                    except Exception as e:
+                        pendientes.append((indice, clave, None, None, {}, e))
+
+                bloque = []
+                for indice, clave, entrada, futuro_emb, tiempos, error in pendientes:
+                    nombre = imagenes[indice][0]
+                    try:
+                        if error is not None:
+                            raise error
+                        desde_cache = futuro_emb is None
+                        if desde_cache:
+                            embedding = entrada["embedding"]
+                        else:
+                            with medir(tiempos, "inferencia"):
+                                embedding = futuro_emb.result()
+                            cache_imagenes.guardar(clave, {"embedding": embedding, "tamano": entrada["tamano"]})
+                        if modalidad == "radiografia":
+                            resultado = resultado_radiografia(embedding, entrada["tamano"], desde_cache, m, tiempos, inicio)
+                        else:
+                            resultado = resultado_histologia(embedding, entrada["tamano"], desde_cache, organo_filtro, m, tiempos, inicio)
+                        bloque.append({"indice": indice, "nombre_archivo": nombre, "exito": True, **resultado})
+                    except Exception as e:
+                        bloque.append({"indice": indice, "nombre_archivo": nombre, "exito": False, "error": str(e)})
+                yield bloque
+        finally:
+            # Cierre anticipado (cliente desconectado): el bloque ya lanzado no se decodifica para nadie
+            for _, _, _, futuro in siguiente or []:
+                if futuro is not None:
+                    futuro.cancel()
+
+
+def resumen_caso(resultados, duracion):
+    """Resumen a nivel de caso: diagnósticos principales, perfil medio y confianza"""
+    validos = [r for r in resultados if r.get("exito")]
+    principales = {}
+    perfil = {}
+    confianza = {"alta": 0, "media": 0, "baja": 0}
+    for r in validos:
+        p = r["diagnostico_principal"]
+        clave = p.get("diagnostico_id", p.get("id"))
+        entrada = principales.setdefault(clave, {"diagnostico_id": clave, "diagnostico": p["diagnostico"], "imagenes": []})
+        entrada["imagenes"].append(r["nombre_archivo"])
+        confianza[r["confianza"]] += 1
+        for d in r["todos_los_diagnosticos"]:
+            clave_d = d.get("diagnostico_id", d.get("id"))
+            acumulado = perfil.setdefault(clave_d, {"diagnostico_id": clave_d, "diagnostico": d["diagnostico"], "suma": 0.0})
+            acumulado["suma"] += d["probabilidad"]
+
+    perfil_medio = sorted(
+        ({"diagnostico_id": v["diagnostico_id"], "diagnostico": v["diagnostico"],
+          "probabilidad_media": round(v["suma"] / len(validos), 3)} for v in perfil.values()),
+        key=lambda x: x["probabilidad_media"], reverse=True
+    )
+    return {
+        "num_imagenes": len(resultados),
+        "num_analizadas": len(validos),
+        "num_errores": len(resultados) - len(validos),
+        "num_desde_cache": sum(1 for r in validos if r.get("desde_cache")),
+        "diagnosticos_principales": sorted(
+            ({**v, "num_imagenes": len(v["imagenes"])} for v in principales.values()),
+            key=lambda x: x["num_imagenes"], reverse=True
+        ),
+        "perfil_medio": perfil_medio[:5],
+        "confianza": confianza,
+        "tiempo_total": f"{duracion:.2f}s",
+        "imagenes_por_segundo": round(len(resultados) / duracion, 2) if duracion > 0 else None,
+    }
+
+
+def analizar_lote(imagenes, modalidad="histologia", organo_filtro=None):
+    """Analiza un lote completo y devuelve los resultados por imagen y el resumen del caso"""
+    inicio = time.time()
+    resultados = []
+    for bloque in iterar_lote(imagenes, modalidad, organo_filtro):
+        resultados.extend(bloque)
+    return {
+        "resultados": resultados,
+        "resumen_caso": resumen_caso(resultados, time.time() - inicio),
+    }
+
+
+async def leer_archivos_lote(archivos):
+    """Lee los ficheros subidos (imágenes sueltas y/o ZIP) como [(nombre, bytes)]"""
+    imagenes = []
+    loop = asyncio.get_running_loop()
+    for archivo in archivos:
+        contenido = await archivo.read()
+        es_zip = archivo.content_type in TIPOS_ZIP or (archivo.filename or "").lower().endswith(".zip")
+        if es_zip:
+            try:
+                imagenes.extend(await loop.run_in_executor(_ejecutor_decodificacion, extraer_imagenes_zip, contenido))
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"ZIP no válido ({archivo.filename}): {e}")
+        elif archivo.content_type in TIPOS_IMAGEN_PERMITIDOS:
+            imagenes.append((archivo.filename, contenido))
+        else:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Tipo de archivo no soportado: {archivo.content_type} ({archivo.filename}). Use JPEG, PNG, TIFF o ZIP."
+            )
+    if not imagenes:
+        raise HTTPException(status_code=400, detail="El lote no contiene imágenes")
+    if len(imagenes) > LOTE_MAX_IMAGENES:
+        raise HTTPException(status_code=413, detail=f"El lote supera el máximo de {LOTE_MAX_IMAGENES} imágenes")
+    return imagenes
+
+
+def _validar_parametros_lote(modalidad, categoria, prioridad="estandar"):
+    if prioridad not in PRIORIDADES:
+        raise HTTPException(status_code=400, detail=f"Prioridad no válida. Use una de {list(PRIORIDADES)}.")
+    if modalidad not in ("histologia", "radiografia"):
+        raise HTTPException(status_code=400, detail="Modalidad no válida. Use 'histologia' o 'radiografia'.")
+    if categoria and categoria not in CATEGORIAS_FORENSES:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Categoría no encontrada. Disponibles: {list(CATEGORIAS_FORENSES.keys())}"
+        )
+
+
+@app.post("/analizar-lote")
+async def analizar_lote_endpoint(
+    archivos: List[UploadFile] = File(...),
+    modalidad: str = "histologia",
+    categoria: Optional[str] = None,
+    prioridad: str = "estandar"
+):
+    """
+    Analiza un caso completo: varias imágenes o un ZIP. Las imágenes se decodifican en
+    paralelo y pasan por encode_image en lotes reales.
+    """
+    _validar_parametros_lote(modalidad, categoria, prioridad)
+    imagenes = await leer_archivos_lote(archivos)
+    try:
+        resultado, espera = await ejecutar_inferencia(
+            analizar_lote, imagenes, modalidad, categoria, prioridad=prioridad, unidades=len(imagenes)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error en análisis por lotes: {str(e)}")
+    return {
+        "exito": True,
+        "modalidad": modalidad,
+        "filtro_categoria": categoria,
+        **resultado,
+        "tiempo_espera_cola": f"{espera:.3f}s"
+    }
+
+
+def _serializar_evento(tipo, datos, formato):
+    """Una línea NDJSON o un evento SSE"""
+    cuerpo = json.dumps({"tipo": tipo, **datos}, ensure_ascii=False)
+    if formato == "sse":
+        return f"event: {tipo}\ndata: {cuerpo}\n\n"
+    return cuerpo + "\n"
+
+
+async def transmitir_lote(imagenes, modalidad, organo_filtro, formato, prioridad="estandar"):
+    """
+    Genera los resultados del lote a medida que se puntúa cada bloque.
+    El bloque siguiente solo se calcula cuando el cliente ha consumido el anterior
+    (StreamingResponse espera a cada envío), así que un cliente lento no acumula
+    resultados en memoria del servidor.
+    """
+    generador = iterar_lote(imagenes, modalidad, organo_filtro)
+    control = threading.Lock()
+    estado = {"ejecutando": False, "cerrar": False}
+
+    def siguiente_bloque():
+        with control:
+            if estado["cerrar"]:
+                return None
+            estado["ejecutando"] = True
+        try:
+            return next(generador, None)
+        finally:
+            with control:
+                estado["ejecutando"] = False
+                cerrar = estado["cerrar"]
+            if cerrar:
+                generador.close()
+
+    def cerrar_generador():
+        """
+        Cierra el generador (cancela la decodificación anticipada y libera la residencia).
+        Si hay un bloque en curso, lo cierra el propio hilo del bloque al terminar, dentro
+        del hueco de admisión que ya ocupa; si no, el cierre es inmediato y barato.
+        """
+        with control:
+            estado["cerrar"] = True
+            if estado["ejecutando"]:
+                return
+        generador.close()
+
+    inicio = time.time()
+    resultados = []
+    try:
+        yield _serializar_evento("inicio", {"num_imagenes": len(imagenes), "modalidad": modalidad}, formato)
+        while True:
+            restantes = len(imagenes) - len(resultados)
+            bloque, _ = await ejecutar_inferencia(siguiente_bloque, prioridad=prioridad, esperar=True,
+                                                  unidades=min(LOTE_TAMANO_MAX, max(1, restantes)))
+            if bloque is None:
+                break
+            for resultado in bloque:
+                resultados.append(resultado)
+                yield _serializar_evento("resultado", resultado, formato)
+        yield _serializar_evento("resumen", {"resumen_caso": resumen_caso(resultados, time.time() - inicio)}, formato)
+    except Exception as e:
+        yield _serializar_evento("error", {"error": str(e)}, formato)
+    finally:
+        # Si el cliente se desconecta, se cierra el generador (libera la residencia del modelo)
+        cerrar_generador()
+
+
+@app.post("/analizar-lote/stream")
+async def analizar_lote_stream(
+    archivos: List[UploadFile] = File(...),
+    modalidad: str = "histologia",
+    categoria: Optional[str] = None,
+    formato: str = "ndjson",
+    prioridad: str = "estandar"
+):
+    """
+    Igual que /analizar-lote, pero transmite cada resultado en cuanto se puntúa:
+    formato=ndjson (una línea JSON por evento) o formato=sse (Server-Sent Events).
+    """
+    _validar_parametros_lote(modalidad, categoria, prioridad)
+    if formato not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="Formato no válido. Use 'ndjson' o 'sse'.")
+    comprobar_admision(prioridad)
+    imagenes = await leer_archivos_lote(archivos)
+    media_type = "text/event-stream" if formato == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        transmitir_lote(imagenes, modalidad, categoria, formato, prioridad),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# =============================================================================
+# TRABAJOS ASÍNCRONOS (COLA PERSISTENTE)
+# =============================================================================
+
+cola_trabajos = None
+_aviso_trabajos = None
+
+
+def _analizar_imagen_trabajo(modalidad, categoria, datos):
+    """Analiza una imagen de un trabajo con las funciones de análisis existentes"""
+    if modalidad == "radiografia":
+        return analizar_imagen_radiografia(datos)
+    return analizar_imagen(datos, organo_filtro=categoria)
+
+
+async def _trabajador_trabajos(numero):
+    """Drena la cola persistente: reclama una imagen, la analiza y guarda el resultado"""
+    while True:
+        try:
+            item = await asyncio.to_thread(cola_trabajos.reclamar)
+        except Exception as e:
+            print(f"⚠️ Trabajador {numero}: error leyendo la cola: {e}")
+            item = None
+        if item is None:
+            _aviso_trabajos.clear()
+            try:
+                await asyncio.wait_for(_aviso_trabajos.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            resultado, _ = await ejecutar_inferencia(
+                _analizar_imagen_trabajo, item["modalidad"], item["categoria"], item["datos"],
+                prioridad=item["prioridad"] or "masiva", esperar=True
+            )
+            await asyncio.to_thread(cola_trabajos.completar, item["trabajo_id"], item["indice"], resultado)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await asyncio.to_thread(cola_trabajos.completar, item["trabajo_id"], item["indice"], None, str(e))
+
+
+def iniciar_trabajadores():
+    """Abre la cola, reanuda lo que quedó a medias y lanza los trabajadores"""
+    global cola_trabajos, _aviso_trabajos
+    cola_trabajos = ColaTrabajos(TRABAJOS_DB, lease_s=TRABAJOS_LEASE_S)
+    _aviso_trabajos = asyncio.Event()
+    reanudadas = cola_trabajos.reanudar()
+    if reanudadas:
+        print(f"🔁 {reanudadas} imágenes de trabajos abandonadas (lease vencido) devueltas a la cola")
+    return [asyncio.create_task(_trabajador_trabajos(n)) for n in range(TRABAJOS_WORKERS)]
+
+
+@app.post("/trabajos")
+async def crear_trabajo(
+    archivos: List[UploadFile] = File(...),
+    modalidad: str = "histologia",
+    categoria: Optional[str] = None,
+    prioridad: str = "masiva"
+):
+    """
+    Encola un análisis (imágenes o ZIP) y devuelve inmediatamente el id del trabajo.
+    El progreso y los resultados se consultan en GET /trabajos/{id}.
+    """
+    _validar_parametros_lote(modalidad, categoria, prioridad)
+    imagenes = await leer_archivos_lote(archivos)
+    id_trabajo = await asyncio.to_thread(cola_trabajos.crear, modalidad, categoria, imagenes, prioridad)
+    _aviso_trabajos.set()
+    return {
+        "exito": True,
+        "trabajo_id": id_trabajo,
+        "num_imagenes": len(imagenes),
+        "estado": "pendiente",
+        "url": f"/trabajos/{id_trabajo}"
+    }
+
+
+@app.get("/trabajos/{trabajo_id}")
+async def obtener_trabajo(trabajo_id: str, incluir_resultados: bool = True):
+    """Progreso, resultados por imagen y, al terminar, el resumen del caso"""
+    trabajo = await asyncio.to_thread(cola_trabajos.obtener, trabajo_id, incluir_resultados)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo no encontrado: {trabajo_id}")
+    if incluir_resultados and trabajo["estado"] == "completado":
+        duracion = (trabajo["finalizado"] or time.time()) - trabajo["creado"]
+        trabajo["resumen_caso"] = resumen_caso(trabajo["resultados"], duracion)
+    return trabajo
+
+
 @app.get("/api/health")
 async def health_check():
     """Verificación de salud del servicio"""
@@ -1529,10 +3410,81 @@ async def health_check():
         "status": "healthy", 
         "version": "2.2.0-BiovilT-Fix",
         "biomedclip_cargado": biomed_ok,
-        "biovil_cargado": biovil_ok
+        "biovil_cargado": biovil_ok,
+        "listo": estado_modelos["biomedclip"]["estado"] == ESTADO_LISTO,
+        "modelos": {tipo: resumen_estado_modelo(tipo) for tipo in estado_modelos}
     }
 
 
+@app.get("/api/health/listo")
+async def readiness_check():
+    """
+    Readiness para el orquestador: 200 si el motor BiomedCLIP está listo o si la residencia
+    lo desalojó (se recarga bajo demanda: una réplica sin tráfico no debe quedar fuera
+    del balanceo y sin forma de volver), 503 si no
+    """
+    estado = resumen_estado_modelo("biomedclip")
+    listo = estado["estado"] == ESTADO_LISTO or (estado["desalojado"] and estado["estado"] != ESTADO_ERROR)
+    codigo = 200 if listo else 503
+    return JSONResponse(status_code=codigo, content={"listo": codigo == 200, "biomedclip": estado})
+
+
+
+# =============================================================================
+# MÉTRICAS (PROMETHEUS)
+# =============================================================================
+
+def _metricas_estado():
+    """Valores de estado que se leen en cada scrape (no cuestan nada entre scrapes)"""
+    ocupacion = admision.ocupacion()
+    yield metricas.medidor(
+        "patologia_admision_en_cola", "Análisis esperando hueco en la cola de admisión",
+        {c: n for c, (n, _) in ocupacion.items()}, ("prioridad",))
+    yield metricas.medidor(
+        "patologia_admision_en_ejecucion", "Análisis en ejecución en el pool de inferencia",
+        {c: n for c, (_, n) in ocupacion.items()}, ("prioridad",))
+    yield metricas.contador(
+        "patologia_admision_rechazadas", "Peticiones rechazadas con 429, por motivo",
+        {"cola_llena": admision.rechazadas, "espera_maxima": admision.rechazadas_por_espera}, ("motivo",))
+    yield metricas.medidor(
+        "patologia_planificador_en_cola", "Tensores esperando entrar en un micro-lote",
+        planificador_imagenes._cola.qsize())
+    if cola_trabajos is not None:
+        yield metricas.medidor(
+            "patologia_trabajos_imagenes_pendientes", "Imágenes de trabajos asíncronos pendientes o en proceso",
+            cola_trabajos.pendientes())
+
+    yield metricas.contador(
+        "patologia_cache_imagenes_consultas", "Consultas a la caché de embeddings de imagen, por resultado",
+        {"acierto": cache_imagenes.aciertos, "fallo": cache_imagenes.fallos}, ("resultado",))
+    total = cache_imagenes.aciertos + cache_imagenes.fallos
+    yield metricas.medidor(
+        "patologia_cache_imagenes_tasa_aciertos", "Fracción de aciertos de la caché desde el arranque",
+        cache_imagenes.aciertos / total if total else 0.0)
+    yield metricas.medidor(
+        "patologia_cache_imagenes_entradas", "Embeddings de imagen en la caché", len(cache_imagenes._entradas))
+
+    rss = memoria_rss_mb()
+    yield metricas.medidor(
+        "patologia_memoria_rss_bytes", "Memoria residente del proceso",
+        rss * 1024 * 1024 if rss is not None else None)
+    yield metricas.medidor(
+        "patologia_modelo_cargado", "1 si el modelo está en memoria",
+        {t: int(modelos_cargados[t]["modelo"] is not None) for t in modelos_cargados}, ("modelo",))
+
+
+metricas.registrar_colector(_metricas_estado)
+
+
+@app.get("/metrics")
+async def exportar_metricas():
+    """Métricas en formato de exposición de Prometheus"""
+    cuerpo, tipo_contenido = metricas.exportar()
+    if cuerpo is None:
+        raise HTTPException(status_code=503, detail="prometheus_client no está instalado")
+    return Response(content=cuerpo, media_type=tipo_contenido)
+
+
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8000))
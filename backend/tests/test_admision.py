@@ -0,0 +1,56 @@
+"""Control de admisión de planificador.py (sin dependencias: solo asyncio)"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from planificador import ColaLlena, ControlAdmision
+
+
+async def _intentar(admision, prioridad, n):
+    """Lanza n entrar() de la clase y devuelve (admitidas, en cola, rechazadas)"""
+    tareas = [asyncio.create_task(admision.entrar(prioridad=prioridad)) for _ in range(n)]
+    await asyncio.sleep(0)
+    admitidas = sum(1 for t in tareas if t.done() and not t.exception())
+    rechazadas = sum(1 for t in tareas if t.done() and isinstance(t.exception(), ColaLlena))
+    en_cola = admision.en_cola
+    for t in tareas:
+        t.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+    return admitidas, en_cola, rechazadas
+
+
+def test_clase_en_su_limite_respeta_la_capacidad_de_cola():
+    # Quedan huecos globales libres, pero 'masiva' está en su límite: la cola no puede crecer sin fin
+    admision = ControlAdmision(4, 2, 0, limites={"masiva": 2})
+    admitidas, en_cola, rechazadas = asyncio.run(_intentar(admision, "masiva", 50))
+    assert admitidas == 2
+    assert en_cola == 2
+    assert rechazadas == 46
+
+
+def test_sin_huecos_rechaza_por_encima_de_la_capacidad():
+    admision = ControlAdmision(2, 3, 0)
+    admitidas, en_cola, rechazadas = asyncio.run(_intentar(admision, "interactiva", 10))
+    assert (admitidas, en_cola, rechazadas) == (2, 3, 5)
+
+
+def test_otra_clase_entra_aunque_la_cola_de_masiva_este_llena():
+    async def escenario():
+        admision = ControlAdmision(4, 2, 0, limites={"masiva": 2})
+        masivas = [asyncio.create_task(admision.entrar(prioridad="masiva")) for _ in range(4)]
+        await asyncio.sleep(0)
+        # Hay huecos libres y 'interactiva' está bajo su límite: entra sin esperar
+        espera = await admision.entrar(prioridad="interactiva")
+        with pytest.raises(ColaLlena):
+            await admision.entrar(prioridad="masiva")
+        for t in masivas:
+            t.cancel()
+        await asyncio.gather(*masivas, return_exceptions=True)
+        return espera
+
+    assert asyncio.run(escenario()) >= 0
@@ -0,0 +1,112 @@
+"""
+Topología de CPU y reparto de hilos por proceso.
+
+Con varios workers de uvicorn/gunicorn en el mismo host, cada proceso abre por
+defecto un pool de torch del tamaño de TODA la máquina (o del host, ignorando la
+cuota del contenedor), y los pools compiten por los mismos núcleos. Aquí se
+calcula cuántas CPUs tiene realmente el proceso (afinidad y cuota de cgroup v1/v2),
+se reparten entre los workers y, opcionalmente, se comparan varias configuraciones
+sobre un lote sintético.
+"""
+
+import math
+import os
+import time
+
+
+def _cuota_cgroup():
+    """CPUs permitidas por la cuota CFS del cgroup (None si no hay límite)"""
+    # cgroup v2: "max 100000" o "200000 100000"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            cuota, periodo = f.read().split()[:2]
+        if cuota != "max":
+            return int(cuota) / int(periodo)
+        return None
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            cuota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            periodo = int(f.read())
+        if cuota > 0 and periodo > 0:
+            return cuota / periodo
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def cpus_disponibles():
+    """Núcleos utilizables: afinidad del proceso limitada por la cuota del cgroup"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    cuota = _cuota_cgroup()
+    if cuota is not None:
+        cpus = min(cpus, max(1, math.ceil(cuota)))
+    return max(1, cpus)
+
+
+def numero_workers():
+    """Workers del servidor en este host (WEB_CONCURRENCY, la convención de uvicorn/gunicorn)"""
+    for variable in ("WEB_CONCURRENCY", "UVICORN_WORKERS", "GUNICORN_WORKERS"):
+        valor = os.environ.get(variable)
+        if valor and valor.strip().isdigit() and int(valor) > 0:
+            return int(valor)
+    return 1
+
+
+def planificar_hilos(cpus=None, workers=None):
+    """
+    Reparto por worker: la inferencia se serializa en el hilo del planificador de
+    lotes, así que basta un hilo inter-op. El pool de decodificación solo lo usa el
+    análisis por lotes, que decodifica el bloque siguiente A LA VEZ que encode_image
+    (/analizar decodifica en el propio hilo de inferencia). Con 4 o más núcleos por
+    worker se le reserva una cuarta parte y el resto va a intra-op; con menos no
+    compensa quitarle núcleos a intra-op: 0 hilos de decodificación (el lote se
+    decodifica en el hilo de inferencia). Nunca se planifican más hilos que núcleos.
+    """
+    cpus = cpus or cpus_disponibles()
+    workers = workers or numero_workers()
+    por_worker = max(1, cpus // workers)
+    decodificacion = por_worker // 4 if por_worker >= 4 else 0
+    return {
+        "cpus_disponibles": cpus,
+        "cuota_cgroup": _cuota_cgroup(),
+        "workers": workers,
+        "cpus_por_worker": por_worker,
+        "hilos_intra_op": por_worker - decodificacion,
+        "hilos_inter_op": 1,
+        "hilos_decodificacion": decodificacion,
+        "sobresuscripcion": workers > cpus,
+    }
+
+
+def candidatos_intra_op(por_worker, intra_op=None):
+    """
+    Configuraciones que se comparan en la calibración: incluye todos los núcleos del
+    worker, para que la calibración pueda recuperar los reservados a decodificación
+    """
+    intra_op = intra_op or por_worker
+    return sorted({por_worker, intra_op, max(1, intra_op // 2), max(1, intra_op - 1)}, reverse=True)
+
+
+def calibrar(funcion_lote, aplicar_hilos, candidatos, lote, repeticiones=3):
+    """
+    Mide imágenes/s de funcion_lote(lote) con cada nº de hilos intra-op candidato
+    y deja aplicado el mejor. Devuelve (mejor, {hilos: imágenes/s}).
+    """
+    resultados = {}
+    for hilos in candidatos:
+        aplicar_hilos(hilos)
+        funcion_lote(lote)  # descarta la primera ejecución (pools, caches)
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            funcion_lote(lote)
+        resultados[hilos] = round(len(lote) * repeticiones / (time.perf_counter() - inicio), 2)
+    mejor = max(resultados, key=resultados.get)
+    aplicar_hilos(mejor)
+    return mejor, resultados
@@ -5,7 +5,10 @@
 
 import React, { useState, useEffect } from 'react';
 import { Brain, Upload, Loader2, CheckCircle, XCircle, AlertTriangle, Cpu, HardDrive, Zap, Trash2, Stethoscope, Activity, FileText } from 'lucide-react';
-import { verificarConexion, obtenerEstadoModelo, analizarImagen, liberarModelo, archivoABase64, API_URL } from './api';
+import { verificarConexion, obtenerEstadoModelo, analizarImagen, analizarPanel, liberarModelo, archivoABase64, API_URL } from './api';
+
+// Opción del selector que analiza todas las categorías por separado en una sola pasada
+const PANEL_COMPLETO = 'panel';
 
 export default function AnalisisIA({ onResultado, imagenActual }) {
   const [conectado, setConectado] = useState(false);
@@ -22,6 +25,7 @@ export default function AnalisisIA({ onResultado, imagenActual }) {
   // Categorías disponibles
   const categorias = [
     { id: null, nombre: 'Todas las categorías (75+ diagnósticos)' },
+    { id: PANEL_COMPLETO, nombre: '📋 Panel completo (resultado por categoría)' },
     { id: 'contusiones', nombre: '🩸 Contusiones (datación temporal)' },
     { id: 'arma_fuego', nombre: '🔫 Arma de fuego' },
     { id: 'arma_blanca', nombre: '🗡️ Arma blanca' },
@@ -82,8 +86,10 @@ export default function AnalisisIA({ onResultado, imagenActual }) {
     }, 300);
 
     try {
-      // Pasar la categoría seleccionada (puede ser null para todas)
-      const res = await analizarImagen(archivoSeleccionado, categoriaSeleccionada);
+      // Pasar la categoría seleccionada (puede ser null para todas) o pedir el panel completo
+      const res = categoriaSeleccionada === PANEL_COMPLETO
+        ? await analizarPanel(archivoSeleccionado)
+        : await analizarImagen(archivoSeleccionado, categoriaSeleccionada);
       
       clearInterval(intervalo);
       setProgreso(100);
@@ -92,10 +98,10 @@ export default function AnalisisIA({ onResultado, imagenActual }) {
         setResultado({ ...res, exito: true });
         if (onResultado) onResultado(res);
         
-        // Liberar modelo si modo ahorro está activo
+        // Liberar modelo si modo ahorro está activo (cuando quede inactivo)
         if (modoAhorro) {
           try {
-            await liberarModelo('biomedclip');
+            await liberarModelo('biomedclip', true);
           } catch (e) {
             console.log('Modelo ya liberado o no cargado');
           }
@@ -422,6 +428,34 @@ export default function AnalisisIA({ onResultado, imagenActual }) {
               </div>
             )}
 
+            {/* Panel completo: mejor diagnóstico de cada categoría */}
+            {resultado.categorias && Object.keys(resultado.categorias).length > 0 && (
+              <div className="space-y-2">
+                <h4 className="text-sm font-semibold text-gray-700 flex items-center gap-2">
+                  <FileText className="w-4 h-4" />
+                  Resultado por categoría:
+                </h4>
+                <div className="space-y-2">
+                  {Object.entries(resultado.categorias)
+                    .sort(([, a], [, b]) => b.probabilidad_global - a.probabilidad_global)
+                    .map(([id, cat]) => (
+                      <div key={id} className={`p-3 rounded-lg border ${getColorByProbabilidad(cat.diagnostico_principal.probabilidad)}`}>
+                        <div className="flex items-center justify-between">
+                          <div>
+                            <span className="text-xs font-semibold uppercase opacity-75">{cat.nombre}</span>
+                            <p className="font-medium">{cat.diagnostico_principal.diagnostico}</p>
+                          </div>
+                          <div className="text-right">
+                            <span className="font-bold">{cat.diagnostico_principal.probabilidad.toFixed(1)}%</span>
+                            <p className="text-xs opacity-75">Global: {cat.diagnostico_principal.probabilidad_global.toFixed(1)}%</p>
+                          </div>
+                        </div>
+                      </div>
+                    ))}
+                </div>
+              </div>
+            )}
+
             {/* Metadatos */}
             <div className="flex items-center justify-between text-xs text-gray-500 pt-3 border-t">
               <div className="flex items-center gap-4">
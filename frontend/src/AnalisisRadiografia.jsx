@@ -65,7 +65,7 @@ export default function AnalisisRadiografia({ onResultado }) {
         setResultado({ ...res, exito: true });
         if (onResultado) onResultado(res);
         if (modoAhorro) {
-          try { await liberarModelo('biovil'); } catch (e) {}
+          try { await liberarModelo('biovil', true); } catch (e) {}
         }
         const modelo = await obtenerEstadoModelo();
         setEstadoModelo(modelo);
@@ -65,6 +65,37 @@ export async function analizarImagen(archivo, categoria = null) {
   }
 }
 
+/**
+ * Analiza una imagen contra todas las categorías forenses en una sola pasada
+ * (softmax global y por categoría)
+ * @param {File} archivo - Archivo de imagen
+ */
+export async function analizarPanel(archivo) {
+  try {
+    const formData = new FormData();
+    formData.append("archivo", archivo);
+
+    const response = await fetch(`${API_URL}/analizar-panel`, {
+      method: "POST",
+      body: formData,
+    });
+
+    if (!response.ok) {
+      let errorDetail = "Error en análisis del panel completo";
+      try {
+        const error = await response.json();
+        errorDetail = error.detail || errorDetail;
+      } catch (e) {}
+      throw new Error(`${errorDetail} (Endpoint: ${API_URL}/analizar-panel, Status: ${response.status})`);
+    }
+
+    return await response.json();
+  } catch (error) {
+    console.error("Error analizando panel:", error);
+    throw error;
+  }
+}
+
 /**
  * Analiza una radiografía de tórax con BioViL-T
  * @param {File} archivo - Archivo de imagen
@@ -98,10 +129,11 @@ export async function analizarRadiografia(archivo) {
 /**
  * Libera un modelo de la memoria
  * @param {string} modelo - 'biomedclip', 'biovil' o 'todos'
+ * @param {boolean} diferido - Solo programa la liberación si el modelo queda inactivo
  */
-export async function liberarModelo(modelo = 'todos') {
+export async function liberarModelo(modelo = 'todos', diferido = false) {
   try {
-    const response = await fetch(`${API_URL}/liberar-modelo?modelo=${modelo}`, {
+    const response = await fetch(`${API_URL}/liberar-modelo?modelo=${modelo}&diferido=${diferido}`, {
       method: "POST",
     });
     if (!response.ok) throw new Error("Error liberando modelo");
@@ -1,15 +1,265 @@
+"""
+Generador de carga HTTP para el servidor de Patología Digital.
 
-import requests
+Envía imágenes reales de imagenes_prueba/ a una mezcla de endpoints
+(/analizar, /analizar/{categoria}, /analizar-radiografia) con un cliente asyncio.
+
+- Lazo abierto (por defecto): las peticiones llegan a una tasa fija o de Poisson,
+  independientemente de lo que tarde el servidor. La latencia se mide desde el
+  instante en que la petición DEBÍA salir, de modo que la espera por falta de
+  conexiones también cuenta (corrección de la omisión coordinada).
+- Lazo cerrado: N clientes envían una petición tras otra. Si se indica --tasa, se
+  corrige la omisión coordinada rellenando las muestras que un cliente no llegó a
+  enviar mientras esperaba una respuesta lenta (como HdrHistogram).
+
+Informa de rendimiento, percentiles de latencia (corregida y sin corregir) y tasas de
+error y de 429 por endpoint.
+
+Uso:
+    python probar_api.py --tasa 5 --duracion 60 --mezcla analizar=6,categoria=3,radiografia=1
+    python probar_api.py --modo cerrado --concurrencia 16 --duracion 60
+Requiere httpx (backend/requirements-dev.txt).
+"""
+
+import argparse
+import asyncio
+import json
 import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from corpus_prueba import cargar_corpus, leer, tipo_mime
+
+ENDPOINTS = ("analizar", "categoria", "radiografia")
+
+
+def percentiles(muestras):
+    if not muestras:
+        return None
+    ordenadas = sorted(muestras)
+
+    def p(q):
+        return round(ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))], 1)
+
+    return {"n": len(ordenadas), "p50": p(0.50), "p90": p(0.90), "p99": p(0.99),
+            "p999": p(0.999), "max": round(ordenadas[-1], 1)}
+
+
+def corregir_omision(latencias_ms, intervalo_ms):
+    """
+    Lazo cerrado: por cada latencia L mayor que el intervalo esperado entre envíos,
+    añade las muestras L - intervalo, L - 2·intervalo, ... que habrían observado las
+    peticiones que no se enviaron mientras se esperaba.
+    """
+    corregidas = list(latencias_ms)
+    if intervalo_ms <= 0:
+        return corregidas
+    for latencia in latencias_ms:
+        faltante = latencia - intervalo_ms
+        while faltante > 0:
+            corregidas.append(faltante)
+            faltante -= intervalo_ms
+    return corregidas
+
+
+def leer_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        nombre = nombre.strip()
+        if nombre not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Endpoint desconocido en --mezcla: {nombre} (use {', '.join(ENDPOINTS)})")
+        mezcla[nombre] = float(peso or 1)
+    return mezcla
+
+
+class GeneradorCarga:
+    def __init__(self, args, imagenes, categorias):
+        self.args = args
+        self.url = args.url.rstrip("/")
+        self.imagenes = imagenes
+        self.categorias = categorias
+        self.nombres = list(args.mezcla)
+        self.pesos = [args.mezcla[n] for n in self.nombres]
+        self.aleatorio = random.Random(args.semilla)
+        self.muestras = []    # dicts por petición medida
+
+    def elegir(self):
+        """Endpoint, ruta HTTP y fichero de la siguiente petición"""
+        endpoint = self.aleatorio.choices(self.nombres, self.pesos)[0]
+        if endpoint == "radiografia":
+            return endpoint, "/analizar-radiografia", self.aleatorio.choice(self.imagenes["radiografia"])
+        ruta = self.aleatorio.choice(self.imagenes["histologia"])
+        if endpoint == "categoria":
+            return endpoint, f"/analizar/{self.aleatorio.choice(self.categorias)}", ruta
+        return endpoint, "/analizar", ruta
+
+    async def enviar(self, cliente, semaforo, previsto, fin_calentamiento):
+        endpoint, ruta_http, ruta = self.elegir()
+        archivos = {"archivo": (os.path.basename(ruta), self.imagenes["datos"][ruta], tipo_mime(ruta))}
+        async with semaforo:
+            enviado = time.perf_counter()
+            try:
+                respuesta = await cliente.post(self.url + ruta_http, files=archivos)
+                estado = respuesta.status_code
+            except Exception as e:
+                estado = type(e).__name__
+        fin = time.perf_counter()
+        if previsto < fin_calentamiento:
+            return
+        self.muestras.append({
+            "endpoint": endpoint,
+            "estado": estado,
+            "fin": fin,
+            # Desde el instante previsto (corregida) y desde el envío real (sin corregir)
+            "latencia_ms": (fin - previsto) * 1000,
+            "servicio_ms": (fin - enviado) * 1000,
+        })
+
+    async def lazo_abierto(self, cliente):
+        semaforo = asyncio.Semaphore(self.args.concurrencia)
+        inicio = time.perf_counter()
+        fin_calentamiento = inicio + self.args.calentamiento
+        limite = inicio + self.args.calentamiento + self.args.duracion
+        tareas = []
+        previsto = inicio
+        while previsto < limite:
+            retraso = previsto - time.perf_counter()
+            if retraso > 0:
+                await asyncio.sleep(retraso)
+            tareas.append(asyncio.create_task(self.enviar(cliente, semaforo, previsto, fin_calentamiento)))
+            if self.args.poisson:
+                previsto += self.aleatorio.expovariate(self.args.tasa)
+            else:
+                previsto += 1.0 / self.args.tasa
+        await asyncio.gather(*tareas)
+        return limite - fin_calentamiento
+
+    async def lazo_cerrado(self, cliente):
+        semaforo = asyncio.Semaphore(self.args.concurrencia)
+        inicio = time.perf_counter()
+        fin_calentamiento = inicio + self.args.calentamiento
+        limite = fin_calentamiento + self.args.duracion
+
+        async def trabajador():
+            while time.perf_counter() < limite:
+                await self.enviar(cliente, semaforo, time.perf_counter(), fin_calentamiento)
+
+        await asyncio.gather(*(trabajador() for _ in range(self.args.concurrencia)))
+        return time.perf_counter() - fin_calentamiento
+
+    def informe(self, duracion):
+        intervalo_ms = 0.0
+        if self.args.modo == "cerrado" and self.args.tasa:
+            # Intervalo previsto entre envíos de cada cliente
+            intervalo_ms = 1000.0 * self.args.concurrencia / self.args.tasa
+
+        def resumir(muestras):
+            total = len(muestras)
+            correctas = [m for m in muestras if m["estado"] == 200]
+            saturadas = sum(1 for m in muestras if m["estado"] == 429)
+            errores = total - len(correctas) - saturadas
+            latencias = [m["latencia_ms"] for m in correctas]
+            if intervalo_ms:
+                latencias = corregir_omision(latencias, intervalo_ms)
+            return {
+                "peticiones": total,
+                "correctas_por_s": round(len(correctas) / duracion, 2) if duracion > 0 else None,
+                "tasa_429": round(saturadas / total, 4) if total else 0.0,
+                "tasa_error": round(errores / total, 4) if total else 0.0,
+                "errores": sorted({str(m["estado"]) for m in muestras if m["estado"] not in (200, 429)}),
+                "latencia_corregida_ms": percentiles(latencias),
+                "latencia_servicio_ms": percentiles([m["servicio_ms"] for m in correctas]),
+            }
+
+        return {
+            "parametros": {k: v for k, v in vars(self.args).items() if k != "salida"},
+            "duracion_s": round(duracion, 1),
+            "global": resumir(self.muestras),
+            "por_endpoint": {
+                e: resumir([m for m in self.muestras if m["endpoint"] == e])
+                for e in self.nombres
+            },
+        }
+
+
+async def obtener_categorias(cliente, url):
+    respuesta = await cliente.get(url.rstrip("/") + "/api/categorias")
+    respuesta.raise_for_status()
+    return list(respuesta.json().keys())
+
+
+async def ejecutar(args):
+    try:
+        import httpx
+    except ImportError:
+        raise SystemExit("❌ probar_api.py necesita httpx: pip install httpx")
+
+    corpus = cargar_corpus(args.corpus)
+    rutas = corpus["histologia"] + corpus["radiografia"]
+    imagenes = {
+        "histologia": corpus["histologia"],
+        "radiografia": corpus["radiografia"],
+        "datos": {r: leer(r) for r in rutas},
+    }
+    if "radiografia" in args.mezcla and not imagenes["radiografia"]:
+        raise SystemExit("❌ No hay radiografías en el corpus")
+
+    limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limites) as cliente:
+        categorias = args.categorias or await obtener_categorias(cliente, args.url)
+        generador = GeneradorCarga(args, imagenes, categorias)
+        print(f"🚦 {args.modo}: {args.tasa or '-'} pet/s, concurrencia {args.concurrencia}, "
+              f"{args.duracion}s (+{args.calentamiento}s de calentamiento) contra {args.url}")
+        if args.modo == "abierto":
+            duracion = await generador.lazo_abierto(cliente)
+        else:
+            duracion = await generador.lazo_cerrado(cliente)
+    return generador.informe(duracion)
+
+
+def imprimir(informe):
+    g = informe["global"]
+    print(f"\n📊 {g['peticiones']} peticiones en {informe['duracion_s']}s → {g['correctas_por_s']} correctas/s")
+    print(f"   429: {g['tasa_429']:.2%}   errores: {g['tasa_error']:.2%} {g['errores'] or ''}")
+    for nombre, datos in [("global", g)] + list(informe["por_endpoint"].items()):
+        corr, serv = datos["latencia_corregida_ms"], datos["latencia_servicio_ms"]
+        if not corr:
+            continue
+        print(f"   {nombre:<12} corregida p50={corr['p50']} p99={corr['p99']} p99.9={corr['p999']} ms | "
+              f"servicio p50={serv['p50']} p99={serv['p99']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga HTTP (asyncio) con imágenes de imagenes_prueba/")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--modo", choices=["abierto", "cerrado"], default="abierto")
+    parser.add_argument("--tasa", type=float, default=None, help="Peticiones/s (obligatoria en lazo abierto)")
+    parser.add_argument("--poisson", action="store_true", help="Llegadas de Poisson en lugar de tasa constante")
+    parser.add_argument("--concurrencia", type=int, default=32, help="Conexiones en vuelo (lazo cerrado: nº de clientes)")
+    parser.add_argument("--duracion", type=float, default=60.0, help="Segundos medidos")
+    parser.add_argument("--calentamiento", type=float, default=5.0, help="Segundos iniciales que no se miden")
+    parser.add_argument("--mezcla", type=leer_mezcla, default=leer_mezcla("analizar=6,categoria=3,radiografia=1"))
+    parser.add_argument("--categorias", type=lambda t: [c for c in t.split(",") if c], default=None,
+                        help="Categorías para /analizar/{categoria} (por defecto, las de /api/categorias)")
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", default=None, help="Guarda el informe en JSON")
+    args = parser.parse_args()
+    if args.modo == "abierto" and not args.tasa:
+        parser.error("el lazo abierto necesita --tasa")
+
+    informe = asyncio.run(ejecutar(args))
+    imprimir(informe)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+        print(f"💾 Informe guardado en {args.salida}")
+
 
-url = "http://localhost:8000/analizar-radiografia"
-# Usamos una imagen de prueba si existe, sino creamos una dummy
-dummy_image = b"fake image content"
-files = {"archivo": ("test.png", dummy_image, "image/png")}
-
-try:
-    response = requests.post(url, files=files)
-    print(f"Status Code: {response.status_code}")
-    print(f"Response: {response.text}")
-except Exception as e:
-    print(f"Error: {e}")
+if __name__ == "__main__":
+    main()